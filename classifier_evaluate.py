@@ -3,6 +3,7 @@ import torch
 import numpy as np
 from src.datamodule import HouseDataModule
 from src.model import HPClassifier
+from src.feature_cache import FeatureStore
 from sklearn.metrics import classification_report
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -66,17 +67,22 @@ def print_classification_reports(categories):
         )
 
 
-def main(ckpt_path, img_dir, data_dir):
+def main(ckpt_path, img_dir, data_dir, feature_cache_dir=None):
+    model = load_model(ckpt_path)
+    model.to(model.device)  # Ensure model is on the correct device
+    model.eval()
+
+    # Repeated evaluations of a checkpoint reuse its backbone features
+    feature_store = FeatureStore(feature_cache_dir, model.backbone) if feature_cache_dir else None
     dm = HouseDataModule(
         img_dir=img_dir,
         data_dir=data_dir,
         batch_size=16,
         num_workers=1,
+        feature_store=feature_store,
     )
-    dm.setup(stage="fit")
-
-    model = load_model(ckpt_path)
-    model.to(model.device)  # Ensure model is on the correct device
+    dm.setup(stage="test")
+    model.cached_features = dm.use_cached_features()
 
     categories = evaluate_model(model, dm.test_dataloader, model.device)
     print_classification_reports(categories)
@@ -84,9 +90,10 @@ def main(ckpt_path, img_dir, data_dir):
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python classifier_evaluate.py <CHECKPOINT_PATH> <IMG_DIR> <DATA_DIR>")
+        print("Usage: python classifier_evaluate.py <CHECKPOINT_PATH> <IMG_DIR> <DATA_DIR> [FEATURE_CACHE_DIR]")
         sys.exit(1)
     CKPT_PATH = sys.argv[1]
     IMG_DIR = sys.argv[2]
     DATA_DIR = sys.argv[3] # where the partitioned csvs are
-    main(CKPT_PATH, IMG_DIR, DATA_DIR)
+    FEATURE_CACHE_DIR = sys.argv[4] if len(sys.argv) > 4 else None
+    main(CKPT_PATH, IMG_DIR, DATA_DIR, FEATURE_CACHE_DIR)
@@ -0,0 +1,43 @@
+import os
+import sys
+import torch
+from src.constants import CATEGORY_NAMES
+from src.model import HPClassifier
+from src.export import ExportedClassifier, export_onnx, export_torchscript
+
+
+def load_model(checkpoint_path):
+    try:
+        model = HPClassifier.load_from_checkpoint(checkpoint_path, map_location="cpu")
+        return model
+    except Exception as e:
+        print(f"Failed to load model from {checkpoint_path}: {e}")
+        sys.exit(1)
+
+
+def main(ckpt_path, output_path):
+    model = load_model(ckpt_path)
+    model.eval()
+
+    if os.path.splitext(output_path)[1] == ".onnx":
+        export_onnx(model, output_path)
+    else:
+        export_torchscript(model, output_path)
+    print(f"Exported {ckpt_path} to {output_path}")
+
+    # Check the exported graph against the checkpoint
+    imgs = torch.randn(2, 3, 512, 512)
+    with torch.no_grad():
+        expected = model(imgs)
+    actual = ExportedClassifier(output_path)(imgs)
+    for name, exp, act in zip(CATEGORY_NAMES, expected, actual):
+        print(f"{name}: max abs logit difference {(exp - act).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python classifier_export.py <CHECKPOINT_PATH> <OUTPUT_PATH (.pt or .onnx)>")
+        sys.exit(1)
+    CKPT_PATH = sys.argv[1]
+    OUTPUT_PATH = sys.argv[2]
+    main(CKPT_PATH, OUTPUT_PATH)
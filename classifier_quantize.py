@@ -0,0 +1,56 @@
+import sys
+from src.datamodule import HouseDataModule
+from src.quantize import TimedModel, export_quantized, quantize_classifier, weighted_f1
+from classifier_evaluate import evaluate_model, load_model
+
+
+def print_comparison_report(fp32_f1, int8_f1, fp32_ms, int8_ms):
+    print(f"\n{'Category':<12}{'fp32 F1':>10}{'int8 F1':>10}{'drop':>10}")
+    for category in fp32_f1:
+        drop = fp32_f1[category] - int8_f1[category]
+        print(f"{category:<12}{fp32_f1[category]:>10.4f}{int8_f1[category]:>10.4f}{drop:>10.4f}")
+    print(f"\nLatency per crop: fp32 {fp32_ms:.1f} ms, int8 {int8_ms:.1f} ms ({fp32_ms / int8_ms:.2f}x)")
+
+
+def main(ckpt_path, img_dir, data_dir, output_path, num_calibration_batches=32, max_f1_drop=0.02):
+    dm = HouseDataModule(
+        img_dir=img_dir,
+        data_dir=data_dir,
+        batch_size=16,
+        num_workers=1,
+    )
+    dm.setup(stage="fit")
+
+    model = load_model(ckpt_path)
+    model.to("cpu")
+    model.eval()
+
+    # Calibrate on the validation split, compare on the test split as classifier_evaluate does
+    quantized = quantize_classifier(model, dm.val_dataloader(), num_batches=num_calibration_batches)
+
+    timed_fp32 = TimedModel(model)
+    fp32_f1 = weighted_f1(evaluate_model(timed_fp32, dm.test_dataloader, "cpu"))
+    timed_int8 = TimedModel(quantized)
+    int8_f1 = weighted_f1(evaluate_model(timed_int8, dm.test_dataloader, "cpu"))
+    print_comparison_report(fp32_f1, int8_f1, timed_fp32.ms_per_crop, timed_int8.ms_per_crop)
+
+    worst_drop = max(fp32_f1[category] - int8_f1[category] for category in fp32_f1)
+    if worst_drop > max_f1_drop:
+        print(f"\nWeighted F1 drops by {worst_drop:.4f}, more than {max_f1_drop}. Not saving {output_path}.")
+        sys.exit(1)
+
+    export_quantized(quantized, output_path)
+    print(f"\nSaved int8 classifier to {output_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print("Usage: python classifier_quantize.py <CHECKPOINT_PATH> <IMG_DIR> <DATA_DIR> <OUTPUT_PATH> "
+              "[MAX_F1_DROP]")
+        sys.exit(1)
+    CKPT_PATH = sys.argv[1]
+    IMG_DIR = sys.argv[2]
+    DATA_DIR = sys.argv[3] # where the partitioned csvs are
+    OUTPUT_PATH = sys.argv[4] # .pt file, usable as CLASS_CPKT_PATH in detect_clip_classify
+    MAX_F1_DROP = float(sys.argv[5]) if len(sys.argv) > 5 else 0.02
+    main(CKPT_PATH, IMG_DIR, DATA_DIR, OUTPUT_PATH, max_f1_drop=MAX_F1_DROP)
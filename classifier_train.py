@@ -6,28 +6,37 @@ from lightning.pytorch.callbacks import LearningRateMonitor, ModelCheckpoint
 from src.datamodule import HouseDataModule
 from src.model import HPClassifier
 from src.callbacks import BackboneFreezeUnfreeze
+from src.feature_cache import FeatureStore
 
 L.seed_everything(42, workers=True)
 
+UNFREEZE_AT_EPOCH = 10
 
-def main(name, img_dir, data_dir):
+
+def main(name, img_dir, data_dir, feature_cache_dir=None, pack_dir=None):
     logger = AimLogger(
         experiment=name,
         train_metric_prefix="train_",
         val_metric_prefix="val_",
     )
+    # model
+    model = HPClassifier(lr=1e-3)
+
     # datamodule
+    # With a feature cache, the epochs run with a frozen backbone train the heads on
+    # cached backbone features of the unaugmented crops instead of decoding images
+    feature_store = FeatureStore(feature_cache_dir, model.backbone) if feature_cache_dir else None
     dm = HouseDataModule(
         img_dir=img_dir,
         data_dir=data_dir,
         batch_size=32, # 128,
         num_workers=8,
+        feature_store=feature_store,
+        cached_epochs=UNFREEZE_AT_EPOCH,
+        pack_dir=pack_dir,
     )
     dm.setup()
 
-    # model
-    model = HPClassifier(lr=1e-3)
-
     # Callbacks
     lr_cb = LearningRateMonitor(
         logging_interval="step",
@@ -42,7 +51,7 @@ def main(name, img_dir, data_dir):
         filename="epoch:{epoch}-step:{step}-loss:{val_loss:.3f}-f1:{val_totalf1:.3f}",
         auto_insert_metric_name=False,
     )
-    backbone_freeze_unfreeze_cb = BackboneFreezeUnfreeze(unfreeze_at_epoch=10)
+    backbone_freeze_unfreeze_cb = BackboneFreezeUnfreeze(unfreeze_at_epoch=UNFREEZE_AT_EPOCH)
 
     # trainer
     trainer = L.Trainer(
@@ -52,14 +61,19 @@ def main(name, img_dir, data_dir):
         precision="bf16-mixed",
         logger=logger,
         callbacks=[lr_cb, ckpt_cb, backbone_freeze_unfreeze_cb],
+        # Switch from cached features back to crops when the backbone is unfrozen
+        reload_dataloaders_every_n_epochs=UNFREEZE_AT_EPOCH if feature_store else 0,
     )
 
     # fit
-    trainer.fit(
-        model,
-        train_dataloaders=dm.train_dataloader(),
-        val_dataloaders=dm.val_dataloader(),
-    )
+    if feature_store:
+        trainer.fit(model, datamodule=dm)
+    else:
+        trainer.fit(
+            model,
+            train_dataloaders=dm.train_dataloader(),
+            val_dataloaders=dm.val_dataloader(),
+        )
 
     # test
     trainer.test(
@@ -70,10 +84,12 @@ def main(name, img_dir, data_dir):
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python classifier_train.py <EXPERIMENT_NAME> <IMG_DIR> <DATA_DIR>")
+        print("Usage: python classifier_train.py <EXPERIMENT_NAME> <IMG_DIR> <DATA_DIR> [FEATURE_CACHE_DIR] [PACK_DIR]")
         sys.exit(1)
     EXPERIMENT_NAME = sys.argv[1]
     IMG_DIR = sys.argv[2]
     DATA_DIR = sys.argv[3] # where the partitioned csvs are
-    main(EXPERIMENT_NAME, IMG_DIR, DATA_DIR)
+    FEATURE_CACHE_DIR = (sys.argv[4] or None) if len(sys.argv) > 4 else None # "" to only use a pack
+    PACK_DIR = sys.argv[5] if len(sys.argv) > 5 else None # written by pack_crops.py
+    main(EXPERIMENT_NAME, IMG_DIR, DATA_DIR, FEATURE_CACHE_DIR, PACK_DIR)
 
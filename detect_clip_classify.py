@@ -1,18 +1,18 @@
-import ast
+import argparse
 import os
 import sys
-import glob
 import cv2
-import re
-import numpy as np
-import pandas as pd
 import torch
-from torchvision.transforms import Compose, Resize, ToTensor, Normalize, ToPILImage
 from detectron2 import model_zoo
 from detectron2.config import get_cfg
-from detectron2.engine.defaults import DefaultPredictor
-from src.datamodule import HouseDataModule
-from src.model import HPClassifier
+from src.constants import CATEGORY_NAMES
+from src.detector_export import ExportedDetector
+from src.export import ExportedClassifier
+from src.instrumentation import PipelineStats
+from src.pipeline import ImageDecoder, ImageWriter, list_images, read_image_list
+from src.predictor import BatchPredictor
+from src.preprocess import buffered_box, crop_and_resize
+from src.shards import ShardedResults, compact, in_shard, output_paths, run_dir_name
 
 
 def load_configuration(config_file):
@@ -43,182 +43,326 @@ def clip_image_around_bbox_buffer(image, bbox, buffer=100):
     Returns:
         ndarray: Clipped image.
     """
-    x1, y1, x2, y2 = bbox
-    x1 -= buffer
-    y1 -= buffer
-    x2 += buffer
-    y2 += buffer
-    x1_ = max(0, int(x1))
-    y1_ = max(0, int(y1))
-    x2_ = min(int(x2), image.shape[1])
-    y2_ = min(int(y2), image.shape[0])
+    x1_, y1_, x2_, y2_ = buffered_box(bbox, image.shape, buffer)
     clipped_image = image[y1_:y2_, x1_:x2_]
     return clipped_image
 
-def extract_float(tensor_string):
-    # Convert tensors to float
-    float_value = re.findall(r'-?\d+\.\d+', tensor_string)
-    return float(float_value[0])
+def batched(iterable, batch_size):
+    """
+    Groups items of an iterable into lists of at most `batch_size` items.
+
+    Args:
+        iterable (iterable): Items to group.
+        batch_size (int): Maximum number of items per list.
+
+    Yields:
+        list: Consecutive items of the iterable.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_detector(detector_cpkt_path, batch_size=8, num_threads=None):
+    """
+    Loads the building detector.
+
+    Exported `.pt` (TorchScript) and `.onnx` files written by `detector_export.py`
+    are run with `ExportedDetector`, which skips building the model zoo
+    configuration and model; anything else is loaded as a detectron2 checkpoint.
+
+    Args:
+        detector_cpkt_path (str): Path to the detector checkpoint or exported file.
+        batch_size (int): Number of images passed to the detector per forward pass.
+        num_threads (int): Optional number of intra-op threads for ONNX Runtime.
+
+    Returns:
+        BatchPredictor or ExportedDetector: Predictor with a `predict_batch` method.
+    """
+    if os.path.splitext(detector_cpkt_path)[1] in (".pt", ".onnx"):
+        return ExportedDetector(detector_cpkt_path, num_threads=num_threads)
+
+    # Load configuration from file
+    cfg = load_configuration(model_zoo.get_config_file("COCO-Detection/retinanet_R_50_FPN_3x.yaml"))
 
-def load_classification_model(checkpoint_path):
+    # Set up Detectron2 model for inference
+    cfg.MODEL.WEIGHTS = os.path.join(detector_cpkt_path)
+    cfg.MODEL.RETINANET.SCORE_THRESH_TEST = 0.5
+    return BatchPredictor(cfg, batch_size=batch_size)
+
+def load_classification_model(checkpoint_path, num_threads=None):
     """
     Loads a classification model from a checkpoint.
 
+    Exported `.pt` (TorchScript) and `.onnx` files are run with the lean
+    `ExportedClassifier` runtime; anything else is loaded as a Lightning
+    checkpoint.
+
     Args:
         checkpoint_path (str): Path to the checkpoint file.
+        num_threads (int): Optional number of intra-op threads for ONNX Runtime.
 
     Returns:
-        HPClassifier: Loaded classification model.
+        HPClassifier or ExportedClassifier: Loaded classification model.
     """
     try:
+        if os.path.splitext(checkpoint_path)[1] in (".pt", ".onnx"):
+            return ExportedClassifier(checkpoint_path, num_threads=num_threads)
+        # Only pull in the Lightning training stack when it is needed
+        from src.model import HPClassifier
+
         model = HPClassifier.load_from_checkpoint(checkpoint_path)
         return model
     except Exception as e:
         print(f"Failed to load model from {checkpoint_path}: {e}")
         sys.exit(1)
 
-def evaluate_classification_model(model, img, device):
+def predict_crops(model, imgs, device):
     """
-    Evaluates a classification model on an image.
+    Runs a classification model on a batch of images in a single forward pass.
 
     Args:
         model (HPClassifier): Classification model.
-        img (Tensor): Input image tensor.
+        imgs (Tensor): Batch of input image tensors of shape (N, C, H, W).
         device (str): Device for model evaluation.
 
     Returns:
-        dict: Predicted classes for different categories.
-    """
-    categories = {
-        "complete": {"preds": [], "labels": [], "names": ["complete", "incomplete"]},
-        "condition": {"preds": [], "labels": [], "names": ["poor", "fair", "good"]},
-        "material": {
-            "preds": [],
-            "labels": [],
-            "names": [
-                "mix-other-unclear", "plaster", "brick_or_cement-concrete_block",
-                "wood_polished", "stone_with_mud-ashlar_with_lime_or_cement",
-                "corrugated_metal", "wood_crude-plank", "container-trailer",
-            ],
-        },
-        "security": {"preds": [], "labels": [], "names": ["secured", "unsecured"]},
-        "use": {
-            "preds": [],
-            "labels": [],
-            "names": ["residential", "critical_infrastructure", "mixed", "commercial"],
-        },
-    }
-
+        tuple: Predicted class indices (int8) and their softmax probabilities (float32),
+        both ndarrays of shape (N, 5) with one column per category of `CATEGORY_NAMES`.
+    """
     with torch.no_grad():
-        logits = model(img.to(device))
-        preds = [torch.argmax(logit, dim=1).cpu().numpy() for logit in logits]
-        for key, pred in zip(categories.keys(), preds):
-            categories[key]["preds"].extend(pred)
+        logits = model(imgs.to(device))
+        probs, preds = zip(*[torch.softmax(logit.float(), dim=1).max(dim=1) for logit in logits])
+    codes = torch.stack(preds, dim=1).to(torch.int8).cpu().numpy()
+    probs = torch.stack(probs, dim=1).cpu().numpy()
+    return codes, probs
+
+
+class CropAccumulator:
+    """
+    Collects clipped buildings across images and classifies them in fixed-size batches.
 
-    predicted_classes = {}
-    for category, data in categories.items():
-        predicted_index = data['preds'][0]
-        predicted_class = data['names'][predicted_index]
-        predicted_classes[category] = predicted_class
-    return predicted_classes
+    Each crop is stored with its prediction row. Once `batch_size` crops are
+    pending, a single classifier forward pass is run and the predicted class
+    index and probability of the five heads are written back into the
+    matching rows, as `<category>` and `<category>_prob`.
 
+    Args:
+        model (HPClassifier): Classification model.
+        batch_size (int): Number of crops per classifier forward pass.
+        stats (PipelineStats): Optional recorder of the classification time of each image.
+    """
 
-def main(images_dir, detector_cpkt_path, classification_ckpt_path, output_dir):
+    def __init__(self, model, batch_size=32, stats=None):
+        self.model = model
+        self.batch_size = max(1, int(batch_size))
+        self.stats = stats
+        self.rows = []
+        self.crops = []
+
+    def add(self, row, crop):
+        """
+        Queues a crop for classification.
+
+        Args:
+            row (dict): Prediction row the classes are written to.
+            crop (Tensor): Preprocessed image tensor of shape (C, H, W).
+
+        Returns:
+            list: Completed prediction rows, empty until a batch is full.
+        """
+        self.rows.append(row)
+        self.crops.append(crop)
+        if len(self.crops) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Classifies all pending crops.
+
+        Returns:
+            list: Completed prediction rows.
+        """
+        if not self.crops:
+            return []
+        if self.stats is None:
+            codes, probs = predict_crops(self.model, torch.stack(self.crops), self.model.device)
+        else:
+            with self.stats.timed("classify", [row["image_name"] for row in self.rows]):
+                codes, probs = predict_crops(self.model, torch.stack(self.crops), self.model.device)
+        rows = self.rows
+        for row, row_codes, row_probs in zip(rows, codes, probs):
+            for category, code, prob in zip(CATEGORY_NAMES, row_codes, row_probs):
+                row[category] = int(code)
+                row[f"{category}_prob"] = float(prob)
+        self.rows = []
+        self.crops = []
+        return rows
+
+
+def main(images_dir, detector_cpkt_path, classification_ckpt_path, output_dir, batch_size=8,
+         classify_batch_size=32, num_decoders=4, prefetch=32, num_writers=2, crop_method="interpolate",
+         resume=False, shard_index=0, num_shards=1, image_list=None, num_threads=None,
+         export_csv=False, report_every=500):
     """
     Main function for object detection and classification.
 
     Args:
         images_dir (str): Directory containing dataset images.
-        detector_cpkt_path (str): Path to the detector checkpoint file.
-        classification_ckpt_path (str): Path to the classification model checkpoint file.
+        detector_cpkt_path (str): Path to the detector checkpoint file, or a detector
+            exported with `detector_export.py`.
+        classification_ckpt_path (str): Path to the classification model checkpoint file, or a
+            classifier exported with `classifier_export.py`.
         output_dir (str): Directory to save output files.
+        batch_size (int): Number of images passed to the detector per forward pass.
+        classify_batch_size (int): Number of clipped buildings passed to the classifier per forward pass.
+        num_decoders (int): Number of threads reading and decoding images ahead of the detector.
+        prefetch (int): Maximum number of images decoded ahead of the detector.
+        num_writers (int): Number of threads writing clipped images.
+        crop_method (str): Tensor crop and resize method, "interpolate" or "roi_align".
+        resume (bool): Continue a previous run in `output_dir`, skipping the images it completed.
+        shard_index (int): Index of the image shard processed by this process.
+        num_shards (int): Total number of image shards. With more than one shard the
+            results are left in the shard run directory for `src.shards.merge_shards` to combine.
+        image_list (str): Optional work-queue file listing the images to process instead of
+            walking `images_dir`.
+        num_threads (int): Optional number of intra-op threads used by torch.
+        export_csv (bool): Also write the predictions as CSV in the original layout.
+        report_every (int): Number of images between two printed throughput and stage timing
+            summaries, each covering the images since the previous one. The per-image
+            timings are appended to `trace.jsonl` in the run directory as images finish.
     """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard index {shard_index} for {num_shards} shards")
+    if num_threads:
+        torch.set_num_threads(num_threads)
 
-    # Load configuration from file
-    cfg = load_configuration(model_zoo.get_config_file("COCO-Detection/retinanet_R_50_FPN_3x.yaml"))
-
-    # Set up Detectron2 model for inference
-    cfg.MODEL.WEIGHTS = os.path.join(detector_cpkt_path)
-    cfg.MODEL.RETINANET.SCORE_THRESH_TEST = 0.5
-    predictor = DefaultPredictor(cfg)
+    predictor = load_detector(detector_cpkt_path, batch_size=batch_size, num_threads=num_threads)
 
 
-    classification_model = load_classification_model(classification_ckpt_path)
+    classification_model = load_classification_model(classification_ckpt_path, num_threads=num_threads)
     classification_model.to(classification_model.device)  
+    classification_model.eval()
+    run_dir = run_dir_name(output_dir, shard_index, num_shards)
+    trace_path = os.path.join(run_dir, "trace.jsonl")
+    stats = PipelineStats(report_every=report_every, trace_path=trace_path)
+    accumulator = CropAccumulator(classification_model, batch_size=classify_batch_size, stats=stats)
 
     image_clipped_output = os.path.join(output_dir, "inference_images_clipped_buffered/")
     os.makedirs(image_clipped_output, exist_ok=True)
-
-    cumulative_predictions = []
-    
-    cntr = 0
-    
-    for t in glob.glob(f"{images_dir}/**/**/*.jpg"): 
-        tf = "/".join(t.split("/")[-3:])
-        
-        im = cv2.imread(os.path.join(images_dir, tf))
-        outputs = predictor(im)
-        bb_preds = outputs["instances"].pred_boxes
-        bb_scores = outputs["instances"].scores
-        box_num = 0
-        if bb_preds:
-            for bb, sc in zip(bb_preds, bb_scores):
-                bbox_data = bb.tolist() 
-                try:
-                    clipped_img = clip_image_around_bbox_buffer(im, bbox_data)
-                    if len(clipped_img) > 0:
-                        img = torch.tensor(clipped_img.transpose(2,0,1)).to(torch.float32)
-                        img = ToPILImage()(img)
-                        transform = Compose([
-                            Resize((512,512), antialias=True),
-                            ToTensor(),
-                            Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-                        ])
-                        img = transform(img)
-                        img = img.unsqueeze(0)
-
-                        image_clipped_output_dirs = tf.split('/')
-                        os.makedirs(os.path.join(image_clipped_output, image_clipped_output_dirs[0]), exist_ok=True)
-                        os.makedirs(os.path.join(image_clipped_output, image_clipped_output_dirs[0], image_clipped_output_dirs[1]), exist_ok=True)
-                        
-                        if os.path.exists(os.path.join(image_clipped_output, tf)):
-                            box_num=box_num+1
-                            categories = evaluate_classification_model(classification_model, img, classification_model.device)
-                            image_boxes_categories = {"image_name": tf, "boxes": bbox_data, "box_scores": sc, "complete": categories["complete"], "condition": categories["condition"], "material": categories["material"], "security": categories["security"], "use": categories["use"], "image_name_clip": f"{tf[:-4]}_{box_num}.jpg"}
-                            print(image_boxes_categories)
-                            cumulative_predictions.append(image_boxes_categories)
-                            cv2.imwrite(os.path.join(image_clipped_output, f"{tf[:-4]}_{box_num}.jpg"), clipped_img)
-                        else:
-                            categories = evaluate_classification_model(classification_model, img, classification_model.device)
-                            image_boxes_categories = {"image_name": tf, "boxes": bbox_data, "box_scores": sc, "complete": categories["complete"], "condition": categories["condition"], "material": categories["material"], "security": categories["security"], "use": categories["use"], "image_name_clip": f"{tf}"}
-                            print(image_boxes_categories)
-                            cumulative_predictions.append(image_boxes_categories)
-                            cv2.imwrite(os.path.join(image_clipped_output, f"{tf}"), clipped_img)
-                        cntr = cntr+1
-                        print("Prediction count: ", cntr)
-                except Exception as e:
-                    print(f"Exception: {e}")
-                    pass
-                
-    df_out = pd.DataFrame(cumulative_predictions)
-    # Convert tensor scores to float
-    #df_out['box_scores'] = df_out['box_scores'].apply(extract_float)
-
-    # Convert tensor boxes to float
-    #df_out['boxes_float'] = df_out['boxes'].apply(ast.literal_eval)
-
-    # Convert float boxes to int
-    #df_out['boxes_int'] = df_out['boxes_float'].apply(lambda x: [int(elem) for elem in x])
-
-    df_out.to_csv(os.path.join(output_dir, f"detection_classification_predictions.csv"))
+    writer = ImageWriter(image_clipped_output, num_workers=num_writers, stats=stats)
+
+    # Results are streamed to shards so that a crashed run can be resumed
+    results = ShardedResults(run_dir, resume=resume, stats=stats)
+    if results.completed:
+        print(f"Resuming run, skipping {len(results.completed)} completed images")
+
+    all_image_names = read_image_list(image_list) if image_list else list_images(images_dir)
+    image_names = (tf for tf in all_image_names
+                   if in_shard(tf, shard_index, num_shards) and tf not in results.completed)
+    decoder = ImageDecoder(images_dir, image_names, num_workers=num_decoders, prefetch=prefetch, stats=stats)
+    for batch_decoded in batched(decoder, batch_size):
+        batch_images = []
+        for tf, im in batch_decoded:
+            if im is None:
+                print(f"Could not read image {tf}. Skipping...")
+                stats.finish(tf)
+                continue
+            batch_images.append((tf, im))
+        stats.sample_queue("decode", decoder.depth)
+        stats.sample_queue("write", writer.depth)
+        stats.sample_queue("classify", len(accumulator.crops))
+        with stats.timed("detect", [tf for tf, _ in batch_images]):
+            batch_outputs = predictor.predict_batch([im for _, im in batch_images])
+
+        for (tf, im), outputs in zip(batch_images, batch_outputs):
+            bb_preds = outputs["instances"].pred_boxes
+            bb_scores = outputs["instances"].scores
+            stats.set_boxes(tf, len(bb_preds))
+            if not bb_preds:
+                results.start_image(tf, 0)
+                continue
+            try:
+                with stats.timed("clip", [tf]):
+                    kept = []
+                    for bb, sc in zip(bb_preds, bb_scores):
+                        bbox_data = bb.tolist()
+                        x1, y1, x2, y2 = buffered_box(bbox_data, im.shape)
+                        if x2 > x1 and y2 > y1:
+                            kept.append((bbox_data, sc, (x1, y1, x2, y2)))
+                with stats.timed("preprocess", [tf]):
+                    crops = crop_and_resize(im, [crop_box for _, _, crop_box in kept], method=crop_method)
+            except Exception as e:
+                print(f"Exception: {e}")
+                results.fail_image(tf)
+                continue
+
+            # First crop keeps the image name, the following ones get a suffix
+            clip_names = [f"{tf[:-4]}_{box_num}.jpg" if box_num > 0 else f"{tf}" for box_num in range(len(kept))]
+            futures = [writer.write(image_name_clip, im[y1:y2, x1:x2], source_name=tf)
+                       for image_name_clip, (_, _, (x1, y1, x2, y2)) in zip(clip_names, kept)]
+            results.start_image(tf, len(kept), futures)
+
+            for image_name_clip, (bbox_data, sc, _), img in zip(clip_names, kept, crops):
+                x1, y1, x2, y2 = bbox_data
+                image_boxes_categories = {"image_name": tf, "image_name_clip": image_name_clip,
+                                          "x1": x1, "y1": y1, "x2": x2, "y2": y2, "score": float(sc)}
+                rows = accumulator.add(image_boxes_categories, img)
+                results.add_rows(rows)
+                stats.add_predictions(len(rows))
+        stats.maybe_report()
+
+    rows = accumulator.flush()
+    results.add_rows(rows)
+    stats.add_predictions(len(rows))
+    writer.close()
+    results.close()
+    stats.report()
+    stats.close()
+    print(f"Wrote per-image stage timings to {trace_path}")
+
+    if num_shards > 1:
+        print(f"Shard {shard_index} of {num_shards} done, results in {results.run_dir}")
+        return
+
+    parquet_path, csv_path = output_paths(output_dir, export_csv)
+    n_rows = compact(results.run_dir, parquet_path, csv_path)
+    print(f"Saved {n_rows} predictions to {parquet_path}")
 
     
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python detect_clip_classify.py <IMG_DIR> <DET_CPKT_PATH> <CLASS_CPKT_PATH> <OUTPUT_DIR>")
-        sys.exit(1)
-    IMG_DIR = sys.argv[1]
-    DET_CPKT_PATH = sys.argv[2]
-    CLASS_CPKT_PATH =  sys.argv[3]
-    OUTPUT_DIR = sys.argv[4]
-    main(IMG_DIR, DET_CPKT_PATH, CLASS_CPKT_PATH, OUTPUT_DIR)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Detect, clip and classify buildings in street view images.")
+    parser.add_argument("images_dir", metavar="IMG_DIR", help="Directory containing dataset images.")
+    parser.add_argument("detector_cpkt_path", metavar="DET_CPKT_PATH", help="Detector checkpoint, or exported .pt/.onnx file.")
+    parser.add_argument("classification_ckpt_path", metavar="CLASS_CPKT_PATH", help="Classifier checkpoint, or exported .pt/.onnx file.")
+    parser.add_argument("output_dir", metavar="OUTPUT_DIR", help="Directory to save output files.")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images per detector forward pass.")
+    parser.add_argument("--classify-batch-size", type=int, default=32,
+                        help="Clipped buildings per classifier forward pass.")
+    parser.add_argument("--num-decoders", type=int, default=4, help="Threads reading and decoding images.")
+    parser.add_argument("--prefetch", type=int, default=32, help="Images decoded ahead of the detector.")
+    parser.add_argument("--num-writers", type=int, default=2, help="Threads writing clipped images.")
+    parser.add_argument("--crop-method", choices=["interpolate", "roi_align"], default="interpolate",
+                        help="Tensor crop and resize method for the classifier input.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue a previous run in OUTPUT_DIR, skipping the images it completed.")
+    parser.add_argument("--shard-index", type=int, default=0, help="Index of the image shard to process.")
+    parser.add_argument("--num-shards", type=int, default=1, help="Total number of image shards.")
+    parser.add_argument("--image-list", help="Work-queue file listing images relative to IMG_DIR, one per line.")
+    parser.add_argument("--num-threads", type=int, default=None, help="Intra-op threads used by torch.")
+    parser.add_argument("--export-csv", action="store_true",
+                        help="Also write detection_classification_predictions.csv in the original layout.")
+    parser.add_argument("--report-every", type=int, default=500,
+                        help="Images between two printed throughput and stage timing summaries.")
+    args = parser.parse_args()
+    main(args.images_dir, args.detector_cpkt_path, args.classification_ckpt_path, args.output_dir,
+         batch_size=args.batch_size, classify_batch_size=args.classify_batch_size,
+         num_decoders=args.num_decoders, prefetch=args.prefetch, num_writers=args.num_writers,
+         crop_method=args.crop_method, resume=args.resume, shard_index=args.shard_index,
+         num_shards=args.num_shards, image_list=args.image_list, num_threads=args.num_threads,
+         export_csv=args.export_csv, report_every=args.report_every)
@@ -0,0 +1,104 @@
+import argparse
+import os
+import subprocess
+import sys
+
+from src.shards import merge_shards
+
+
+def split_cpus(num_workers):
+    """
+    Splits the CPUs available to this process into contiguous groups, one per worker.
+
+    Contiguous core ids keep a worker on one socket on the usual Linux numbering.
+
+    Args:
+        num_workers (int): Number of worker processes.
+
+    Returns:
+        list: Sorted CPU ids for each worker.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if num_workers > len(cpus):
+        raise ValueError(f"Cannot start {num_workers} workers on {len(cpus)} CPUs")
+    size, extra = divmod(len(cpus), num_workers)
+    groups = []
+    start = 0
+    for worker in range(num_workers):
+        end = start + size + (1 if worker < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+def launch(images_dir, detector_cpkt_path, classification_ckpt_path, output_dir, num_workers,
+           node_index=0, num_nodes=1, extra_args=()):
+    """
+    Runs one `detect_clip_classify` process per image shard on this node and merges their outputs.
+
+    Each worker is pinned to its own group of CPUs and uses that many torch
+    threads. Shards are numbered globally over all nodes, so running the
+    launcher with the same `num_workers` and `num_nodes` on every node covers
+    the whole image set. With several nodes, merging is left to a final
+    `--merge-only` call once every node is done.
+
+    Args:
+        images_dir (str): Directory containing dataset images.
+        detector_cpkt_path (str): Path to the detector checkpoint file.
+        classification_ckpt_path (str): Path to the classification model checkpoint file.
+        output_dir (str): Directory to save output files, shared by all nodes.
+        num_workers (int): Number of worker processes on this node.
+        node_index (int): Index of this node.
+        num_nodes (int): Total number of nodes.
+        extra_args (list): Additional arguments passed to every worker.
+    """
+    num_shards = num_workers * num_nodes
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "detect_clip_classify.py")
+    os.makedirs(output_dir, exist_ok=True)
+
+    workers = []
+    for worker, cpus in enumerate(split_cpus(num_workers)):
+        shard_index = node_index * num_workers + worker
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cpus)), MKL_NUM_THREADS=str(len(cpus)))
+        cmd = [sys.executable, script, images_dir, detector_cpkt_path, classification_ckpt_path, output_dir,
+               "--shard-index", str(shard_index), "--num-shards", str(num_shards),
+               "--num-threads", str(len(cpus)), *extra_args]
+        log = open(os.path.join(output_dir, f"worker_{shard_index:03d}-of-{num_shards:03d}.log"), "a")
+        print(f"Starting shard {shard_index} of {num_shards} on CPUs {cpus[0]}-{cpus[-1]}")
+        process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                   preexec_fn=lambda cpus=cpus: os.sched_setaffinity(0, cpus))
+        workers.append((shard_index, process, log))
+
+    failed = []
+    for shard_index, process, log in workers:
+        if process.wait() != 0:
+            failed.append(shard_index)
+        log.close()
+    if failed:
+        print(f"Shards {failed} failed, see their logs. Re-run with --resume to continue them.")
+        sys.exit(1)
+
+    if num_nodes == 1:
+        merge_shards(output_dir, num_shards, export_csv="--export-csv" in extra_args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run detect_clip_classify on several processes and nodes. "
+                    "Unknown options (e.g. --batch-size, --resume) are passed to every worker.")
+    parser.add_argument("images_dir", metavar="IMG_DIR", help="Directory containing dataset images.")
+    parser.add_argument("detector_cpkt_path", metavar="DET_CPKT_PATH", help="Detector checkpoint file.")
+    parser.add_argument("classification_ckpt_path", metavar="CLASS_CPKT_PATH", help="Classifier checkpoint file.")
+    parser.add_argument("output_dir", metavar="OUTPUT_DIR", help="Directory to save output files.")
+    parser.add_argument("--num-workers", type=int, default=4, help="Worker processes on this node.")
+    parser.add_argument("--node-index", type=int, default=0, help="Index of this node.")
+    parser.add_argument("--num-nodes", type=int, default=1, help="Total number of nodes.")
+    parser.add_argument("--merge-only", action="store_true",
+                        help="Only merge the shard results of all nodes into the predictions Parquet file, "
+                             "and the CSV with --export-csv.")
+    args, extra_args = parser.parse_known_args()
+    if args.merge_only:
+        merge_shards(args.output_dir, args.num_workers * args.num_nodes, export_csv="--export-csv" in extra_args)
+    else:
+        launch(args.images_dir, args.detector_cpkt_path, args.classification_ckpt_path, args.output_dir,
+               args.num_workers, node_index=args.node_index, num_nodes=args.num_nodes, extra_args=extra_args)
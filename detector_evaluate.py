@@ -10,6 +10,7 @@ from detectron2.config import get_cfg
 from detectron2.data import MetadataCatalog, DatasetCatalog
 from detectron2.data.datasets import register_coco_instances
 from detectron2.engine import DefaultPredictor
+from src.detector_export import ExportedDetector
 from pprint import pprint
 
 def load_configuration(config_file):
@@ -84,7 +85,8 @@ def main(annotations_dir, images_dir, cpkt_path):
     Args:
         annotations_dir (str): Path to the directory containing dataset annotations.
         images_dir (str): Path to the directory containing dataset images.
-        cpkt_path (str): Path to the trained model checkpoint.
+        cpkt_path (str): Path to the trained model checkpoint, or a detector exported
+            with `detector_export.py`.
     """
     # Register the partitioned COCO datasets for building detection
     register_coco_instances("hp_train", {}, os.path.join(annotations_dir, "instances_default_train.json"), images_dir)
@@ -94,13 +96,17 @@ def main(annotations_dir, images_dir, cpkt_path):
     # Load test dataset annotations
     test_annotations = load_test_annotations(annotations_dir)
 
-    # Load configuration from file
-    cfg = load_configuration(model_zoo.get_config_file("COCO-Detection/retinanet_R_50_FPN_3x.yaml"))
-
-    # Set up Detectron2 model for inference
-    cfg.MODEL.WEIGHTS = cpkt_path
-    cfg.MODEL.RETINANET.SCORE_THRESH_TEST = 0.5
-    predictor = DefaultPredictor(cfg)
+    if os.path.splitext(cpkt_path)[1] in (".pt", ".onnx"):
+        # Exported detectors skip building the model zoo configuration and model
+        predictor = ExportedDetector(cpkt_path)
+    else:
+        # Load configuration from file
+        cfg = load_configuration(model_zoo.get_config_file("COCO-Detection/retinanet_R_50_FPN_3x.yaml"))
+
+        # Set up Detectron2 model for inference
+        cfg.MODEL.WEIGHTS = cpkt_path
+        cfg.MODEL.RETINANET.SCORE_THRESH_TEST = 0.5
+        predictor = DefaultPredictor(cfg)
 
     # Use the test dataset
     dataset_name = "hp_test"
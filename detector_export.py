@@ -0,0 +1,60 @@
+import os
+import sys
+import cv2
+from detectron2 import model_zoo
+from detectron2.config import get_cfg
+from src.predictor import BatchPredictor
+from src.detector_export import ExportedDetector, export_detector_onnx, export_detector_torchscript
+
+
+def load_configuration(config_file):
+    """
+    Load configuration from a YAML file.
+
+    Args:
+        config_file (str): Path to the configuration file.
+
+    Returns:
+        CfgNode: Configuration options.
+    """
+    cfg = get_cfg()
+    cfg.merge_from_file(config_file)
+    return cfg
+
+
+def main(cpkt_path, output_path, sample_image_path):
+    cfg = load_configuration(model_zoo.get_config_file("COCO-Detection/retinanet_R_50_FPN_3x.yaml"))
+    cfg.MODEL.WEIGHTS = cpkt_path
+    cfg.MODEL.RETINANET.SCORE_THRESH_TEST = 0.5
+    cfg.MODEL.DEVICE = "cpu"
+    predictor = BatchPredictor(cfg, batch_size=1)
+
+    im = cv2.imread(sample_image_path)
+    if im is None:
+        print(f"Could not read image {sample_image_path}")
+        sys.exit(1)
+
+    if os.path.splitext(output_path)[1] == ".onnx":
+        export_detector_onnx(predictor, im, output_path)
+    else:
+        export_detector_torchscript(predictor, im, output_path)
+    print(f"Exported {cpkt_path} to {output_path}")
+
+    # Check the exported graph against the checkpoint
+    expected = predictor(im)["instances"]
+    actual = ExportedDetector(output_path)(im)["instances"]
+    print(f"detections: checkpoint {len(expected)}, exported {len(actual)}")
+    if len(expected) == len(actual) and len(expected):
+        box_diff = (expected.pred_boxes.tensor - actual.pred_boxes.tensor).abs().max().item()
+        score_diff = (expected.scores - actual.scores).abs().max().item()
+        print(f"max abs box difference {box_diff:.2e}, max abs score difference {score_diff:.2e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python detector_export.py <CPKT_PATH> <OUTPUT_PATH (.pt or .onnx)> <SAMPLE_IMAGE>")
+        sys.exit(1)
+    CPKT_PATH = sys.argv[1]
+    OUTPUT_PATH = sys.argv[2]
+    SAMPLE_IMAGE = sys.argv[3] # street view image used for tracing and the comparison
+    main(CPKT_PATH, OUTPUT_PATH, SAMPLE_IMAGE)
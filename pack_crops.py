@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from src.crop_pack import pack_crops
+
+SPLITS = ("train", "valid", "test")
+
+
+def main(img_dir, data_dir, pack_dir, max_side=512):
+    # One pack holds the crops of every split, each dataset selects its own by file name
+    df = pd.concat([pd.read_csv(Path(data_dir) / f"{split}.csv") for split in SPLITS])
+    df = df.drop_duplicates("file_name")
+    pack_crops(df, img_dir, pack_dir, max_side=max_side)
+    print(f"Packed {len(df)} crops with a max side of {max_side} to {pack_dir}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python pack_crops.py <IMG_DIR> <DATA_DIR> <PACK_DIR> [MAX_SIDE]")
+        sys.exit(1)
+    IMG_DIR = sys.argv[1]
+    DATA_DIR = sys.argv[2] # where the partitioned csvs are
+    PACK_DIR = sys.argv[3]
+    MAX_SIDE = int(sys.argv[4]) if len(sys.argv) > 4 else 512
+    main(IMG_DIR, DATA_DIR, PACK_DIR, MAX_SIDE)
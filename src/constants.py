@@ -0,0 +1,20 @@
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# Class names of each building property, in the order of the classifier outputs
+CATEGORY_NAMES = {
+    "complete": ["complete", "incomplete"],
+    "condition": ["poor", "fair", "good"],
+    "material": [
+        "mix-other-unclear",
+        "plaster",
+        "brick_or_cement-concrete_block",
+        "wood_polished",
+        "stone_with_mud-ashlar_with_lime_or_cement",
+        "corrugated_metal",
+        "wood_crude-plank",
+        "container-trailer",
+    ],
+    "security": ["secured", "unsecured"],
+    "use": ["residential", "critical_infrastructure", "mixed", "commercial"],
+}
@@ -0,0 +1,183 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torchvision.io import ImageReadMode, read_image
+from torchvision.transforms.v2 import functional as F
+
+from src.constants import CATEGORY_NAMES
+
+# Label columns of the pack, in the order returned by `HouseDataset`
+PROPERTIES = list(CATEGORY_NAMES)
+
+IMAGES_FILE = "images.u8"
+INDEX_FILE = "index.npy"
+LABELS_FILE = "labels.npy"
+META_FILE = "meta.json"
+
+
+def resize_max_side(img, max_side):
+    "Downsizes a CHW image so that its longest side is at most `max_side`, keeping its aspect ratio"
+    _, height, width = img.shape
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return img
+    size = [max(1, round(height * scale)), max(1, round(width * scale))]
+    return F.resize(img, size, antialias=True)
+
+
+def encode_labels(df):
+    """
+    Encodes the string labels of the crops as class indices.
+
+    Args:
+        df (DataFrame): Crops with one column per building property.
+
+    Returns:
+        ndarray: int8 array of shape (N, len(PROPERTIES)).
+    """
+    labels = np.empty((len(df), len(PROPERTIES)), dtype=np.int8)
+    for col, prop in enumerate(PROPERTIES):
+        codes = df[prop].map({name: i for i, name in enumerate(CATEGORY_NAMES[prop])})
+        if codes.isna().any():
+            unknown = sorted(set(df[prop][codes.isna()].astype(str)))
+            raise ValueError(f"Unknown {prop} labels: {unknown}")
+        labels[:, col] = codes.to_numpy()
+    return labels
+
+
+class _DecodeDataset(Dataset):
+    def __init__(self, file_names, img_dir, max_side):
+        self.file_names = file_names
+        self.img_dir = Path(img_dir)
+        self.max_side = max_side
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __getitem__(self, idx):
+        img = read_image(str(self.img_dir / self.file_names[idx]), mode=ImageReadMode.RGB)
+        return resize_max_side(img, self.max_side)
+
+
+def pack_crops(df, img_dir, pack_dir, max_side=512, num_workers=8):
+    """
+    Decodes every crop once and writes them to a single uint8 file that `CropPack` memory-maps.
+
+    The pack directory holds the CHW pixels of all crops back to back
+    (`images.u8`), an int64 index of (offset, height, width) per crop, an
+    int8 matrix of the labels in `PROPERTIES` order and the file names. It is
+    written next to `pack_dir` and swapped in whole, replacing any previous
+    pack.
+
+    Args:
+        df (DataFrame): Crops and labels. File names must be unique.
+        img_dir (str or Path): Directory of the crops.
+        pack_dir (str or Path): Output directory.
+        max_side (int): Longest side of the stored crops. Larger crops are downsized.
+        num_workers (int): DataLoader workers decoding the crops.
+    """
+    pack_dir = Path(pack_dir)
+    file_names = list(df.file_name)
+    if len(set(file_names)) != len(file_names):
+        raise ValueError("File names of the packed crops must be unique")
+    labels = encode_labels(df)
+
+    # Write a whole new directory then swap it in, so a pack shared between
+    # experiments is never read half written or with the index of another pack
+    tmp_dir = pack_dir.with_name(f"{pack_dir.name}.{os.getpid()}.tmp")
+    old_dir = pack_dir.with_name(f"{pack_dir.name}.{os.getpid()}.old")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    index = np.empty((len(file_names), 3), dtype=np.int64)
+    loader = DataLoader(_DecodeDataset(file_names, img_dir, max_side), batch_size=None,
+                        num_workers=num_workers)
+    offset = 0
+    with open(tmp_dir / IMAGES_FILE, "wb") as f:
+        for idx, img in enumerate(loader):
+            _, height, width = img.shape
+            index[idx] = offset, height, width
+            f.write(img.contiguous().numpy().tobytes())
+            offset += img.numel()
+
+    np.save(tmp_dir / INDEX_FILE, index)
+    np.save(tmp_dir / LABELS_FILE, labels)
+    with open(tmp_dir / META_FILE, "w") as f:
+        json.dump({"max_side": max_side, "properties": PROPERTIES, "file_names": file_names,
+                   "n_bytes": offset}, f)
+    if pack_dir.exists():
+        os.replace(pack_dir, old_dir)
+    os.replace(tmp_dir, pack_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class CropPack:
+    """
+    Read access to the crops written by `pack_crops`.
+
+    The pixel file is memory-mapped copy-on-write, so crops are served as
+    tensors viewing the page cache, which concurrent experiments share. It
+    is mapped on first access in every process, so DataLoader workers each
+    map it rather than receive a copy.
+
+    Args:
+        pack_dir (str or Path): Directory written by `pack_crops`.
+    """
+
+    def __init__(self, pack_dir):
+        self.dir = Path(pack_dir)
+        self.index = np.load(self.dir / INDEX_FILE)
+        self.labels = np.load(self.dir / LABELS_FILE)
+        with open(self.dir / META_FILE) as f:
+            meta = json.load(f)
+        if meta["properties"] != PROPERTIES:
+            raise ValueError(f"Pack labels {meta['properties']} do not match {PROPERTIES}")
+        self.max_side = meta["max_side"]
+        self.n_bytes = meta["n_bytes"]
+        self.file_names = meta["file_names"]
+        self._positions = {file_name: i for i, file_name in enumerate(self.file_names)}
+        self._images = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @property
+    def images(self):
+        if self._images is None:
+            images = np.memmap(self.dir / IMAGES_FILE, dtype=np.uint8, mode="c")
+            # Mapped lazily, so the pack may have been rewritten since its index was loaded
+            if len(images) != self.n_bytes:
+                raise RuntimeError(f"The pack at {self.dir} was rewritten while in use, reload it")
+            self._images = images
+        return self._images
+
+    def positions(self, file_names):
+        """
+        Looks up crops by file name.
+
+        Args:
+            file_names (iterable of str): File names, e.g. the `file_name` column of a split.
+
+        Returns:
+            ndarray: Position of each crop in the pack.
+        """
+        try:
+            return np.array([self._positions[file_name] for file_name in file_names], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError(f"Crop {e} is not in the pack at {self.dir}") from None
+
+    def image(self, position):
+        "Returns the uint8 CHW tensor of a crop without copying it"
+        offset, height, width = self.index[position]
+        pixels = self.images[offset:offset + 3 * height * width]
+        return torch.from_numpy(pixels.reshape(3, height, width))
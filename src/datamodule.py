@@ -1,6 +1,7 @@
 from pathlib import Path
 
 from einops import rearrange
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import torch
@@ -9,6 +10,10 @@ from torchvision.io import read_image
 from torchvision.transforms import v2
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
 
+from src.constants import CATEGORY_NAMES, IMAGENET_MEAN, IMAGENET_STD
+from src.crop_pack import CropPack
+from src.feature_cache import content_hash
+
 
 class HouseDataset(Dataset):
     def __init__(self, df, img_dir, transform=None):
@@ -16,25 +21,11 @@ class HouseDataset(Dataset):
         self.img_dir = img_dir
         self.transform = transform
 
-        self.complete = {"complete": 0, "incomplete": 1}
-        self.condition = {"poor": 0, "fair": 1, "good": 2}
-        self.material = {
-            "mix-other-unclear": 0,
-            "plaster": 1,
-            "brick_or_cement-concrete_block": 2,
-            "wood_polished": 3,
-            "stone_with_mud-ashlar_with_lime_or_cement": 4,
-            "corrugated_metal": 5,
-            "wood_crude-plank": 6,
-            "container-trailer": 7,
-        }
-        self.security = {"secured": 0, "unsecured": 1}
-        self.use = {
-            "residential": 0,
-            "critical_infrastructure": 1,
-            "mixed": 2,
-            "commercial": 3,
-        }
+        self.complete = {name: i for i, name in enumerate(CATEGORY_NAMES["complete"])}
+        self.condition = {name: i for i, name in enumerate(CATEGORY_NAMES["condition"])}
+        self.material = {name: i for i, name in enumerate(CATEGORY_NAMES["material"])}
+        self.security = {name: i for i, name in enumerate(CATEGORY_NAMES["security"])}
+        self.use = {name: i for i, name in enumerate(CATEGORY_NAMES["use"])}
         self.weights = self.df["weights"]
 
     def __getattr__(self, name):
@@ -108,12 +99,107 @@ def resize_and_pad(target_width, target_height):
     return transform
 
 
+def eval_transform(size=512):
+    "Resize and normalize a uint8 image tensor for validation, test and inference"
+    return v2.Compose(
+        [
+            # resize_and_pad(224, 224),
+            #v2.Resize((224, 224), antialias=True),
+            v2.Resize((size, size), antialias=True),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+        ]
+    )
+
+
+class CachedFeatureDataset(HouseDataset):
+    """
+    Serves pooled backbone features from a `FeatureStore` instead of decoding crops.
+
+    Features missing from the store are computed once from the crops resized
+    with `eval_transform`, then all features are held in memory. Crops are not
+    augmented, so this is meant for evaluation and for the epochs trained
+    while the backbone is frozen.
+
+    Args:
+        df (DataFrame): Crops and labels, as read from the partitioned csvs.
+        img_dir (Path): Directory of the crops.
+        feature_store (FeatureStore): Store of the backbone features.
+        num_workers (int): DataLoader workers decoding the crops missing from the store.
+    """
+
+    def __init__(self, df, img_dir, feature_store, num_workers=4):
+        super().__init__(df, img_dir, eval_transform(512))
+        keys = [content_hash(img_dir / file_name) for file_name in df.file_name]
+        feature_store.fill(keys, HouseDataset(df, img_dir, self.transform), num_workers=num_workers)
+        self.features = torch.from_numpy(np.stack([feature_store.get(key) for key in keys]))
+
+    def __getitem__(self, idx):
+        row = self.df.iloc[idx]
+        features = self.features[idx][:, None, None]
+        return (
+            features,
+            self.complete[row.complete],
+            self.condition[row.condition],
+            self.material[row.material],
+            self.security[row.security],
+            self.use[row.use],
+        )
+
+
+class PackedHouseDataset(HouseDataset):
+    """
+    Serves crops and labels from a `CropPack` instead of decoding JPEGs and mapping string labels.
+
+    Crops are returned as uint8 tensors viewing the memory-mapped pack and
+    go through `transform` like the crops of `HouseDataset`. They were
+    downsized to the `max_side` of the pack when it was written.
+
+    Args:
+        df (DataFrame): Crops of the split, as read from the partitioned csvs.
+        pack (CropPack): Pack holding every crop of `df`.
+        transform (callable): Transform applied to the uint8 CHW crops.
+    """
+
+    def __init__(self, df, pack, transform=None):
+        super().__init__(df, pack.dir, transform)
+        self.pack = pack
+        self.positions = pack.positions(df.file_name)
+
+    def __getitem__(self, idx):
+        position = self.positions[idx]
+        img = self.pack.image(position)
+        if self.transform:
+            img = self.transform(img)
+        return (img, *(int(label) for label in self.pack.labels[position]))
+
+
 class HouseDataModule(L.LightningDataModule):
-    def __init__(self, img_dir, data_dir, batch_size, num_workers):
+    """
+    Args:
+        img_dir (str): Directory of the crops.
+        data_dir (str): Directory of the partitioned csvs.
+        batch_size (int): Number of crops per batch.
+        num_workers (int): DataLoader workers.
+        feature_store (FeatureStore): Optional store of backbone features. When given, the
+            dataloaders serve cached features outside of training and during the first
+            `cached_epochs` epochs of training, while the backbone is frozen.
+        cached_epochs (int): Number of training epochs served from `feature_store`. Train with
+            `reload_dataloaders_every_n_epochs=cached_epochs` to switch back to crops.
+        pack_dir (str): Optional directory written by `pack_crops.py`. When given, crops are
+            served from the memory-mapped pack instead of being decoded from `img_dir`.
+    """
+
+    def __init__(self, img_dir, data_dir, batch_size, num_workers, feature_store=None, cached_epochs=0,
+                 pack_dir=None):
+        super().__init__()
         self.img_dir = Path(img_dir)
+        self.pack = CropPack(pack_dir) if pack_dir else None
         self.data_dir = Path(data_dir)
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.feature_store = feature_store
+        self.cached_epochs = cached_epochs
         self.trn_tfm = v2.Compose(
             [
                 # resize_and_pad(224, 224),
@@ -126,45 +212,72 @@ class HouseDataModule(L.LightningDataModule):
                 ),
                 v2.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2),
                 v2.ToDtype(torch.float32, scale=True),
-                v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            ]
-        )
-        self.val_tfm = self.tst_tfm = v2.Compose(
-            [
-                # resize_and_pad(224, 224),
-                #v2.Resize((224, 224), antialias=True),
-                v2.Resize((512, 512), antialias=True),
-                v2.ToDtype(torch.float32, scale=True),
-                v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+                v2.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
             ]
         )
+        self.val_tfm = self.tst_tfm = eval_transform(512)
 
     def setup(self, stage=None):
+        # The Trainer calls setup again after an explicit call; building the
+        # datasets twice would hash every crop again for the feature cache
+        if stage in ("fit", None) and hasattr(self, "trn_ds"):
+            return
+        if stage == "test" and hasattr(self, "tst_ds"):
+            return
         if stage == "fit" or stage is None:
             trn_df = pd.read_csv(self.data_dir / f"train.csv")
             val_df = pd.read_csv(self.data_dir / f"valid.csv")
 
-            self.trn_ds = HouseDataset(trn_df, self.img_dir, self.trn_tfm)
+            self.trn_ds = self._dataset(trn_df, self.trn_tfm)
             self.trn_sampler = WeightedRandomSampler(
                 weights=self.trn_ds.weights,
                 num_samples=len(self.trn_ds),
                 replacement=True,
             )
 
-            self.val_ds = HouseDataset(val_df, self.img_dir, self.val_tfm)
+            self.val_ds = self._dataset(val_df, self.val_tfm)
             
             tst_df = pd.read_csv(self.data_dir / f"test.csv")
-            self.tst_ds = HouseDataset(tst_df, self.img_dir, self.tst_tfm)
-            
+            self.tst_ds = self._dataset(tst_df, self.tst_tfm)
+
+            if self.feature_store is not None:
+                self.cached_trn_ds = self._cached(trn_df)
+                self.cached_val_ds = self._cached(val_df)
+                self.cached_tst_ds = self._cached(tst_df)
         
         elif stage == "test" or stage is None:
             tst_df = pd.read_csv(self.data_dir / f"test.csv")
-            self.tst_ds = HouseDataset(tst_df, self.img_dir, self.tst_tfm)
+            self.tst_ds = self._dataset(tst_df, self.tst_tfm)
             #self.tst_ds = (self.data_dir, train=False)
+            if self.feature_store is not None:
+                self.cached_tst_ds = self._cached(tst_df)
         else:
             raise ValueError(f"Invalid stage: {stage}")
 
+    def _dataset(self, df, transform):
+        if self.pack is not None:
+            return PackedHouseDataset(df, self.pack, transform)
+        return HouseDataset(df, self.img_dir, transform)
+
+    def _cached(self, df):
+        return CachedFeatureDataset(df, self.img_dir, self.feature_store, num_workers=self.num_workers)
+
+    def use_cached_features(self):
+        "Whether the dataloaders serve cached features rather than crops"
+        if self.feature_store is None:
+            return False
+        # Outside of a Trainer, e.g. in classifier_evaluate, the backbone is not trained
+        return self.trainer is None or self.trainer.current_epoch < self.cached_epochs
+
     def train_dataloader(self):
+        if self.use_cached_features():
+            return DataLoader(
+                self.cached_trn_ds,
+                sampler=self.trn_sampler,
+                shuffle=False,
+                batch_size=self.batch_size,
+                pin_memory=True,
+            )
         return DataLoader(
             self.trn_ds,
             sampler=self.trn_sampler,
@@ -176,7 +289,7 @@ class HouseDataModule(L.LightningDataModule):
 
     def val_dataloader(self):
         return DataLoader(
-            self.val_ds,
+            self.cached_val_ds if self.use_cached_features() else self.val_ds,
             shuffle=False,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
@@ -185,7 +298,7 @@ class HouseDataModule(L.LightningDataModule):
 
     def test_dataloader(self):
         return DataLoader(
-            self.tst_ds,
+            self.cached_tst_ds if self.use_cached_features() else self.tst_ds,
             shuffle=False,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+import torch
+import detectron2.data.transforms as T
+from detectron2.structures import Boxes, Instances
+
+# Order in which detectron2's TracingAdapter flattens the RetinaNet `Instances`
+OUTPUT_NAMES = ["pred_boxes", "pred_classes", "scores", "image_size"]
+
+
+def metadata_path(model_path):
+    "Path of the json file holding the preprocessing settings of an exported detector"
+    return os.path.splitext(model_path)[0] + ".json"
+
+
+def _tracing_adapter(predictor, original_image):
+    """
+    Wraps a loaded detector into a module taking one CHW image tensor.
+
+    Args:
+        predictor (BatchPredictor): Detector built from the training configuration.
+        original_image (ndarray): Sample image of shape (H, W, C) in BGR order.
+
+    Returns:
+        tuple: The `TracingAdapter` and the sample input tensor.
+    """
+    from detectron2.export import TracingAdapter
+
+    image = predictor._prepare(original_image)["image"]
+    adapter = TracingAdapter(predictor.model, [{"image": image}])
+    with torch.no_grad():
+        assert len(adapter(image)) == len(OUTPUT_NAMES), adapter.outputs_schema
+    return adapter, image
+
+
+def _write_metadata(predictor, output_path):
+    metadata = {
+        "input_format": predictor.input_format,
+        "min_size_test": predictor.cfg.INPUT.MIN_SIZE_TEST,
+        "max_size_test": predictor.cfg.INPUT.MAX_SIZE_TEST,
+        "output_names": OUTPUT_NAMES,
+    }
+    with open(metadata_path(output_path), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def export_detector_torchscript(predictor, original_image, output_path):
+    """
+    Traces and saves the detector as TorchScript, with its preprocessing settings next to it.
+
+    The score threshold of the configuration is baked into the graph.
+
+    Args:
+        predictor (BatchPredictor): Detector built from the training configuration.
+        original_image (ndarray): Sample image of shape (H, W, C) in BGR order used for tracing.
+        output_path (str): Path of the `.pt` file to write.
+    """
+    adapter, image = _tracing_adapter(predictor, original_image)
+    with torch.no_grad():
+        traced = torch.jit.trace(adapter, (image,))
+    torch.jit.save(traced, output_path)
+    _write_metadata(predictor, output_path)
+
+
+def export_detector_onnx(predictor, original_image, output_path, opset_version=16):
+    """
+    Exports the detector as an ONNX graph, with its preprocessing settings next to it.
+
+    Args:
+        predictor (BatchPredictor): Detector built from the training configuration.
+        original_image (ndarray): Sample image of shape (H, W, C) in BGR order used for tracing.
+        output_path (str): Path of the `.onnx` file to write.
+        opset_version (int): ONNX opset used for the export.
+    """
+    adapter, image = _tracing_adapter(predictor, original_image)
+    dynamic_axes = {"image": {1: "height", 2: "width"}, "pred_boxes": {0: "detections"},
+                    "pred_classes": {0: "detections"}, "scores": {0: "detections"}}
+    with torch.no_grad():
+        torch.onnx.export(adapter, (image,), output_path, input_names=["image"], output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version)
+    _write_metadata(predictor, output_path)
+
+
+class ExportedDetector:
+    """
+    Runs an exported detector with the output contract of detectron2's ``DefaultPredictor``.
+
+    Calling it on a BGR image returns ``{"instances": Instances}`` with
+    ``pred_boxes``, ``scores`` and ``pred_classes`` in original image
+    coordinates, and ``predict_batch`` matches ``BatchPredictor``, so it can
+    replace either without building the model zoo configuration and model.
+    TorchScript files are run with torch, ONNX files with ONNX Runtime on CPU.
+
+    Args:
+        model_path (str): Path to a `.pt` TorchScript or `.onnx` file written by
+            `detector_export.py`, next to its `.json` metadata.
+        num_threads (int): Optional number of intra-op threads for ONNX Runtime.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        with open(metadata_path(model_path)) as f:
+            metadata = json.load(f)
+        self.input_format = metadata["input_format"]
+        self.output_names = metadata["output_names"]
+        self.aug = T.ResizeShortestEdge(
+            [metadata["min_size_test"], metadata["min_size_test"]], metadata["max_size_test"]
+        )
+        self.backend = "onnx" if os.path.splitext(model_path)[1] == ".onnx" else "torchscript"
+        if self.backend == "onnx":
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        else:
+            self.module = torch.jit.load(model_path, map_location="cpu")
+            self.module.eval()
+
+    def _run(self, image):
+        if self.backend == "onnx":
+            outputs = self.session.run(self.output_names, {"image": image.numpy()})
+            return dict(zip(self.output_names, (torch.from_numpy(output) for output in outputs)))
+        with torch.no_grad():
+            return dict(zip(self.output_names, self.module(image)))
+
+    def __call__(self, original_image):
+        """
+        Runs the detector on a single image, matching ``DefaultPredictor.__call__``.
+
+        Args:
+            original_image (ndarray): Image of shape (H, W, C) in BGR order.
+
+        Returns:
+            dict: Output dict holding the image ``instances``.
+        """
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(np.ascontiguousarray(image.astype("float32").transpose(2, 0, 1)))
+        outputs = self._run(image)
+
+        # Rescale to the original image as detector_postprocess does
+        boxes = Boxes(outputs["pred_boxes"])
+        boxes.scale(width / image.shape[2], height / image.shape[1])
+        boxes.clip((height, width))
+        instances = Instances((height, width), pred_boxes=boxes, scores=outputs["scores"],
+                              pred_classes=outputs["pred_classes"])
+        return {"instances": instances[boxes.nonempty()]}
+
+    def predict_batch(self, original_images):
+        """
+        Runs the detector on a list of images, one forward pass per image.
+
+        Args:
+            original_images (list of ndarray): Images of shape (H, W, C) in BGR order.
+
+        Returns:
+            list of dict: One output dict per input image, in input order.
+        """
+        return [self(original_image) for original_image in original_images]
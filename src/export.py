@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.constants import CATEGORY_NAMES
+
+HEAD_NAMES = [f"{category}_head" for category in CATEGORY_NAMES]
+
+
+class InferenceClassifier(nn.Module):
+    """
+    Inference-only copy of `HPClassifier.forward`.
+
+    Keeps the backbone and the five heads and drops the torchmetrics F1
+    objects, hyperparameters and optimizer hooks of the Lightning module, so
+    it can be traced into a standalone graph.
+
+    Args:
+        model (HPClassifier): Trained classification model.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.backbone = model.backbone
+        self.heads = nn.ModuleList([getattr(model, name) for name in HEAD_NAMES])
+
+    def forward(self, xb):
+        features = self.backbone.forward_features(xb)
+        return tuple(head(features) for head in self.heads)
+
+
+def export_torchscript(model, output_path, size=512):
+    """
+    Traces, freezes and saves the classifier as TorchScript.
+
+    Args:
+        model (HPClassifier): Trained classification model.
+        output_path (str): Path of the `.pt` file to write.
+        size (int): Side of the square classifier input.
+    """
+    module = InferenceClassifier(model).cpu().eval()
+    example = torch.zeros(1, 3, size, size)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    torch.jit.save(frozen, output_path)
+
+
+def export_onnx(model, output_path, size=512, opset_version=17):
+    """
+    Exports the classifier as an ONNX graph with a dynamic batch dimension.
+
+    Args:
+        model (HPClassifier): Trained classification model.
+        output_path (str): Path of the `.onnx` file to write.
+        size (int): Side of the square classifier input.
+        opset_version (int): ONNX opset used for the export.
+    """
+    module = InferenceClassifier(model).cpu().eval()
+    example = torch.zeros(1, 3, size, size)
+    output_names = [f"{category}_logits" for category in CATEGORY_NAMES]
+    dynamic_axes = {name: {0: "batch"} for name in ["image", *output_names]}
+    with torch.no_grad():
+        torch.onnx.export(module, example, output_path, input_names=["image"], output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version)
+
+
+class ExportedClassifier:
+    """
+    Runs an exported classifier with the calling convention of `HPClassifier`.
+
+    Calling it on a batch returns the five head logits, and it exposes the
+    `device`, `to` and `eval` members used by `detect_clip_classify`, so it can
+    replace a model loaded with `load_from_checkpoint`. TorchScript files are
+    run with torch, ONNX files with ONNX Runtime on CPU.
+
+    Args:
+        model_path (str): Path to a `.pt` TorchScript or `.onnx` file.
+        num_threads (int): Optional number of intra-op threads for ONNX Runtime.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.device = torch.device("cpu")
+        self.backend = "onnx" if os.path.splitext(model_path)[1] == ".onnx" else "torchscript"
+        if self.backend == "onnx":
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            self.module = torch.jit.load(model_path, map_location=self.device)
+
+    def __call__(self, imgs):
+        if self.backend == "onnx":
+            outputs = self.session.run(None, {self.input_name: np.ascontiguousarray(imgs.cpu().numpy())})
+            return tuple(torch.from_numpy(output) for output in outputs)
+        return self.module(imgs.to(self.device))
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
@@ -0,0 +1,129 @@
+import os
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def weights_hash(module):
+    """
+    Hashes the parameters and buffers of a module.
+
+    Args:
+        module (nn.Module): Module to hash, e.g. the classifier backbone.
+
+    Returns:
+        str: Hex digest that changes whenever any weight changes.
+    """
+    digest = hashlib.sha1()
+    for name, tensor in sorted(module.state_dict().items()):
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def content_hash(fpath):
+    """
+    Hashes the bytes of a crop image file, without decoding it.
+
+    Args:
+        fpath (str or Path): Image file.
+
+    Returns:
+        str: Hex digest of the file content.
+    """
+    with open(fpath, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class FeatureStore:
+    """
+    On-disk store of pooled backbone features.
+
+    Entries live under `<cache_dir>/<backbone weights hash>/` and are keyed by
+    the content hash of the crop, so a store is only reused while the
+    backbone weights are unchanged, e.g. while `BackboneFreezeUnfreeze` keeps
+    it frozen, and features are never served for a modified crop. Each entry
+    is the globally average-pooled `forward_features` output (768 values for
+    convnextv2_tiny) of the crop after `eval_transform`, which the
+    `NormMlpClassifierHead`s accept as a (768, 1, 1) input.
+
+    Args:
+        cache_dir (str): Root directory of the store.
+        backbone (nn.Module): Backbone used to compute missing features.
+    """
+
+    def __init__(self, cache_dir, backbone):
+        self.backbone = backbone
+        self.weights_hash = weights_hash(backbone)
+        self.dir = Path(cache_dir) / self.weights_hash
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.dir / key[:2] / f"{key}.npy"
+
+    def has(self, key):
+        return self._path(key).exists()
+
+    def get(self, key):
+        return np.load(self._path(key))
+
+    def put(self, key, features):
+        fpath = self._path(key)
+        fpath.parent.mkdir(exist_ok=True)
+        # Write then rename so concurrent readers never see a partial entry
+        tmp_fpath = fpath.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_fpath, "wb") as f:
+            np.save(f, features)
+        os.replace(tmp_fpath, fpath)
+
+    def compute(self, imgs):
+        """
+        Computes pooled features for a batch of preprocessed crops.
+
+        The backbone runs in eval mode, so drop path is disabled.
+
+        Args:
+            imgs (Tensor): Batch of shape (N, 3, H, W).
+
+        Returns:
+            ndarray: Features of shape (N, C) as float32.
+        """
+        was_training = self.backbone.training
+        self.backbone.eval()
+        device = next(self.backbone.parameters()).device
+        with torch.no_grad():
+            features = self.backbone.forward_features(imgs.to(device)).mean(dim=(2, 3))
+        self.backbone.train(was_training)
+        return features.float().cpu().numpy()
+
+    def fill(self, keys, dataset, batch_size=32, num_workers=4):
+        """
+        Computes and stores the features of every crop of a dataset missing from the store.
+
+        Args:
+            keys (list): Content hash of each dataset item.
+            dataset (Dataset): Dataset yielding preprocessed crops first, e.g. a `HouseDataset`
+                with `eval_transform`.
+            batch_size (int): Number of crops per backbone forward pass.
+            num_workers (int): DataLoader workers decoding the missing crops.
+
+        Returns:
+            int: Number of features computed.
+        """
+        missing = [idx for idx, key in enumerate(keys) if not self.has(key)]
+        if not missing:
+            return 0
+        loader = torch.utils.data.DataLoader(
+            torch.utils.data.Subset(dataset, missing),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            shuffle=False,
+        )
+        start = 0
+        for img, *_ in loader:
+            for idx, features in zip(missing[start:start + len(img)], self.compute(img)):
+                self.put(keys[idx], features)
+            start += len(img)
+        return len(missing)
@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+STAGES = ("decode", "detect", "clip", "preprocess", "classify", "write")
+PERCENTILES = (50, 95, 99)
+
+
+class PipelineStats:
+    """
+    Records the wall time spent on each image by every stage of the inference pipeline.
+
+    Stages running on batches (detect, classify) split the batch time evenly
+    across its images or crops. Stages running on worker threads (decode,
+    write) record their time from the worker, so all methods are thread-safe.
+    Queue depths are sampled by the consumer.
+
+    Only the records of images still in flight are kept. `finish` appends
+    the record of a done image to the JSONL trace file and to the current
+    window, and `maybe_report` prints a summary of the window every
+    `report_every` images before starting a new one, so memory and reporting
+    cost do not grow with the length of the run.
+
+    Args:
+        report_every (int): Number of detected images between two printed summaries.
+        trace_path (str): Optional JSONL file the per-image records are appended to. It is
+            opened on the first finished image.
+    """
+
+    def __init__(self, report_every=500, trace_path=None):
+        self.report_every = max(1, int(report_every))
+        self.trace_path = trace_path
+        self.trace = None
+        self.lock = threading.Lock()
+        self.images = defaultdict(lambda: dict.fromkeys(STAGES, 0.0))
+        self.boxes = {}
+        self.totals = dict.fromkeys(STAGES, 0.0)
+        self.n_images = 0
+        self.n_predictions = 0
+        self.start_time = time.perf_counter()
+        self._last_report = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.perf_counter()
+        self.window_images = self.n_images
+        self.window_times = []
+        self.window_boxes = []
+        # Running sum, count and max of each queue depth
+        self.queue_depths = defaultdict(lambda: [0, 0, 0])
+
+    def add(self, image_name, stage, seconds):
+        with self.lock:
+            self.images[image_name][stage] += seconds
+
+    @contextmanager
+    def timed(self, stage, image_names):
+        """
+        Times a block of work and splits its duration evenly across `image_names`.
+
+        Args:
+            stage (str): One of `STAGES`.
+            image_names (list): Image each unit of work belongs to, repeated for several crops
+                of the same image.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if image_names:
+                share = (time.perf_counter() - start) / len(image_names)
+                with self.lock:
+                    for image_name in image_names:
+                        self.images[image_name][stage] += share
+
+    def set_boxes(self, image_name, n_boxes):
+        with self.lock:
+            self.boxes[image_name] = n_boxes
+            self.n_images += 1
+
+    def add_predictions(self, n_predictions):
+        self.n_predictions += n_predictions
+
+    def sample_queue(self, name, depth):
+        with self.lock:
+            stats = self.queue_depths[name]
+            stats[0] += depth
+            stats[1] += 1
+            stats[2] = max(stats[2], depth)
+
+    def finish(self, image_name):
+        """
+        Moves the record of an image that went through every stage to the trace and the window.
+
+        Args:
+            image_name (str): Image path relative to the images directory.
+        """
+        with self.lock:
+            record = self.images.pop(image_name, None) or dict.fromkeys(STAGES, 0.0)
+            n_boxes = self.boxes.pop(image_name, None)
+            self.window_times.append([record[stage] for stage in STAGES])
+            if n_boxes is not None:
+                self.window_boxes.append(n_boxes)
+            for stage in STAGES:
+                self.totals[stage] += record[stage]
+            if self.trace_path is not None:
+                if self.trace is None:
+                    self.trace = open(self.trace_path, "a")
+                self.trace.write(json.dumps({"image_name": image_name, "boxes": n_boxes, **record}) + "\n")
+
+    def summary(self):
+        """
+        Summarizes the current window.
+
+        Returns:
+            dict: Images per second over the run and over the window, per-stage p50/p95/p99
+            in milliseconds per image and total seconds over the run, boxes per image and
+            queue depths over the window.
+        """
+        with self.lock:
+            times = np.array(self.window_times, dtype=np.float64).reshape(-1, len(STAGES))
+            boxes = np.array(self.window_boxes)
+            totals = dict(self.totals)
+            depths = {name: list(stats) for name, stats in self.queue_depths.items()}
+            window_images = self.n_images - self.window_images
+        now = time.perf_counter()
+        elapsed = now - self.start_time
+        window_elapsed = now - self.window_start
+        summary = {
+            "images": self.n_images,
+            "predictions": self.n_predictions,
+            "elapsed_s": elapsed,
+            "images_per_s": self.n_images / elapsed if elapsed else 0.0,
+            "window_images_per_s": window_images / window_elapsed if window_elapsed else 0.0,
+            "stage_ms": {},
+            "boxes_per_image": {},
+            "queue_depth": {},
+        }
+        if len(times):
+            for idx, stage in enumerate(STAGES):
+                values = np.percentile(times[:, idx] * 1000, PERCENTILES)
+                summary["stage_ms"][stage] = {f"p{p}": float(v) for p, v in zip(PERCENTILES, values)}
+                summary["stage_ms"][stage]["total_s"] = totals[stage]
+        if len(boxes):
+            summary["boxes_per_image"] = {"mean": float(boxes.mean()), "max": int(boxes.max())}
+        for name, (total, count, maximum) in depths.items():
+            if count:
+                summary["queue_depth"][name] = {"mean": total / count, "max": int(maximum)}
+        return summary
+
+    def report(self):
+        "Prints a one-block summary of the window, then starts a new window"
+        summary = self.summary()
+        with self.lock:
+            self._reset_window()
+        print(f"[{summary['images']} images, {summary['predictions']} predictions, "
+              f"{summary['images_per_s']:.2f} images/s, {summary['window_images_per_s']:.2f} images/s "
+              f"since the last report]")
+        for stage, stats in summary["stage_ms"].items():
+            percentiles = " ".join(f"p{p}={stats[f'p{p}']:.1f}" for p in PERCENTILES)
+            print(f"  {stage:<11}{percentiles} ms/image, {stats['total_s']:.1f} s total")
+        if summary["boxes_per_image"]:
+            print(f"  boxes/image mean={summary['boxes_per_image']['mean']:.2f} "
+                  f"max={summary['boxes_per_image']['max']}")
+        if summary["queue_depth"]:
+            depths = ", ".join(f"{name} mean={stats['mean']:.1f} max={stats['max']}"
+                               for name, stats in summary["queue_depth"].items())
+            print(f"  queue depth {depths}")
+
+    def maybe_report(self):
+        "Prints a summary once `report_every` more images were detected"
+        if self.n_images - self._last_report >= self.report_every:
+            self._last_report = self.n_images
+            self.report()
+
+    def close(self):
+        "Closes the trace file"
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
@@ -83,6 +83,9 @@ class HPClassifier(L.LightningModule):
             features, num_securities, drop_rate=0.5
         )
         self.use_head = NormMlpClassifierHead(features, num_uses, drop_rate=0.5)
+        # Whether inputs are pooled backbone features served by a FeatureStore
+        # rather than crops. Kept in sync with the datamodule during fit and test.
+        self.cached_features = False
 
         # self.complete_head = nn.Linear(features, num_completeness)
         # self.condition_head = nn.Linear(in_features, num_conditions)
@@ -117,9 +120,13 @@ class HPClassifier(L.LightningModule):
         # self.use_f1 = torchmetrics.F1Score(task="multiclass", num_classes=num_uses)
 
     def forward(self, xb):
-        features = self.backbone.forward_features(xb)
-        # features = torch.flatten(features, 1)
+        # Pooled features served by a FeatureStore skip the (frozen) backbone
+        if self.cached_features:
+            return self.forward_heads(xb)
+        return self.forward_heads(self.backbone.forward_features(xb))
 
+    def forward_heads(self, features):
+        # features = torch.flatten(features, 1)
         complete_logits = self.complete_head(features)
         condition_logits = self.condition_head(features)
         material_logits = self.material_head(features)
@@ -134,6 +141,19 @@ class HPClassifier(L.LightningModule):
             use_logits,
         )
 
+    def _sync_cached_features(self):
+        datamodule = getattr(self.trainer, "datamodule", None)
+        self.cached_features = datamodule is not None and datamodule.use_cached_features()
+
+    def on_train_epoch_start(self):
+        self._sync_cached_features()
+
+    def on_validation_epoch_start(self):
+        self._sync_cached_features()
+
+    def on_test_epoch_start(self):
+        self._sync_cached_features()
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
         # scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(
@@ -0,0 +1,182 @@
+import os
+import glob
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+
+def list_images(images_dir):
+    """
+    Lists images laid out as `<images_dir>/<sequence>/<side>/<image>.jpg`.
+
+    Args:
+        images_dir (str): Directory containing dataset images.
+
+    Yields:
+        str: Image path relative to `images_dir`.
+    """
+    for t in glob.iglob(f"{images_dir}/**/**/*.jpg"):
+        yield "/".join(t.split("/")[-3:])
+
+
+def read_image_list(fpath):
+    """
+    Reads a work-queue file listing one image path relative to the images directory per line.
+
+    Args:
+        fpath (str): Path to the image list.
+
+    Yields:
+        str: Image path relative to the images directory.
+    """
+    with open(fpath) as image_list:
+        for line in image_list:
+            if line.strip():
+                yield line.strip()
+
+
+class ImageDecoder:
+    """
+    Reads and decodes images on a pool of worker threads ahead of the consumer.
+
+    A feeder thread walks `image_names` and submits one decode task per image
+    to the pool. Pending tasks are kept in a bounded queue, so the feeder
+    blocks once `prefetch` images are decoded or in flight and resumes as the
+    consumer catches up. Images are yielded in the order of `image_names`.
+
+    Args:
+        images_dir (str): Directory containing dataset images.
+        image_names (iterable): Image paths relative to `images_dir`.
+        num_workers (int): Number of decoder threads.
+        prefetch (int): Maximum number of images decoded ahead of the consumer.
+        stats (PipelineStats): Optional recorder of the decode time of each image.
+    """
+
+    _done = object()
+
+    def __init__(self, images_dir, image_names, num_workers=4, prefetch=32, stats=None):
+        self.images_dir = images_dir
+        self.image_names = image_names
+        self.num_workers = max(1, int(num_workers))
+        self.prefetch = max(1, int(prefetch))
+        self.stats = stats
+        self.pending = None
+
+    @property
+    def depth(self):
+        "Number of images decoded or in flight ahead of the consumer"
+        return self.pending.qsize() if self.pending is not None else 0
+
+    def _decode(self, image_name):
+        start = time.perf_counter()
+        image = cv2.imread(os.path.join(self.images_dir, image_name))
+        if self.stats is not None:
+            self.stats.add(image_name, "decode", time.perf_counter() - start)
+        return image
+
+    def __iter__(self):
+        pending = self.pending = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def feed(executor):
+            try:
+                for image_name in self.image_names:
+                    if stop.is_set():
+                        break
+                    pending.put((image_name, executor.submit(self._decode, image_name)))
+            finally:
+                pending.put(self._done)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            feeder = threading.Thread(target=feed, args=(executor,), daemon=True)
+            feeder.start()
+            try:
+                while True:
+                    item = pending.get()
+                    if item is self._done:
+                        break
+                    image_name, future = item
+                    yield image_name, future.result()
+            finally:
+                stop.set()
+                # Drain the queue so a blocked feeder can observe `stop` and exit
+                while feeder.is_alive():
+                    try:
+                        pending.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                feeder.join()
+
+
+class ImageWriter:
+    """
+    Writes images to disk on a pool of worker threads.
+
+    At most `max_pending` writes are queued at any time; `write` blocks
+    beyond that so that crops do not pile up in memory when the disk is
+    slower than inference.
+
+    Args:
+        output_dir (str): Directory images are written to.
+        num_workers (int): Number of writer threads.
+        max_pending (int): Maximum number of queued writes.
+        stats (PipelineStats): Optional recorder of the write time of each image.
+    """
+
+    def __init__(self, output_dir, num_workers=2, max_pending=64, stats=None):
+        self.output_dir = output_dir
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(num_workers)))
+        self.slots = threading.BoundedSemaphore(max(1, int(max_pending)))
+        self.errors = []
+        self.stats = stats
+        self.depth = 0
+        self.depth_lock = threading.Lock()
+
+    def _write(self, image_name, image, source_name):
+        start = time.perf_counter()
+        try:
+            fpath = os.path.join(self.output_dir, image_name)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            if not cv2.imwrite(fpath, image):
+                raise IOError(f"cv2.imwrite failed for {fpath}")
+        except Exception as e:
+            self.errors.append((image_name, e))
+            raise
+        finally:
+            if self.stats is not None:
+                self.stats.add(source_name, "write", time.perf_counter() - start)
+            with self.depth_lock:
+                self.depth -= 1
+            self.slots.release()
+
+    def write(self, image_name, image, source_name=None):
+        """
+        Queues an image write.
+
+        Args:
+            image_name (str): Path relative to `output_dir`.
+            image (ndarray): Image to write.
+            source_name (str): Image the write time is recorded for, defaults to `image_name`.
+
+        Returns:
+            Future: Completes once the image is written, raises if the write failed.
+        """
+        self.slots.acquire()
+        with self.depth_lock:
+            self.depth += 1
+        return self.executor.submit(self._write, image_name, image, source_name or image_name)
+
+    def close(self):
+        """Waits for all queued writes and reports failed ones."""
+        self.executor.shutdown(wait=True)
+        for image_name, e in self.errors:
+            print(f"Failed to write {image_name}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
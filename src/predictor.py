@@ -0,0 +1,88 @@
+from collections import defaultdict
+
+import torch
+import detectron2.data.transforms as T
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.modeling import build_model
+
+
+class BatchPredictor:
+    """
+    Batched counterpart of detectron2's ``DefaultPredictor``.
+
+    Applies the same test-time resize and channel handling as
+    ``DefaultPredictor``, but calls the underlying ``build_model`` module on
+    lists of inputs. Images are grouped by shape before batching so that the
+    padded ``ImageList`` built by the model does not grow beyond the inputs.
+
+    Args:
+        cfg (CfgNode): Detectron2 configuration with ``MODEL.WEIGHTS`` set.
+        batch_size (int): Maximum number of images per forward pass.
+    """
+
+    def __init__(self, cfg, batch_size=8):
+        self.cfg = cfg.clone()
+        self.batch_size = max(1, int(batch_size))
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        DetectionCheckpointer(self.model).load(cfg.MODEL.WEIGHTS)
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+
+    def _prepare(self, original_image):
+        """
+        Builds the model input dict for one BGR image, as ``DefaultPredictor`` does.
+
+        Args:
+            original_image (ndarray): Image of shape (H, W, C) in BGR order.
+
+        Returns:
+            dict: Model input with ``image``, ``height`` and ``width`` keys.
+        """
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def predict_batch(self, original_images):
+        """
+        Runs the detector on a list of images.
+
+        Args:
+            original_images (list of ndarray): Images of shape (H, W, C) in BGR order.
+
+        Returns:
+            list of dict: One output dict per input image, in input order, each
+            holding the per-image ``instances`` exactly as ``DefaultPredictor`` returns.
+        """
+        groups = defaultdict(list)
+        for idx, image in enumerate(original_images):
+            groups[image.shape].append(idx)
+
+        outputs = [None] * len(original_images)
+        with torch.no_grad():
+            for indices in groups.values():
+                for start in range(0, len(indices), self.batch_size):
+                    chunk = indices[start:start + self.batch_size]
+                    inputs = [self._prepare(original_images[i]) for i in chunk]
+                    for i, prediction in zip(chunk, self.model(inputs)):
+                        outputs[i] = prediction
+        return outputs
+
+    def __call__(self, original_image):
+        """
+        Runs the detector on a single image, matching ``DefaultPredictor.__call__``.
+
+        Args:
+            original_image (ndarray): Image of shape (H, W, C) in BGR order.
+
+        Returns:
+            dict: Output dict holding the image ``instances``.
+        """
+        return self.predict_batch([original_image])[0]
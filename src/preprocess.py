@@ -0,0 +1,137 @@
+import sys
+
+import cv2
+import torch
+import torch.nn.functional as F
+from torchvision.ops import roi_align
+
+from src.constants import IMAGENET_MEAN, IMAGENET_STD
+
+
+def buffered_box(bbox, image_shape, buffer=100):
+    """
+    Expands a bounding box by a buffer and clips it to the image, as
+    `clip_image_around_bbox_buffer` does.
+
+    Args:
+        bbox (tuple): Bounding box coordinates (x1, y1, x2, y2).
+        image_shape (tuple): Shape of the image (H, W, ...).
+        buffer (int): Buffer size.
+
+    Returns:
+        tuple: Integer crop bounds (x1, y1, x2, y2), end-exclusive.
+    """
+    x1, y1, x2, y2 = bbox
+    x1_ = max(0, int(x1 - buffer))
+    y1_ = max(0, int(y1 - buffer))
+    x2_ = min(int(x2 + buffer), image_shape[1])
+    y2_ = min(int(y2 + buffer), image_shape[0])
+    return x1_, y1_, x2_, y2_
+
+
+def frame_to_tensor(image):
+    """
+    Converts a decoded BGR frame into an RGB uint8 tensor without copying pixels twice.
+
+    Args:
+        image (ndarray): Image of shape (H, W, 3) in BGR order, as read by `cv2.imread`.
+
+    Returns:
+        Tensor: Image tensor of shape (3, H, W) in RGB order.
+    """
+    return torch.from_numpy(image).permute(2, 0, 1).flip(0)
+
+
+def normalize(imgs):
+    """
+    Scales a float batch in [0, 255] to [0, 1] and applies ImageNet normalization.
+
+    Args:
+        imgs (Tensor): Batch of shape (N, 3, H, W).
+
+    Returns:
+        Tensor: Normalized batch.
+    """
+    mean = torch.tensor(IMAGENET_MEAN, dtype=imgs.dtype, device=imgs.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, dtype=imgs.dtype, device=imgs.device).view(1, 3, 1, 1)
+    return (imgs / 255.0 - mean) / std
+
+
+def crop_and_resize(image, boxes, size=512, method="interpolate"):
+    """
+    Crops boxes out of a frame, resizes them and normalizes them as a single batch.
+
+    Everything runs on tensors; the result matches `eval_transform(size)`
+    applied to each RGB crop, which is what the classifier is validated on.
+
+    Args:
+        image (ndarray): Image of shape (H, W, 3) in BGR order.
+        boxes (list): Integer crop bounds (x1, y1, x2, y2), e.g. from `buffered_box`.
+        size (int): Side of the square classifier input.
+        method (str): "interpolate" resizes each crop with antialiased bilinear
+            interpolation, exactly like `v2.Resize`. "roi_align" samples all crops
+            from the frame in one `roi_align` call, which is faster for many boxes
+            but averages a fixed grid instead of using an antialiasing kernel.
+
+    Returns:
+        Tensor: Batch of shape (N, 3, size, size).
+    """
+    frame = frame_to_tensor(image)
+    if not boxes:
+        return torch.empty((0, 3, size, size))
+
+    if method == "roi_align":
+        rois = torch.tensor([[0, *box] for box in boxes], dtype=torch.float32)
+        imgs = roi_align(frame.unsqueeze(0).float(), rois, output_size=(size, size),
+                         spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+    elif method == "interpolate":
+        imgs = torch.cat([
+            F.interpolate(frame[:, y1:y2, x1:x2].unsqueeze(0).float(), size=(size, size),
+                          mode="bilinear", align_corners=False, antialias=True)
+            for x1, y1, x2, y2 in boxes
+        ])
+        # `v2.Resize` rounds back to uint8 before scaling
+        imgs = imgs.round_().clamp_(0, 255)
+    else:
+        raise ValueError(f"Invalid method: {method}")
+
+    return normalize(imgs)
+
+
+def check_crop_and_resize(image, boxes, size=512, method="interpolate"):
+    """
+    Compares `crop_and_resize` against `eval_transform` applied crop by crop.
+
+    Args:
+        image (ndarray): Image of shape (H, W, 3) in BGR order.
+        boxes (list): Integer crop bounds (x1, y1, x2, y2).
+        size (int): Side of the square classifier input.
+        method (str): Method passed to `crop_and_resize`.
+
+    Returns:
+        float: Maximum absolute difference between both batches.
+    """
+    from src.datamodule import eval_transform
+
+    transform = eval_transform(size)
+    frame = frame_to_tensor(image)
+    expected = torch.stack([transform(frame[:, y1:y2, x1:x2].contiguous()) for x1, y1, x2, y2 in boxes])
+    actual = crop_and_resize(image, boxes, size=size, method=method)
+    return (expected - actual).abs().max().item()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m src.preprocess <IMAGE_PATH>")
+        sys.exit(1)
+    IMAGE_PATH = sys.argv[1]
+    image = cv2.imread(IMAGE_PATH)
+    height, width = image.shape[:2]
+    # Boxes smaller and larger than the classifier input
+    boxes = [
+        buffered_box((width * 0.4, height * 0.4, width * 0.5, height * 0.5), image.shape),
+        buffered_box((width * 0.1, height * 0.2, width * 0.9, height * 0.8), image.shape),
+        buffered_box((0, 0, width * 0.3, height), image.shape),
+    ]
+    for method in ("interpolate", "roi_align"):
+        print(f"{method}: max abs difference {check_crop_and_resize(image, boxes, method=method):.4f}")
@@ -0,0 +1,99 @@
+import time
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from sklearn.metrics import f1_score
+
+from src.export import InferenceClassifier
+
+
+def quantize_classifier(model, dataloader, num_batches=32, backend="x86", size=512):
+    """
+    Post-training static int8 quantization of the backbone and the five heads.
+
+    The inference copy of the model is traced with FX, observers are inserted
+    with the default qconfig of `backend`, activations are calibrated on up to
+    `num_batches` batches and the model is converted to int8 kernels. Ops
+    without an int8 kernel (LayerNorm, GELU) stay in float.
+
+    Args:
+        model (HPClassifier): Trained classification model.
+        dataloader (DataLoader): Calibration batches, e.g. `HouseDataModule.val_dataloader()`.
+        num_batches (int): Number of calibration batches.
+        backend (str): Quantization backend, "x86" or "qnnpack".
+        size (int): Side of the square classifier input.
+
+    Returns:
+        GraphModule: Quantized model returning the five head logits.
+    """
+    torch.backends.quantized.engine = backend
+    module = InferenceClassifier(model).cpu().eval()
+    example = (torch.zeros(1, 3, size, size),)
+    prepared = prepare_fx(module, get_default_qconfig_mapping(backend), example)
+
+    with torch.no_grad():
+        for idx, batch in enumerate(dataloader):
+            if idx >= num_batches:
+                break
+            img, *_ = batch
+            prepared(img.cpu())
+
+    return convert_fx(prepared)
+
+
+def export_quantized(quantized, output_path, size=512):
+    """
+    Saves a quantized model as TorchScript, loadable by `ExportedClassifier`.
+
+    Args:
+        quantized (GraphModule): Model returned by `quantize_classifier`.
+        output_path (str): Path of the `.pt` file to write.
+        size (int): Side of the square classifier input.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, torch.zeros(1, 3, size, size))
+        frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, output_path)
+
+
+class TimedModel:
+    """
+    Wraps a model to accumulate its forward time and the number of crops it saw.
+
+    Args:
+        model (callable): Model returning the five head logits.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.seconds = 0.0
+        self.n_crops = 0
+
+    def __call__(self, imgs):
+        start = time.perf_counter()
+        outputs = self.model(imgs)
+        self.seconds += time.perf_counter() - start
+        self.n_crops += len(imgs)
+        return outputs
+
+    @property
+    def ms_per_crop(self):
+        return 1000 * self.seconds / max(1, self.n_crops)
+
+
+def weighted_f1(categories):
+    """
+    Computes the weighted F1 score of each building property.
+
+    Args:
+        categories (dict): Predictions and labels per property, as returned by
+            `classifier_evaluate.evaluate_model`.
+
+    Returns:
+        dict: Weighted F1 score per property.
+    """
+    return {
+        category: f1_score(data["labels"], data["preds"], average="weighted", zero_division=0)
+        for category, data in categories.items()
+    }
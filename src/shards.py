@@ -0,0 +1,366 @@
+import os
+import glob
+import json
+import zlib
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.constants import CATEGORY_NAMES
+
+BOX_COLUMNS = ["x1", "y1", "x2", "y2", "score"]
+PROB_COLUMNS = [f"{category}_prob" for category in CATEGORY_NAMES]
+COLUMNS = ["image_name", "image_name_clip", *BOX_COLUMNS, *CATEGORY_NAMES, *PROB_COLUMNS]
+SCHEMA = pa.schema(
+    [(column, pa.string()) for column in ("image_name", "image_name_clip")]
+    + [(column, pa.float32()) for column in BOX_COLUMNS]
+    + [(category, pa.dictionary(pa.int8(), pa.string())) for category in CATEGORY_NAMES]
+    + [(column, pa.float32()) for column in PROB_COLUMNS]
+)
+
+
+class ShardedResults:
+    """
+    Streams prediction rows to append-only JSONL shards with a manifest of finished images.
+
+    Rows are appended to `shard-<n>.jsonl` files in `run_dir`, starting a new
+    shard every `rows_per_shard` rows and on every restart. An image is added
+    to `manifest.txt` only once all of its rows are flushed to a shard and its
+    crop writes are done, so the manifest never lists an image whose results
+    could be lost by a crash. A resumed run skips the images in the manifest.
+
+    Args:
+        run_dir (str): Directory holding the shards and the manifest.
+        resume (bool): Keep the results of a previous run in `run_dir` instead of starting over.
+        rows_per_shard (int): Number of rows after which a new shard is started.
+        stats (PipelineStats): Optional recorder told when each image is done.
+    """
+
+    manifest_name = "manifest.txt"
+    failures_name = "failures.txt"
+
+    def __init__(self, run_dir, resume=False, rows_per_shard=100000, stats=None):
+        self.run_dir = run_dir
+        self.stats = stats
+        self.rows_per_shard = max(1, int(rows_per_shard))
+        if not resume and os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        os.makedirs(run_dir, exist_ok=True)
+
+        self.manifest_path = os.path.join(run_dir, self.manifest_name)
+        self.completed = set()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest:
+                self.completed = {line.rstrip("\n") for line in manifest if line.endswith("\n")}
+        self.manifest = open(self.manifest_path, "a")
+        self.failures = open(os.path.join(run_dir, self.failures_name), "a")
+        self.n_failed = 0
+
+        self.shard_index = len(shard_paths(run_dir))
+        self.shard = None
+        self.shard_rows = 0
+        self.pending = {}
+
+    def _open_shard(self):
+        if self.shard is not None:
+            self._close_shard()
+        self.shard = open(os.path.join(self.run_dir, f"shard-{self.shard_index:05d}.jsonl"), "a")
+        self.shard_index += 1
+        self.shard_rows = 0
+
+    def _close_shard(self):
+        self.shard.flush()
+        os.fsync(self.shard.fileno())
+        self.shard.close()
+        self.shard = None
+
+    def _commit(self, image_name):
+        _, futures = self.pending.pop(image_name)
+        if self.shard is not None:
+            self.shard.flush()
+        if any(future.exception() is not None for future in futures):
+            self.fail_image(image_name)
+            return
+        self.manifest.write(f"{image_name}\n")
+        self.manifest.flush()
+        self.completed.add(image_name)
+        if self.stats is not None:
+            self.stats.finish(image_name)
+
+    def fail_image(self, image_name):
+        """
+        Gives up on an image, e.g. when preprocessing or a crop write failed.
+
+        The image is left out of the manifest, so its rows already in a shard
+        are dropped by `compact` and a resumed run processes it again. It is
+        listed in `failures.txt` so that `close` and `compact` report it.
+
+        Args:
+            image_name (str): Image path relative to the images directory.
+        """
+        self.pending.pop(image_name, None)
+        self.failures.write(f"{image_name}\n")
+        self.failures.flush()
+        self.n_failed += 1
+        if self.stats is not None:
+            self.stats.finish(image_name)
+
+    def start_image(self, image_name, n_rows, futures=()):
+        """
+        Registers an image and the number of rows it will produce.
+
+        Args:
+            image_name (str): Image path relative to the images directory.
+            n_rows (int): Number of prediction rows expected for the image.
+            futures (iterable): Crop writes that must succeed before the image is committed.
+        """
+        self.pending[image_name] = [n_rows, list(futures)]
+        if n_rows == 0:
+            self._commit(image_name)
+
+    def add_rows(self, rows):
+        """
+        Appends completed rows and commits the images that have all their rows.
+
+        Args:
+            rows (list): Prediction rows, each holding an `image_name` key.
+        """
+        finished = []
+        for row in rows:
+            if self.shard is None or self.shard_rows >= self.rows_per_shard:
+                self._open_shard()
+            self.shard.write(json.dumps(row) + "\n")
+            self.shard_rows += 1
+            self.pending[row["image_name"]][0] -= 1
+            if self.pending[row["image_name"]][0] == 0:
+                finished.append(row["image_name"])
+        for image_name in finished:
+            self._commit(image_name)
+
+    def close(self):
+        """Flushes the current shard and the manifest, and reports the failed images."""
+        if self.shard is not None:
+            self._close_shard()
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.manifest.close()
+        self.failures.close()
+        if self.n_failed:
+            print(f"{self.n_failed} images failed and were left out of the results, listed in "
+                  f"{os.path.join(self.run_dir, self.failures_name)}. Resume the run to retry them.")
+
+
+def run_dir_name(output_dir, shard_index=0, num_shards=1):
+    """
+    Returns the directory holding the shards of a run, one per inference shard.
+
+    Args:
+        output_dir (str): Directory to save output files.
+        shard_index (int): Index of the inference shard.
+        num_shards (int): Total number of inference shards.
+
+    Returns:
+        str: Run directory path.
+    """
+    if num_shards == 1:
+        return os.path.join(output_dir, "predictions_run")
+    return os.path.join(output_dir, f"predictions_run_{shard_index:03d}-of-{num_shards:03d}")
+
+
+def in_shard(image_name, shard_index, num_shards):
+    """
+    Deterministically assigns an image to one of `num_shards` inference shards.
+
+    The assignment only depends on the image path, so every process and node
+    agrees on it without coordination, whatever order images are listed in.
+
+    Args:
+        image_name (str): Image path relative to the images directory.
+        shard_index (int): Index of the inference shard.
+        num_shards (int): Total number of inference shards.
+
+    Returns:
+        bool: Whether the image belongs to the shard.
+    """
+    return zlib.crc32(image_name.encode("utf-8")) % num_shards == shard_index
+
+
+def shard_paths(run_dir):
+    """
+    Lists the shards of a run in write order.
+
+    Args:
+        run_dir (str): Directory holding the shards.
+
+    Returns:
+        list: Shard file paths.
+    """
+    return sorted(glob.glob(os.path.join(run_dir, "shard-*.jsonl")))
+
+
+def read_shard(shard_path):
+    """
+    Reads the complete rows of a shard, skipping a line torn by a crash.
+
+    Args:
+        shard_path (str): Path to a JSONL shard.
+
+    Yields:
+        dict: Prediction row.
+    """
+    with open(shard_path) as shard:
+        for line in shard:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def typed_frame(rows):
+    """
+    Builds a typed predictions table from shard rows.
+
+    Box coordinates, scores and probabilities are float32 and every building
+    property is a categorical column whose codes are the classifier outputs.
+
+    Args:
+        rows (list): Prediction rows.
+
+    Returns:
+        DataFrame: Predictions with the columns of `COLUMNS`.
+    """
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    df = df.astype({column: "float32" for column in BOX_COLUMNS + PROB_COLUMNS})
+    for category, names in CATEGORY_NAMES.items():
+        df[category] = pd.Categorical.from_codes(df[category].astype("int8"), categories=names)
+    return df
+
+
+def legacy_frame(df):
+    """
+    Converts a typed predictions table to the original CSV layout.
+
+    Args:
+        df (DataFrame): Predictions built by `typed_frame`.
+
+    Returns:
+        DataFrame: Predictions with `boxes` lists, `box_scores` and class names.
+    """
+    legacy = pd.DataFrame({
+        "image_name": df["image_name"],
+        "boxes": df[["x1", "y1", "x2", "y2"]].astype(float).values.tolist(),
+        "box_scores": df["score"].astype(float),
+    }, index=df.index)
+    for category in CATEGORY_NAMES:
+        legacy[category] = df[category].astype(str)
+    legacy["image_name_clip"] = df["image_name_clip"]
+    return legacy
+
+
+def compact(run_dir, parquet_path, csv_path=None):
+    """
+    Merges the shards of one or more runs into a single Parquet file.
+
+    Only rows of images listed in a run manifest are kept. Rows written for
+    an image before a crash and written again after a restart are
+    deduplicated on `image_name_clip`, keeping the latest one. Shards are
+    converted one at a time so the whole run never has to fit in memory.
+    The rows dropped because their image is not in a manifest and the
+    images that failed without being redone are reported.
+
+    Args:
+        run_dir (str or list): Directory, or list of directories, holding shards and a manifest.
+        parquet_path (str): Path of the Parquet file to write.
+        csv_path (str): Optional path of a CSV export in the original layout.
+
+    Returns:
+        int: Number of rows written.
+    """
+    run_dirs = [run_dir] if isinstance(run_dir, str) else list(run_dir)
+    completed = set()
+    failed = set()
+    paths = []
+    for run_dir in run_dirs:
+        with open(os.path.join(run_dir, ShardedResults.manifest_name)) as manifest:
+            completed.update(line.rstrip("\n") for line in manifest if line.endswith("\n"))
+        failures_path = os.path.join(run_dir, ShardedResults.failures_name)
+        if os.path.exists(failures_path):
+            with open(failures_path) as failures:
+                failed.update(line.rstrip("\n") for line in failures if line.endswith("\n"))
+        paths.extend(shard_paths(run_dir))
+
+    latest = {}
+    n_dropped = 0
+    dropped_images = set()
+    for shard_idx, shard_path in enumerate(paths):
+        for line_idx, row in enumerate(read_shard(shard_path)):
+            if row["image_name"] in completed:
+                latest[row["image_name_clip"]] = (shard_idx, line_idx)
+            else:
+                n_dropped += 1
+                dropped_images.add(row["image_name"])
+    failed -= completed
+    if n_dropped:
+        print(f"Dropped {n_dropped} rows of {len(dropped_images)} images missing from the manifest")
+    if failed:
+        print(f"{len(failed)} images failed and have no results, e.g. {sorted(failed)[:5]}")
+
+    n_rows = 0
+    if csv_path and os.path.exists(csv_path):
+        os.remove(csv_path)
+    with pq.ParquetWriter(parquet_path, SCHEMA) as parquet_writer:
+        for shard_idx, shard_path in enumerate(paths):
+            rows = [row for line_idx, row in enumerate(read_shard(shard_path))
+                    if latest.get(row.get("image_name_clip")) == (shard_idx, line_idx)]
+            if not rows:
+                continue
+            df_out = typed_frame(rows)
+            parquet_writer.write_table(pa.Table.from_pandas(df_out, schema=SCHEMA, preserve_index=False))
+            if csv_path:
+                df_out.index += n_rows
+                legacy_frame(df_out).to_csv(csv_path, mode="a", header=n_rows == 0)
+            n_rows += len(df_out)
+
+    if csv_path and n_rows == 0:
+        legacy_frame(typed_frame([])).to_csv(csv_path)
+    return n_rows
+
+
+def merge_shards(output_dir, num_shards, export_csv=False):
+    """
+    Combines the results of all image shards into the predictions Parquet file.
+
+    Args:
+        output_dir (str): Directory the shard runs saved their output files to.
+        num_shards (int): Total number of image shards.
+        export_csv (bool): Also write the predictions CSV in the original layout.
+
+    Returns:
+        int: Number of rows written.
+    """
+    run_dirs = [run_dir_name(output_dir, shard_index, num_shards) for shard_index in range(num_shards)]
+    missing = [run_dir for run_dir in run_dirs if not os.path.exists(run_dir)]
+    if missing:
+        raise RuntimeError(f"Missing shard results: {missing}")
+    parquet_path, csv_path = output_paths(output_dir, export_csv)
+    n_rows = compact(run_dirs, parquet_path, csv_path)
+    print(f"Saved {n_rows} predictions from {num_shards} shards to {parquet_path}")
+    return n_rows
+
+
+def output_paths(output_dir, export_csv=False):
+    """
+    Returns the paths of the merged predictions files.
+
+    Args:
+        output_dir (str): Directory to save output files.
+        export_csv (bool): Whether a CSV export is written.
+
+    Returns:
+        tuple: Parquet path and CSV path, or None without a CSV export.
+    """
+    parquet_path = os.path.join(output_dir, "detection_classification_predictions.parquet")
+    csv_path = os.path.join(output_dir, "detection_classification_predictions.csv") if export_csv else None
+    return parquet_path, csv_path
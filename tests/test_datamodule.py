@@ -0,0 +1,84 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+
+try:
+    import torch
+    import torch.nn as nn
+    import lightning as L
+    from torchvision.io import write_jpeg
+
+    from src.callbacks import BackboneFreezeUnfreeze
+    from src.constants import CATEGORY_NAMES
+    from src.datamodule import HouseDataModule
+    from src.feature_cache import FeatureStore
+    from src.model import HPClassifier
+except ImportError:
+    L = None
+
+
+def tiny_backbone(*args, **kwargs):
+    "Stands in for convnextv2_tiny, with as many pooled features but a single strided conv"
+    backbone = nn.Module()
+    backbone.num_features = 768
+    backbone.stem = nn.Conv2d(3, backbone.num_features, kernel_size=64, stride=64)
+    backbone.forward_features = backbone.stem
+    return backbone
+
+
+def write_split(img_dir, data_dir, split, n_crops):
+    rows = []
+    for i in range(n_crops):
+        file_name = f"{split}_{i}.jpg"
+        write_jpeg(torch.randint(0, 256, (3, 40, 30), dtype=torch.uint8), str(img_dir / file_name))
+        row = {"file_name": file_name, "weights": 1.0}
+        row.update({category: names[i % len(names)] for category, names in CATEGORY_NAMES.items()})
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(data_dir / f"{split}.csv", index=False)
+
+
+@unittest.skipIf(L is None, "torch, torchvision, timm or lightning is not installed")
+class TestCachedFit(unittest.TestCase):
+    """ Smoke run of `trainer.fit(datamodule=...)` switching from cached features to crops """
+
+    def test_fit_switches_from_cached_features_to_crops(self):
+        seen = []
+
+        class RecordingClassifier(HPClassifier):
+            def training_step(self, batch, batch_idx):
+                seen.append((self.current_epoch, self.cached_features, batch[0].shape[1:]))
+                return super().training_step(batch, batch_idx)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            img_dir, data_dir = tmp / "crops", tmp / "data"
+            img_dir.mkdir()
+            data_dir.mkdir()
+            for split in ("train", "valid", "test"):
+                write_split(img_dir, data_dir, split, 8)
+
+            with mock.patch("src.model.timm.create_model", tiny_backbone):
+                model = RecordingClassifier(lr=1e-3)
+            dm = HouseDataModule(img_dir, data_dir, batch_size=4, num_workers=0,
+                                 feature_store=FeatureStore(tmp / "features", model.backbone),
+                                 cached_epochs=1)
+            dm.setup()
+            trainer = L.Trainer(
+                accelerator="cpu",
+                max_epochs=2,
+                logger=False,
+                enable_checkpointing=False,
+                enable_progress_bar=False,
+                callbacks=[BackboneFreezeUnfreeze(unfreeze_at_epoch=1)],
+                reload_dataloaders_every_n_epochs=1,
+            )
+            trainer.fit(model, datamodule=dm)
+
+        self.assertEqual(trainer.current_epoch, 2)
+        self.assertTrue(seen)
+        for epoch, cached_features, shape in seen:
+            self.assertEqual(cached_features, epoch == 0)
+            self.assertEqual(tuple(shape), (768, 1, 1) if epoch == 0 else (3, 512, 512))
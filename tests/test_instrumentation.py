@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+from src.instrumentation import STAGES, PipelineStats
+
+
+class TestPipelineStats(unittest.TestCase):
+    """ Per-image records are streamed out and summaries only cover the last window """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.trace_path = os.path.join(self.tmp.name, "trace.jsonl")
+        self.stats = PipelineStats(report_every=2, trace_path=self.trace_path)
+
+    def tearDown(self):
+        self.stats.close()
+        self.tmp.cleanup()
+
+    def run_image(self, image_name, decode_s, n_boxes):
+        self.stats.add(image_name, "decode", decode_s)
+        self.stats.set_boxes(image_name, n_boxes)
+        self.stats.sample_queue("decode", n_boxes)
+        self.stats.finish(image_name)
+
+    def test_finish_streams_records(self):
+        self.run_image("a.jpg", 0.5, 3)
+        self.run_image("b.jpg", 0.25, 1)
+        self.stats.close()
+
+        self.assertEqual(len(self.stats.images), 0)
+        self.assertEqual(self.stats.boxes, {})
+        with open(self.trace_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record["image_name"] for record in records], ["a.jpg", "b.jpg"])
+        self.assertEqual(records[0]["boxes"], 3)
+        self.assertEqual(set(records[0]) - {"image_name", "boxes"}, set(STAGES))
+        self.assertEqual(records[1]["decode"], 0.25)
+
+    def test_report_starts_a_new_window(self):
+        self.run_image("a.jpg", 1.0, 3)
+        self.run_image("b.jpg", 1.0, 5)
+        with redirect_stdout(StringIO()):
+            self.stats.maybe_report()
+        self.run_image("c.jpg", 0.002, 1)
+
+        summary = self.stats.summary()
+        self.assertEqual(summary["images"], 3)
+        self.assertAlmostEqual(summary["stage_ms"]["decode"]["p99"], 2.0)
+        self.assertAlmostEqual(summary["stage_ms"]["decode"]["total_s"], 2.002)
+        self.assertEqual(summary["boxes_per_image"], {"mean": 1.0, "max": 1})
+        self.assertEqual(summary["queue_depth"]["decode"], {"mean": 1.0, "max": 1})
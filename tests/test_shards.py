@@ -0,0 +1,164 @@
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+from contextlib import redirect_stdout
+from io import StringIO
+
+import pandas as pd
+
+from src.constants import CATEGORY_NAMES
+from src.shards import ShardedResults, compact, in_shard, legacy_frame, read_shard, shard_paths, typed_frame
+
+
+def prediction_row(image_name, box_num, score=0.9):
+    row = {"image_name": image_name, "image_name_clip": f"{image_name[:-4]}_{box_num}.jpg",
+           "x1": 1.0 + box_num, "y1": 2.0, "x2": 30.0, "y2": 40.5, "score": score}
+    for idx, category in enumerate(CATEGORY_NAMES):
+        row[category] = (box_num + idx) % len(CATEGORY_NAMES[category])
+        row[f"{category}_prob"] = 0.5
+    return row
+
+
+def failed_future():
+    future = Future()
+    future.set_exception(IOError("disk full"))
+    return future
+
+
+def read_lines(fpath):
+    with open(fpath) as f:
+        return [line.rstrip("\n") for line in f]
+
+
+class TestShardedResults(unittest.TestCase):
+    """ Images are committed to the manifest once all their rows and crop writes are done """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.run_dir = os.path.join(self.tmp.name, "predictions_run")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def manifest(self):
+        return read_lines(os.path.join(self.run_dir, ShardedResults.manifest_name))
+
+    def test_commit_after_all_rows(self):
+        results = ShardedResults(self.run_dir, rows_per_shard=2)
+        results.start_image("a.jpg", 3)
+        results.start_image("empty.jpg", 0)
+        results.add_rows([prediction_row("a.jpg", 0), prediction_row("a.jpg", 1)])
+        self.assertEqual(self.manifest(), ["empty.jpg"])
+        results.add_rows([prediction_row("a.jpg", 2)])
+        results.close()
+
+        self.assertEqual(self.manifest(), ["empty.jpg", "a.jpg"])
+        self.assertEqual(len(shard_paths(self.run_dir)), 2)
+        rows = [row for path in shard_paths(self.run_dir) for row in read_shard(path)]
+        self.assertEqual([row["image_name_clip"] for row in rows], ["a_0.jpg", "a_1.jpg", "a_2.jpg"])
+
+    def test_failed_images_are_not_committed(self):
+        results = ShardedResults(self.run_dir)
+        results.start_image("a.jpg", 1, [failed_future()])
+        results.add_rows([prediction_row("a.jpg", 0)])
+        results.fail_image("b.jpg")
+        with redirect_stdout(StringIO()) as out:
+            results.close()
+
+        self.assertEqual(self.manifest(), [])
+        self.assertEqual(read_lines(os.path.join(self.run_dir, ShardedResults.failures_name)),
+                         ["a.jpg", "b.jpg"])
+        self.assertIn("2 images failed", out.getvalue())
+
+    def test_resume_keeps_completed_images(self):
+        results = ShardedResults(self.run_dir)
+        results.start_image("a.jpg", 1)
+        results.add_rows([prediction_row("a.jpg", 0)])
+        results.close()
+
+        resumed = ShardedResults(self.run_dir, resume=True)
+        self.assertEqual(resumed.completed, {"a.jpg"})
+        resumed.start_image("b.jpg", 1)
+        resumed.add_rows([prediction_row("b.jpg", 0)])
+        resumed.close()
+        self.assertEqual(self.manifest(), ["a.jpg", "b.jpg"])
+        # A restart starts a new shard rather than appending to the last one
+        self.assertEqual(len(shard_paths(self.run_dir)), 2)
+
+        restarted = ShardedResults(self.run_dir)
+        self.assertEqual(restarted.completed, set())
+        restarted.close()
+        self.assertEqual(shard_paths(self.run_dir), [])
+
+
+class TestCompact(unittest.TestCase):
+    """ Shards are merged into one Parquet file with the rows of committed images only """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.run_dir = os.path.join(self.tmp.name, "predictions_run")
+        self.parquet_path = os.path.join(self.tmp.name, "predictions.parquet")
+        self.csv_path = os.path.join(self.tmp.name, "predictions.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_compact_dedups_and_drops_uncommitted_rows(self):
+        os.makedirs(self.run_dir)
+        with open(os.path.join(self.run_dir, "shard-00000.jsonl"), "w") as shard:
+            # Rows of a crashed run: a.jpg was not committed before the crash
+            shard.write(json.dumps(prediction_row("a.jpg", 0, score=0.1)) + "\n")
+            shard.write(json.dumps(prediction_row("c.jpg", 0)) + "\n")
+            shard.write('{"image_name": "a.jpg", "image_na')
+        with open(os.path.join(self.run_dir, "shard-00001.jsonl"), "w") as shard:
+            shard.write(json.dumps(prediction_row("a.jpg", 0, score=0.8)) + "\n")
+            shard.write(json.dumps(prediction_row("a.jpg", 1)) + "\n")
+            shard.write(json.dumps(prediction_row("b.jpg", 0)) + "\n")
+        with open(os.path.join(self.run_dir, ShardedResults.manifest_name), "w") as manifest:
+            manifest.write("a.jpg\nb.jpg\n")
+        with open(os.path.join(self.run_dir, ShardedResults.failures_name), "w") as failures:
+            failures.write("c.jpg\n")
+
+        with redirect_stdout(StringIO()) as out:
+            n_rows = compact(self.run_dir, self.parquet_path, self.csv_path)
+
+        self.assertEqual(n_rows, 3)
+        df = pd.read_parquet(self.parquet_path)
+        self.assertEqual(list(df.image_name_clip), ["a_0.jpg", "a_1.jpg", "b_0.jpg"])
+        self.assertAlmostEqual(float(df.score.iloc[0]), 0.8, places=6)
+        self.assertEqual(len(pd.read_csv(self.csv_path)), 3)
+        self.assertIn("Dropped 1 rows of 1 images", out.getvalue())
+        self.assertIn("1 images failed", out.getvalue())
+
+
+class TestFrames(unittest.TestCase):
+    """ Typed tables hold class codes and convert back to the original layout """
+
+    def test_typed_to_legacy(self):
+        rows = [prediction_row("a.jpg", 0), prediction_row("a.jpg", 1)]
+        df = typed_frame(rows)
+        for category, names in CATEGORY_NAMES.items():
+            self.assertEqual(list(df[category].cat.categories), names)
+            self.assertEqual(list(df[category].cat.codes), [row[category] for row in rows])
+        self.assertEqual(str(df.x1.dtype), "float32")
+
+        legacy = legacy_frame(df)
+        self.assertEqual(legacy.boxes.iloc[1], [2.0, 2.0, 30.0, 40.5])
+        self.assertAlmostEqual(legacy.box_scores.iloc[0], 0.9, places=6)
+        for category, names in CATEGORY_NAMES.items():
+            self.assertEqual(list(legacy[category]), [names[row[category]] for row in rows])
+        self.assertEqual(list(legacy.image_name_clip), ["a_0.jpg", "a_1.jpg"])
+
+
+class TestInShard(unittest.TestCase):
+    """ Every image belongs to exactly one shard, whatever the process """
+
+    def test_partition(self):
+        image_names = [f"seq{i}/left/{j}.jpg" for i in range(20) for j in range(20)]
+        for image_name in image_names:
+            self.assertEqual(sum(in_shard(image_name, idx, 4) for idx in range(4)), 1)
+        counts = [sum(in_shard(image_name, idx, 4) for image_name in image_names) for idx in range(4)]
+        self.assertTrue(all(count > 50 for count in counts))
+        self.assertTrue(all(in_shard(image_name, 0, 1) for image_name in image_names))
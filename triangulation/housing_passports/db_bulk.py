@@ -0,0 +1,495 @@
+"""
+Bulk loading of buildings, images and detections into PostGRES
+
+Rows are validated and encoded in Python (geometries as hex WKB), streamed
+into temporary staging tables with `COPY ... FROM STDIN`, and moved into the
+ORM tables with one `INSERT ... SELECT` per table. Rows that cannot be loaded
+are collected in a `LoadErrors` report instead of aborting the load.
+"""
+import csv
+import io
+import json
+import os.path as op
+from collections import namedtuple
+
+import numpy as np
+from osgeo import ogr
+from shapely import to_wkb
+from sqlalchemy import text
+from tqdm import tqdm
+
+from housing_passports.db_classes import SRID
+from housing_passports.utils_transforms import (detection_heading, generate_rays, generate_buffer_rays)
+
+# Image columns needed to place the detections of an image
+ImageRef = namedtuple('ImageRef', ['id', 'lon', 'lat', 'heading', 'neighborhood'])
+
+# A detection resolved to its image, with the heading of its ray
+PlacedDetection = namedtuple('PlacedDetection',
+                             ['group_index', 'image', 'score', 'class_id', 'class_str', 'bbox', 'heading'])
+
+# Default length of the detection rays and distance of their buffers, in meters
+RAY_LENGTH = 20
+BUFFER_DISTANCE = 15
+
+# Number of rows sent per COPY statement
+COPY_CHUNK_SIZE = 100000
+
+STAGING_TABLES = {
+    'stage_buildings': """
+        CREATE TEMP TABLE stage_buildings (
+            neighborhood text, lon double precision, lat double precision,
+            building_metadata jsonb, footprint bytea, centroid bytea
+        ) ON COMMIT DROP""",
+    'stage_images': """
+        CREATE TEMP TABLE stage_images (
+            lon double precision, lat double precision, heading double precision,
+            neighborhood text, subfolder text, frame text, image_fname text, cam integer
+        ) ON COMMIT DROP""",
+    'stage_detections': """
+        CREATE TEMP TABLE stage_detections (
+            image_id integer, x_min double precision, y_min double precision,
+            x_max double precision, y_max double precision, class_id integer, class_str text,
+            confidence double precision, neighborhood text, angle double precision,
+            detection_ray bytea, ray_buffer bytea
+        ) ON COMMIT DROP""",
+    'stage_rays': """
+        CREATE TEMP TABLE stage_rays (
+            detection_id integer, detection_ray bytea, ray_buffer bytea
+        ) ON COMMIT DROP""",
+    'stage_links': """
+        CREATE TEMP TABLE stage_links (
+            detection_id integer, building_id integer
+        ) ON COMMIT DROP""",
+}
+
+
+class LoadErrors:
+    """Per-row report of rows skipped by the bulk loaders
+
+    Parameters
+    ----------
+    fpath: str or None
+        CSV file the report is written to. If None, the report is printed.
+    """
+
+    def __init__(self, fpath=None):
+        self.fpath = fpath
+        self.rows = []
+
+    def add(self, source, row_ref, message):
+        """Record a skipped row.
+
+        Parameters
+        ----------
+        source: str
+            File the row comes from.
+        row_ref: str or int
+            Line number, feature index or key identifying the row in `source`.
+        message: str
+            Reason the row was skipped.
+        """
+        self.rows.append((source, row_ref, message))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def report(self):
+        """Write or print all recorded errors."""
+        if self.fpath:
+            with open(self.fpath, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(['source', 'row', 'error'])
+                writer.writerows(self.rows)
+            print(f'Wrote {len(self.rows)} skipped rows to {self.fpath}')
+        else:
+            for source, row_ref, message in self.rows:
+                print(f'{source}, row {row_ref}: {message}')
+
+
+def _hex_wkb(wkb):
+    """Encode WKB bytes as a bytea literal for CSV COPY."""
+    return '\\x' + wkb.hex()
+
+
+def _copy_rows(session, table, columns, rows):
+    """Stream rows into a table with COPY in CSV format.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    table: str
+        Name of the table to load.
+    columns: list of str
+        Column names, in the order of the row values.
+    rows: iterable of tuple
+        Rows to load. `None` values are loaded as NULL.
+
+    Returns
+    -------
+    n_rows: int
+        Number of rows copied.
+    """
+    cursor = session.connection().connection.cursor()
+    statement = f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)'
+    n_rows = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        n_rows += 1
+        if n_rows % COPY_CHUNK_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+    if buffer.tell():
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+    return n_rows
+
+
+def _create_staging_table(session, table):
+    session.execute(text(f'DROP TABLE IF EXISTS {table}'))
+    session.execute(text(STAGING_TABLES[table]))
+
+
+def bulk_add_buildings(geomfile_fpath, session, errors):
+    """Bulk load building polygons, skipping missing, invalid and non-polygon geometries
+
+    Parameters
+    ----------
+    geomfile_fpath: str
+        File path to shapefile or geojson containing building polygons, with a
+        "neighborho" column holding the neighborhood.
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    errors: LoadErrors
+        Report of skipped rows.
+
+    Returns
+    -------
+    n_rows_added: int
+        Number of buildings inserted. The caller commits.
+    """
+    ogr_driver = 'ESRI Shapefile' if op.splitext(geomfile_fpath)[1] == '.shp' else 'GeoJSON'
+    dataSource = ogr.GetDriverByName(ogr_driver).Open(geomfile_fpath, 0)
+    if dataSource is None:
+        print('Could not open {}'.format(geomfile_fpath))
+        return 0
+    layer = dataSource.GetLayer()
+
+    def rows():
+        for gi in tqdm(range(layer.GetFeatureCount()), desc='Streaming buildings to staging table'):
+            feat = layer.GetFeature(gi)
+            geom = feat.GetGeometryRef()
+            if geom is None:
+                errors.add(geomfile_fpath, gi, 'Geometry is None')
+            elif geom.GetGeometryName() != 'POLYGON':
+                errors.add(geomfile_fpath, gi, f'Geometry is a {geom.GetGeometryName()}, not a POLYGON')
+            elif not geom.IsValid():
+                errors.add(geomfile_fpath, gi, 'Geometry is invalid')
+            else:
+                centroid = geom.Centroid()
+                lon, lat = centroid.GetPoint()[:2]
+                yield (feat.GetField('neighborho'), lon, lat, json.dumps(feat.items()),
+                       _hex_wkb(bytes(geom.ExportToWkb())), _hex_wkb(bytes(centroid.ExportToWkb())))
+
+    _create_staging_table(session, 'stage_buildings')
+    _copy_rows(session, 'stage_buildings',
+               ['neighborhood', 'lon', 'lat', 'building_metadata', 'footprint', 'centroid'], rows())
+    return session.execute(text(f"""
+        INSERT INTO buildings (neighborhood, lon, lat, building_metadata, footprint, centroid)
+        SELECT neighborhood, lon, lat, building_metadata,
+               ST_GeomFromWKB(footprint, {SRID}), ST_GeomFromWKB(centroid, {SRID})
+        FROM stage_buildings
+    """)).rowcount
+
+
+def bulk_add_images(image_csv_fpath, session, errors):
+    """Bulk load image information from a trajectory CSV file
+
+    Parameters
+    ----------
+    image_csv_fpath: str
+        Filepath to the CSV file containing image information, in the format
+        documented in `db_package.add_images`.
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    errors: LoadErrors
+        Report of skipped rows.
+
+    Returns
+    -------
+    n_rows_added: int
+        Number of images inserted. The caller commits.
+    """
+    def rows():
+        with open(image_csv_fpath, 'r') as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=',')
+            for row in tqdm(reader, desc='Streaming images to staging table'):
+                try:
+                    yield (float(row['longitude[deg]']), float(row['latitude[deg]']),
+                           float(row['heading[deg]']), row['neighborhood'], row['subfolder'],
+                           row['frame'], row['image_fname'], int(row['cam']))
+                except (KeyError, TypeError, ValueError) as e:
+                    errors.add(image_csv_fpath, reader.line_num, f'{type(e).__name__}: {e}')
+
+    _create_staging_table(session, 'stage_images')
+    _copy_rows(session, 'stage_images',
+               ['lon', 'lat', 'heading', 'neighborhood', 'subfolder', 'frame', 'image_fname', 'cam'], rows())
+    return session.execute(text("""
+        INSERT INTO sv_images (lon, lat, heading, neighborhood, subfolder, frame, image_fname, cam)
+        SELECT lon, lat, heading, neighborhood, subfolder, frame, image_fname, cam
+        FROM stage_images
+    """)).rowcount
+
+
+def image_lookup(session, subfolders=None):
+    """Fetch the position and heading of images in one query, keyed for detection matching
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    subfolders: iterable of str or None
+        If specified, only fetch images from these subfolders.
+
+    Returns
+    -------
+    images: dict
+        (frame, subfolder, image_fname, cam) -> `ImageRef`
+    """
+    query = 'SELECT frame, subfolder, image_fname, cam, id, lon, lat, heading, neighborhood FROM sv_images'
+    params = {}
+    if subfolders is not None:
+        query += ' WHERE subfolder = ANY(:subfolders)'
+        params['subfolders'] = sorted(set(subfolders))
+    return {tuple(row[:4]): ImageRef(*row[4:]) for row in session.execute(text(query), params)}
+
+
+def _group_ref(det):
+    return '/'.join(map(str, (det['frame'], det['subfolder'], det['image_fname'], det['cam'])))
+
+
+def missing_image_message(det):
+    """Describe a detection group whose image is missing from the database."""
+    return (f'No image found for filters: {det["neighborhood"]}, '
+            f'{det["subfolder"]}, {det["frame"]}, {op.basename(det["image_fname"])}, {det["cam"]}. '
+            'Missing in image information/trajectory file?')
+
+
+def place_detections(det_group, images, classes_to_include=None, ray_length=RAY_LENGTH,
+                     buffer_distance=BUFFER_DISTANCE):
+    """Resolve the image and heading of every detection, then generate all rays and buffers at once
+
+    Parameters
+    ----------
+    det_group: list
+        List of detections, one item per image, as returned by
+        `db_package._load_detections`.
+    images: dict
+        Image lookup returned by `image_lookup`.
+    classes_to_include: None or list of str
+        If specified, only keep detections for these class strings.
+    ray_length: float
+        Length of the detection rays in meters.
+    buffer_distance: float
+        Distance of the ray buffers around the rays in meters.
+
+    Returns
+    -------
+    placed: list of PlacedDetection
+        Kept detections, grouped by image in the order of `det_group`.
+    rays: np.ndarray of shapely.LineString
+        Detection ray of each placed detection.
+    buffers: np.ndarray of shapely.Polygon
+        Ray buffer of each placed detection.
+    missing: list of dict
+        Detection groups whose image is not in `images`.
+    failed: list of tuple
+        (detection group, exception) for groups that could not be placed,
+        e.g. with an unrecognized camera key. No detection of these groups is kept.
+    """
+    placed, missing, failed = [], [], []
+    for group_index, det in enumerate(det_group):
+        image = images.get((det['frame'], det['subfolder'], det['image_fname'], det['cam']))
+        if image is None:
+            missing.append(det)
+            continue
+
+        try:
+            group = []
+            for score, class_id, class_str, bbox, od_mean_x in zip(
+                    det['detection_scores'],
+                    det['detection_classes'],
+                    det['detection_class_strs'],
+                    det['detection_boxes'],
+                    det['od_mean_xs']):
+
+                if classes_to_include and class_str not in classes_to_include:
+                    continue
+                group.append(PlacedDetection(group_index, image, score, class_id, class_str, bbox,
+                                             detection_heading(det['cam'], od_mean_x, image.heading)))
+        except (RuntimeError, ValueError) as e:
+            failed.append((det, e))
+            continue
+        placed.extend(group)
+
+    rays = generate_rays([p.image.lon for p in placed], [p.image.lat for p in placed],
+                         [p.heading for p in placed], ray_length)
+    buffers = generate_buffer_rays(rays, buffer_distance)
+    return placed, rays, buffers, missing, failed
+
+
+def bulk_add_detections(det_group, session, errors, classes_to_include=None, source='detections',
+                        ray_length=RAY_LENGTH, buffer_distance=BUFFER_DISTANCE):
+    """Bulk load detections, resolving their image and generating their ray geometries
+
+    Parameters
+    ----------
+    det_group: list
+        List of detections, one item per image, as returned by
+        `db_package._load_detections`.
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    errors: LoadErrors
+        Report of skipped rows. Detections whose image is missing from the
+        trajectory file are reported here.
+    classes_to_include: None or list of str
+        If specified, only add detections for these class strings.
+    source: str
+        Name of the detections file, used in the error report.
+    ray_length, buffer_distance: float
+        Ray geometry settings in meters, see `place_detections`.
+
+    Returns
+    -------
+    n_rows_added: int
+        Number of detections inserted. The caller commits.
+    """
+    images = image_lookup(session, (det['subfolder'] for det in det_group))
+    placed, rays, buffers, missing, failed = place_detections(det_group, images, classes_to_include,
+                                                              ray_length, buffer_distance)
+    for det in missing:
+        errors.add(source, _group_ref(det), missing_image_message(det))
+    for det, e in failed:
+        errors.add(source, _group_ref(det), f'{type(e).__name__}: {e}')
+
+    rows = ((p.image.id, p.bbox[1], p.bbox[0], p.bbox[3], p.bbox[2], p.class_id, p.class_str, p.score,
+             p.image.neighborhood, p.heading, _hex_wkb(ray_wkb), _hex_wkb(buffer_wkb))
+            for p, ray_wkb, buffer_wkb in zip(tqdm(placed, desc='Streaming detections to staging table'),
+                                              to_wkb(rays), to_wkb(buffers)))
+
+    _create_staging_table(session, 'stage_detections')
+    _copy_rows(session, 'stage_detections',
+               ['image_id', 'x_min', 'y_min', 'x_max', 'y_max', 'class_id', 'class_str', 'confidence',
+                'neighborhood', 'angle', 'detection_ray', 'ray_buffer'], rows)
+    return session.execute(text(f"""
+        INSERT INTO sv_detections (image_id, x_min, y_min, x_max, y_max, class_id, class_str,
+                                   confidence, neighborhood, angle, detection_ray, ray_buffer)
+        SELECT image_id, x_min, y_min, x_max, y_max, class_id, class_str,
+               confidence, neighborhood, angle,
+               ST_GeomFromWKB(detection_ray, {SRID}), ST_GeomFromWKB(ray_buffer, {SRID})
+        FROM stage_detections
+    """)).rowcount
+
+
+def bulk_set_building_ids(session, detection_ids, building_ids):
+    """Assign buildings to detections with one COPY and one UPDATE
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    detection_ids: array_like of int
+        IDs of the detections to link.
+    building_ids: array_like of int
+        ID of the building linked to each detection.
+
+    Returns
+    -------
+    n_rows_updated: int
+        Number of detections updated. The caller commits.
+    """
+    _create_staging_table(session, 'stage_links')
+    _copy_rows(session, 'stage_links', ['detection_id', 'building_id'],
+               zip(map(int, detection_ids), map(int, building_ids)))
+    return session.execute(text("""
+        UPDATE sv_detections AS d
+        SET building_id = s.building_id
+        FROM stage_links AS s
+        WHERE d.id = s.detection_id
+    """)).rowcount
+
+
+def detection_origins(session, neighborhood):
+    """Fetch the camera location and heading of every detection of a neighborhood in one query
+
+    The rays of a detection are fully determined by its image location and
+    its `angle`, so they can be regenerated for other distances without
+    re-reading the trajectory and detection files.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    neighborhood: str
+        Name of neighborhood to fetch detections for.
+
+    Returns
+    -------
+    ids: np.ndarray of int
+        Detection IDs.
+    lons, lats, headings: np.ndarray of float
+        Camera longitude, latitude and ray heading of each detection in deg.
+    """
+    rows = session.execute(text("""
+        SELECT det.id, img.lon, img.lat, det.angle
+        FROM sv_detections AS det
+        JOIN sv_images AS img ON img.id = det.image_id
+        WHERE det.neighborhood = :neighborhood AND det.angle IS NOT NULL
+        ORDER BY det.id
+    """), {'neighborhood': neighborhood}).all()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    lons, lats, headings = (np.array([row[i] for row in rows], dtype=float) for i in (1, 2, 3))
+    return ids, lons, lats, headings
+
+
+def bulk_regenerate_rays(session, neighborhood, ray_length=RAY_LENGTH, buffer_distance=BUFFER_DISTANCE):
+    """Regenerate the rays and buffers of a neighborhood in place and clear its links
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    neighborhood: str
+        Name of neighborhood to regenerate detections for.
+    ray_length: float
+        Length of the detection rays in meters.
+    buffer_distance: float
+        Distance of the ray buffers around the rays in meters.
+
+    Returns
+    -------
+    n_rows_updated: int
+        Number of detections updated. The caller commits.
+    """
+    ids, lons, lats, headings = detection_origins(session, neighborhood)
+    rays = generate_rays(lons, lats, headings, ray_length)
+    buffers = generate_buffer_rays(rays, buffer_distance)
+
+    _create_staging_table(session, 'stage_rays')
+    _copy_rows(session, 'stage_rays', ['detection_id', 'detection_ray', 'ray_buffer'],
+               ((int(det_id), _hex_wkb(ray_wkb), _hex_wkb(buffer_wkb))
+                for det_id, ray_wkb, buffer_wkb in zip(ids, to_wkb(rays), to_wkb(buffers))))
+    session.execute(text('UPDATE sv_detections SET building_id = NULL WHERE neighborhood = :neighborhood'),
+                    {'neighborhood': neighborhood})
+    return session.execute(text(f"""
+        UPDATE sv_detections AS d
+        SET detection_ray = ST_GeomFromWKB(s.detection_ray, {SRID}),
+            ray_buffer = ST_GeomFromWKB(s.ray_buffer, {SRID})
+        FROM stage_rays AS s
+        WHERE d.id = s.detection_id
+    """)).rowcount
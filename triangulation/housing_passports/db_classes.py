@@ -7,7 +7,7 @@ from collections import Counter
 
 import numpy as np
 from sqlalchemy import (Column, Integer, String, Float,
-                        ForeignKey)
+                        ForeignKey, inspect, text)
 from sqlalchemy.dialects.postgresql.json import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -16,6 +16,111 @@ from geoalchemy2 import Geometry
 # Set the declarative base to prep creation of SQL classes
 Base = declarative_base()
 
+# All geometries are stored as lon/lat on WGS84
+SRID = 4326
+
+# Version of the tables below. Bump it when they change so that
+# `ensure_schema` runs `create_all` again on existing databases.
+SCHEMA_VERSION = 1
+
+# Secondary indexes per table. They are not declared on the columns so that
+# `create_all` does not build them on empty tables; `create_indexes` builds
+# them once the table is bulk loaded.
+INDEXES = {
+    'buildings': [
+        ('idx_building_neighborhood', '(neighborhood)'),
+        ('idx_buildings_footprint', 'USING GIST (footprint)'),
+        ('idx_buildings_centroid', 'USING GIST (centroid)'),
+    ],
+    'sv_images': [
+        ('idx_sv_images_frame', '(frame)'),
+        # Image lookup of `add_detections`
+        ('idx_sv_images_lookup', '(frame, subfolder, image_fname, cam)'),
+    ],
+    'sv_detections': [
+        ('idx_sv_detections_neighborhood_building', '(neighborhood, building_id)'),
+        ('idx_sv_detections_ray', 'USING GIST (detection_ray)'),
+        ('idx_sv_detections_ray_buffer', 'USING GIST (ray_buffer)'),
+    ],
+}
+
+# Geometry columns per table, used to bring databases created without an SRID up to date
+GEOMETRY_COLUMNS = {
+    'buildings': ['footprint', 'centroid'],
+    'sv_detections': ['detection_ray', 'ray_buffer'],
+}
+
+
+def create_indexes(session, tablenames=None):
+    """Create the secondary indexes of tables and refresh their planner statistics.
+
+    Meant to run after a table is bulk loaded, which is faster than
+    maintaining the indexes on every insert and yields more compact indexes.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    tablenames: list or None
+        Tables to index. Defaults to all tables in `INDEXES`.
+    """
+    for tablename in tablenames or INDEXES:
+        for index_name, definition in INDEXES[tablename]:
+            session.execute(text(f'CREATE INDEX IF NOT EXISTS {index_name} ON {tablename} {definition};'))
+        session.execute(text(f'ANALYZE {tablename};'))
+
+
+def set_geometry_srid(session):
+    """Declare SRID 4326 on geometry columns created without one.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    """
+    for tablename, columns in GEOMETRY_COLUMNS.items():
+        for column in columns:
+            srid = session.execute(text(f"SELECT Find_SRID('public', '{tablename}', '{column}');")).scalar()
+            if srid != SRID:
+                session.execute(text(f"SELECT UpdateGeometrySRID('{tablename}', '{column}', {SRID});"))
+
+
+def ensure_schema(engine):
+    """Create the tables unless the database already holds the current schema version.
+
+    Checking the version is a single query, whereas `create_all` reflects
+    every table on each call.
+
+    Parameters
+    ----------
+    engine: sqlalchemy.engine.Engine
+        Engine of the database.
+
+    Returns
+    -------
+    created: bool
+        Whether `create_all` ran.
+    """
+    with engine.begin() as connection:
+        version = None
+        if connection.execute(text("SELECT to_regclass('schema_version') IS NOT NULL;")).scalar():
+            version = connection.execute(text('SELECT max(version) FROM schema_version;')).scalar()
+        if version == SCHEMA_VERSION:
+            return False
+
+        Base.metadata.create_all(connection)
+        connection.execute(text('DELETE FROM schema_version;'))
+        connection.execute(text('INSERT INTO schema_version (version) VALUES (:version);'),
+                           {'version': SCHEMA_VERSION})
+    return True
+
+
+class SchemaVersion(Base):
+    """Version of the schema the database was created with, see `ensure_schema`"""
+
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+
 
 class Building(Base):
     """Geometry and properties for a single building
@@ -37,18 +142,20 @@ class Building(Base):
 
     __tablename__ = 'buildings'
     id = Column(Integer, primary_key=True)
-    footprint = Column(Geometry('POLYGON'))
+    footprint = Column(Geometry('POLYGON', srid=SRID, spatial_index=False))
     lon = Column(Float)
     lat = Column(Float)
     neighborhood = Column(String)
     building_metadata = Column(JSONB)
-    centroid = Column(Geometry('POINT'))
+    centroid = Column(Geometry('POINT', srid=SRID, spatial_index=False))
 
     # Add a relationship with the Detections class
     detections = relationship('Detection', back_populates='building')
 
     def __repr__(self):
-        """Define string representation."""
+        """Define string representation without lazy loading the detections."""
+        if 'detections' in inspect(self).unloaded:
+            return f'<Building(id={self.id}, neighborhood={self.neighborhood})>'
         return f'<Building(n_detections={len(self.detections)}, neighborhood={self.neighborhood})>'
 
 
@@ -216,8 +323,8 @@ class Detection(Base):
     confidence = Column(Float)
     neighborhood = Column(String)
     angle = Column(Float)
-    detection_ray = Column(Geometry('LINESTRING'))
-    ray_buffer = Column(Geometry('POLYGON'))
+    detection_ray = Column(Geometry('LINESTRING', srid=SRID, spatial_index=False))
+    ray_buffer = Column(Geometry('POLYGON', srid=SRID, spatial_index=False))
 
     # Add a relationship with the Image and building class
     image = relationship('Image', back_populates='detections')
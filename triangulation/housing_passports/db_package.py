@@ -8,20 +8,31 @@ PostGRES DB will have 3 tables:
 """
 import csv
 import json
+import os
 import os.path as op
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 import numpy as np
 import tensorflow as tf
-from geoalchemy2.functions import ST_Intersects, ST_Within
+from geoalchemy2 import WKBElement, WKTElement
+from shapely import to_wkb
 # from object_detection.utils import label_map_util
 from osgeo import ogr
-from sqlalchemy import create_engine, text, and_
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from tqdm import tqdm
 
-from housing_passports.db_classes import Image, Building, Detection, Base
-from housing_passports.utils_transforms import (get_LR_visual_extents, interpolate, generate_ray, generate_buffer_ray)
+from housing_passports.db_bulk import (BUFFER_DISTANCE, RAY_LENGTH, LoadErrors, bulk_add_buildings,
+                                       bulk_add_detections, bulk_add_images, bulk_regenerate_rays,
+                                       detection_origins, image_lookup, missing_image_message,
+                                       place_detections)
+from housing_passports.db_classes import (Image, Building, Detection, SCHEMA_VERSION, SRID, create_indexes,
+                                          ensure_schema, set_geometry_srid)
+from housing_passports.geo_export import FORMATS, export_features
+from housing_passports.link_offline import (link_db_neighborhood, link_placed_detections, load_db_buildings,
+                                            load_file_buildings, load_file_images, sweep_link_counts)
 from housing_passports.utils_convert import (create_category_index_from_labelmap)
 
 ### script used to writen by TF1.0
@@ -30,6 +41,92 @@ from housing_passports.utils_convert import (create_category_index_from_labelmap
 # tf.gfile = tf.io.gfile
 
 
+# Link every detection of a neighborhood to the building whose centroid lies in
+# the ray buffer and whose footprint the ray intersects. When several buildings
+# qualify, the one closest to the camera wins (KNN ordering on the centroid).
+LINK_DETECTIONS_SQL = text("""
+    UPDATE sv_detections AS d
+    SET building_id = m.building_id
+    FROM (
+        SELECT det.id AS detection_id, nearest.id AS building_id
+        FROM sv_detections AS det
+        JOIN sv_images AS img ON img.id = det.image_id
+        CROSS JOIN LATERAL (
+            SELECT b.id
+            FROM buildings AS b
+            WHERE b.neighborhood = :neighborhood
+              AND ST_Within(b.centroid, det.ray_buffer)
+              AND ST_Intersects(b.footprint, det.detection_ray)
+            ORDER BY b.centroid <-> ST_SetSRID(ST_MakePoint(img.lon, img.lat), ST_SRID(b.centroid))
+            LIMIT 1
+        ) AS nearest
+        WHERE det.neighborhood = :neighborhood
+    ) AS m
+    WHERE d.id = m.detection_id
+""")
+
+# Consolidate the detections linked to the buildings of a neighborhood into
+# their metadata, as `Building.get_consolidated_properties` and
+# `Building.get_consolidated_parts` do:
+#   * properties: per property group, the class with the largest summed
+#     confidence (first listed class on ties), kept if that sum is > 0.
+#   * parts: per part, the largest number of detections in a single image.
+# Keys already in the metadata take precedence, then parts, then properties.
+DISTILL_METADATA_SQL = text("""
+    WITH dets AS (
+        SELECT d.building_id, d.image_id, d.class_str, d.confidence
+        FROM sv_detections AS d
+        JOIN buildings AS b ON b.id = d.building_id
+        WHERE b.neighborhood = :neighborhood
+    ),
+    group_classes AS (
+        SELECT g.key AS group_key, c.class_str, c.position
+        FROM jsonb_each(CAST(:property_groups AS jsonb)) AS g
+        CROSS JOIN LATERAL jsonb_array_elements_text(g.value) WITH ORDINALITY AS c(class_str, position)
+    ),
+    group_best AS (
+        SELECT DISTINCT ON (s.building_id, gc.group_key) s.building_id, gc.group_key, gc.class_str, s.conf
+        FROM (
+            SELECT building_id, class_str, SUM(confidence) AS conf
+            FROM dets GROUP BY building_id, class_str
+        ) AS s
+        JOIN group_classes AS gc ON gc.class_str = s.class_str
+        ORDER BY s.building_id, gc.group_key, s.conf DESC, gc.position
+    ),
+    props AS (
+        SELECT building_id, jsonb_object_agg(:prefix || group_key, class_str) AS metadata
+        FROM group_best WHERE conf > 0
+        GROUP BY building_id
+    ),
+    parts AS (
+        SELECT building_id, jsonb_object_agg(:prefix || class_str, max_count) AS metadata
+        FROM (
+            SELECT building_id, class_str, MAX(n) AS max_count
+            FROM (
+                SELECT building_id, class_str, COUNT(*) AS n
+                FROM dets WHERE class_str = ANY(:parts)
+                GROUP BY building_id, class_str, image_id
+            ) AS per_image
+            GROUP BY building_id, class_str
+        ) AS per_part
+        GROUP BY building_id
+    )
+    UPDATE buildings AS b
+    SET building_metadata = COALESCE(m.props, '{}') || COALESCE(m.parts, '{}')
+                            || COALESCE(b.building_metadata, '{}')
+    FROM (
+        SELECT COALESCE(props.building_id, parts.building_id) AS building_id,
+               props.metadata AS props, parts.metadata AS parts
+        FROM props FULL JOIN parts ON parts.building_id = props.building_id
+    ) AS m
+    WHERE b.id = m.building_id
+""")
+
+# Engines per (database URL, pool size, echo), shared by all commands run in this process
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
 def add_buildings(geomfile_fpath, session):
     """Add a building polygon to the database
 
@@ -78,12 +175,12 @@ def add_buildings(geomfile_fpath, session):
         if geom.GetGeometryName() == 'POLYGON' and geom.IsValid():
             centroid = geom.Centroid().GetPoint()
 
-            session.add(Building(footprint=geom.ExportToWkt(),
+            session.add(Building(footprint=WKTElement(geom.ExportToWkt(), srid=SRID),
                                  neighborhood=feat.GetField('neighborho'),  # neighborhood, TODO Fix later
                                  lon=centroid[0],
                                  lat=centroid[1],
                                  building_metadata=feat.items(),
-                                 centroid=geom.Centroid().ExportToWkt()))
+                                 centroid=WKTElement(geom.Centroid().ExportToWkt(), srid=SRID)))
             n_rows_added += 1
 
     return n_rows_added
@@ -141,7 +238,8 @@ def add_images(image_csv_fpath, session):
     return n_rows_added
 
 
-def add_detections(det_group, session, classes_to_include=None):
+def add_detections(det_group, session, classes_to_include=None, images=None, ray_length=RAY_LENGTH,
+                   buffer_distance=BUFFER_DISTANCE):
     # print(det_group)
     """Add a list of detections to database (incl. with link to image).
 
@@ -154,6 +252,11 @@ def add_detections(det_group, session, classes_to_include=None):
         SQL Alchemy session handle to the database
     classes_to_include: None or str
         If specified, only add detections for these class strings.
+    images: dict or None
+        Image lookup keyed on (frame, subfolder, image_fname, cam), as returned
+        by `db_bulk.image_lookup`. Built in one query if not given.
+    ray_length, buffer_distance: float
+        Ray geometry settings in meters, see `db_bulk.place_detections`.
 
     Returns
     -------
@@ -162,58 +265,37 @@ def add_detections(det_group, session, classes_to_include=None):
     """
 
     n_rows_added = 0
-    missing_img_report = []
+
+    # Resolve images in memory rather than with one query per detection group
+    if images is None:
+        images = image_lookup(session, (det['subfolder'] for det in det_group))
+
+    # Rays and buffers of all detections are generated in one vectorized pass
+    placed, rays, buffers, missing, failed = place_detections(det_group, images, classes_to_include,
+                                                              ray_length, buffer_distance)
+    missing_img_report = [missing_image_message(det) for det in missing]
+    for det, e in failed:
+        print(f"Error processing detection {det}: {e}")
+
+    groups = {}
+    for p, ray_wkb, buffer_wkb in zip(placed, to_wkb(rays), to_wkb(buffers)):
+        groups.setdefault(p.group_index, []).append((p, ray_wkb, buffer_wkb))
 
     # Iterate through all ML detections
-    # TODO: could maybe speed this up using a better query strategy
-    for det in tqdm(det_group, desc='Connecting detections to images and adding to session'):
+    for group_index, group in tqdm(groups.items(), desc='Adding detections to session'):
         try:
             with session.begin_nested():
-                image = session.query(Image).filter(and_(Image.frame == det['frame'],
-                                                         Image.subfolder == det['subfolder'],
-                                                         Image.image_fname == det['image_fname'],
-                                                         Image.cam == det['cam'])).first()
-
-                if image is None:
-                    missing_img_report.append(
-                        f'No image found for filters: {det["neighborhood"]}, '
-                        f'{det["subfolder"]}, {det["frame"]}, {op.basename(det["image_fname"])}, {det["cam"]}. '
-                        'Missing in image information/trajectory file?')
-                    continue
-
-                # Get information from matching image
-                vext = get_LR_visual_extents(image.heading)
-
-                for score, class_id, class_str, bbox, od_mean_x in zip(
-                        det['detection_scores'],
-                        det['detection_classes'],
-                        det['detection_class_strs'],
-                        det['detection_boxes'],
-                        det['od_mean_xs']):
-
-                    if classes_to_include and class_str not in classes_to_include:
-                        continue
-
-                    if det['cam'] == 1:
-                        det_heading = interpolate(od_mean_x, vext['r_min'], vext['r_max'])
-                    elif det['cam'] == 3:
-                        det_heading = interpolate(od_mean_x, vext['l_min'], vext['l_max'])
-                    else:
-                        raise RuntimeError('Key indicating camera view unrecognized')
-
-                    wkt_linestring = generate_ray(image.lon, image.lat, det_heading)
-                    wkt_buffer = generate_buffer_ray(wkt_linestring)
-
-                    detection = Detection(image_id=image.id,
-                                          y_min=bbox[0], x_min=bbox[1],
-                                          y_max=bbox[2], x_max=bbox[3],
-                                          class_id=class_id,
-                                          class_str=class_str,
-                                          confidence=score,
-                                          neighborhood=image.neighborhood,
-                                          angle=det_heading,
-                                          detection_ray=wkt_linestring,
-                                          ray_buffer=wkt_buffer)
+                for p, ray_wkb, buffer_wkb in group:
+                    detection = Detection(image_id=p.image.id,
+                                          y_min=p.bbox[0], x_min=p.bbox[1],
+                                          y_max=p.bbox[2], x_max=p.bbox[3],
+                                          class_id=p.class_id,
+                                          class_str=p.class_str,
+                                          confidence=p.score,
+                                          neighborhood=p.image.neighborhood,
+                                          angle=p.heading,
+                                          detection_ray=WKBElement(ray_wkb, srid=SRID),
+                                          ray_buffer=WKBElement(buffer_wkb, srid=SRID))
 
                     session.add(detection)
 
@@ -222,7 +304,7 @@ def add_detections(det_group, session, classes_to_include=None):
             session.commit()
 
         except Exception as e:
-            print(f"Error processing detection {det}: {e}")
+            print(f"Error processing detection {det_group[group_index]}: {e}")
             session.rollback()
 
     for msg in missing_img_report:
@@ -231,12 +313,43 @@ def add_detections(det_group, session, classes_to_include=None):
     return n_rows_added
 
 
+def get_engine(db_url, pool_size=5, echo=False):
+    """Get the pooled engine of a database, creating it on first use.
+
+    Commands run in the same process share one engine (and its connection
+    pool) per URL, pool size and echo setting. The tables are only created
+    when the database does not hold the current `SCHEMA_VERSION`.
+
+    Parameters
+    ----------
+    db_url: str
+        Database access URL (including username and password if necessary).
+    pool_size: int
+        Number of connections kept open by the pool. As many more can be
+        opened on demand.
+    echo: bool
+        Whether to log all statements.
+
+    Returns
+    -------
+    engine: sqlalchemy.engine.Engine
+    """
+    with _ENGINES_LOCK:
+        key = (db_url, pool_size, echo)
+        engine = _ENGINES.get(key)
+        if engine is None:
+            engine = create_engine(db_url, echo=echo, pool_size=pool_size, max_overflow=pool_size,
+                                   pool_pre_ping=True)
+            if ensure_schema(engine):
+                print(f'Created tables for schema version {SCHEMA_VERSION}.')
+            _ENGINES[key] = engine
+    return engine
+
+
 def _get_session(db_url, use_batch_mode=True, echo=False):
     """Helper to get an SQLAlchemy DB session"""
     # `use_batch_mode` is experimental currently, but needed for `executemany`
-    engine = create_engine(db_url, echo=echo)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=get_engine(db_url, echo=echo))
     session = Session()
 
     try:
@@ -278,23 +391,24 @@ def _load_detections(det_data, class_map):
     return det_data
 
 
-@click.command(short_help="Populate each building's metadata field using pre-attached detections.")
-@click.argument('db-url', nargs=1)
-@click.option("--fpath-parts", type=click.Path(exists=True),
-              help="JSON file containing a list of building parts under `parts` key.")
-@click.option("--fpath-property-groups", type=click.Path(exists=True),
-              help="JSON file containing a dictionary of property names and included keys.")
-@click.option("--neighborhood", type=str,
-              help="Name of neighborhood to store in DB for all detections.")
-def distill_building_metadata(db_url, fpath_parts, fpath_property_groups,
-                              neighborhood):
-    """Helper to distill all building detections into metadata."""
+def load_distill_keys(fpath_parts=None, fpath_property_groups=None):
+    """Load the part names and property groups used to distill building metadata.
 
-    session = _get_session(db_url)
-    query = session.query(Building). \
-        filter(Building.neighborhood == neighborhood)
+    Parameters
+    ----------
+    fpath_parts: str or None
+        JSON file containing a list of building parts under `parts` key.
+    fpath_property_groups: str or None
+        JSON file containing a dictionary of property names and included keys.
 
-    # Load parts and property information
+    Returns
+    -------
+    parts_list: list
+        Part names, empty if `fpath_parts` is None.
+    property_groups: dict
+        Property groups, empty if `fpath_property_groups` is None.
+    """
+    parts_list = []
     if fpath_parts:
         with open(fpath_parts, 'r') as json_file:
             parts_dict = json.load(json_file)
@@ -302,26 +416,43 @@ def distill_building_metadata(db_url, fpath_parts, fpath_property_groups,
             raise ValueError('`fpath-parts` must point to json with `parts` key')
         parts_list = parts_dict['parts']
 
+    property_groups = {}
     if fpath_property_groups:
         with open(fpath_property_groups, 'r') as json_file:
             property_groups = json.load(json_file)
 
-    # Iterate over buildings, considlidate metadata
-    for building in tqdm(query.yield_per(1000),
-                         desc='Distilling detections into building metadata',
-                         total=query.count()):
+    return parts_list, property_groups
+
 
-        # Must create new dicts (and not update original ones) when assigning to the metadata
-        if fpath_parts:
-            all_parts = building.get_consolidated_parts(parts_list)
-            all_parts.update(building.building_metadata)
-            building.building_metadata = all_parts
+def distill_neighborhood(session, neighborhood, parts_list, property_groups):
+    """Consolidate the detections of a neighborhood into building metadata with `DISTILL_METADATA_SQL`.
 
-        if fpath_property_groups:
-            all_props = building.get_consolidated_properties(property_groups)
-            all_props.update(building.building_metadata)
-            building.building_metadata = all_props
+    Returns the number of buildings updated. The caller commits.
+    """
+    print(f'Distilling detections into building metadata for {neighborhood}...')
+    n_buildings = session.execute(DISTILL_METADATA_SQL, {'neighborhood': neighborhood,
+                                                         'property_groups': json.dumps(property_groups),
+                                                         'parts': parts_list,
+                                                         'prefix': 'sv_'}).rowcount
+    print(f'Updated metadata of {n_buildings} buildings in {neighborhood}.')
+    return n_buildings
 
+
+@click.command(short_help="Populate each building's metadata field using pre-attached detections.")
+@click.argument('db-url', nargs=1)
+@click.option("--fpath-parts", type=click.Path(exists=True),
+              help="JSON file containing a list of building parts under `parts` key.")
+@click.option("--fpath-property-groups", type=click.Path(exists=True),
+              help="JSON file containing a dictionary of property names and included keys.")
+@click.option("--neighborhood", type=str,
+              help="Name of neighborhood to store in DB for all detections.")
+def distill_building_metadata(db_url, fpath_parts, fpath_property_groups,
+                              neighborhood):
+    """Helper to distill all building detections into metadata."""
+
+    session = _get_session(db_url)
+    parts_list, property_groups = load_distill_keys(fpath_parts, fpath_property_groups)
+    distill_neighborhood(session, neighborhood, parts_list, property_groups)
     session.commit()
 
 
@@ -345,9 +476,17 @@ def distill_building_metadata(db_url, fpath_parts, fpath_property_groups,
               help="PBTXT file mapping building properties class IDs to strings")
 @click.option('--det_classes', type=str, default=None, multiple=True,
               help='Property classes to include (e.g., "window", "pre_1940").')
+@click.option('--bulk', is_flag=True, default=False,
+              help='Load with COPY into staging tables instead of adding ORM objects one by one.')
+@click.option('--error-report', type=click.Path(), default=None,
+              help='CSV file listing the rows skipped by --bulk. Printed if not given.')
+@click.option('--ray-length', type=float, default=RAY_LENGTH, show_default=True,
+              help='Length of the detection rays in meters.')
+@click.option('--buffer-distance', type=float, default=BUFFER_DISTANCE, show_default=True,
+              help='Distance of the ray buffers around the detection rays in meters.')
 def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
                  parts_inference_fpath, props_inference_fpath, parts_map_fpath, props_map_fpath,
-                 det_classes):
+                 det_classes, bulk, error_report, ray_length, buffer_distance):
     """Export housing passport information to a database.
 
     Parameters
@@ -369,10 +508,30 @@ def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
     det_classes: list or None
         List of class names (e.g., 'complete', 'window', etc.) used to filter
         detections.
+    bulk: bool
+        Whether to stream rows into the database with COPY (see `db_bulk`).
+    error_report: str or None
+        CSV file listing the rows skipped in bulk mode.
+    ray_length: float
+        Length of the detection rays in meters.
+    buffer_distance: float
+        Distance of the ray buffers around the detection rays in meters.
     """
-
-    # Create database connection
     session = _get_session(db_url)
+    load_inputs(session, trajectory_fpath, geomfile_fpath, parts_inference_fpath, props_inference_fpath,
+                parts_map_fpath, props_map_fpath, det_classes, bulk, LoadErrors(error_report),
+                ray_length, buffer_distance)
+
+
+def load_inputs(session, trajectory_fpath, geomfile_fpath, parts_inference_fpath, props_inference_fpath,
+                parts_map_fpath, props_map_fpath, det_classes=None, bulk=False, errors=None,
+                ray_length=RAY_LENGTH, buffer_distance=BUFFER_DISTANCE):
+    """Load buildings, images and detections into the database and index them.
+
+    See `export_to_db` for the parameters. Commits after every table.
+    """
+    errors = LoadErrors() if errors is None else errors
+    set_geometry_srid(session)
 
     # Load category index
     map_parts = create_category_index_from_labelmap(
@@ -386,13 +545,19 @@ def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
     ######################################
 
     if geomfile_fpath is not None:
-        n_buildings = add_buildings(geomfile_fpath, session)
+        if bulk:
+            n_buildings = bulk_add_buildings(geomfile_fpath, session, errors)
+        else:
+            n_buildings = add_buildings(geomfile_fpath, session)
         print(f'Committing {n_buildings} buildings...')
         session.commit()
         print('Done.\n')
 
     if trajectory_fpath is not None:
-        n_images = add_images(trajectory_fpath, session)
+        if bulk:
+            n_images = bulk_add_images(trajectory_fpath, session, errors)
+        else:
+            n_images = add_images(trajectory_fpath, session)
         print(f'Committing {n_images} images...')
         session.commit()
         print('Done.\n')
@@ -402,12 +567,9 @@ def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
     # # # # will be faster, more compact and more efficient indexation 
     # # # ######################################
 
-    print('Creating index on buildings table...')
-    session.execute(text('CREATE INDEX IF NOT EXISTS idx_building_id ON buildings(id);'))
-    session.execute(text('CREATE INDEX IF NOT EXISTS idx_building_neighborhood ON buildings(neighborhood);'))
-
-    print('Creating index  on colum frame in table sv_images...')
-    session.execute(text('CREATE INDEX IF NOT EXISTS idx_sv_images_frame ON sv_images(frame);'))
+    print('Creating indexes on buildings and sv_images tables...')
+    create_indexes(session, ['buildings', 'sv_images'])
+    session.commit()
 
     # ############################
     # # Add detections to database
@@ -416,12 +578,21 @@ def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
     # ############################################
     # # Load and process building part predictions
     # ############################################
+    # One image lookup serves both the part and the property detections
+    images = None if bulk else image_lookup(session)
+
     loaded_part_dets = []
     with open(parts_inference_fpath, 'r') as json_file:
         for det_parts in json.load(json_file):
             loaded_part_dets.append(_load_detections(det_parts, map_parts))
     loaded_part_dets = [det for det in loaded_part_dets if det is not None]
-    n_added_part_dets = add_detections(loaded_part_dets, session, det_classes)
+    if bulk:
+        n_added_part_dets = bulk_add_detections(loaded_part_dets, session, errors, det_classes,
+                                                source=parts_inference_fpath, ray_length=ray_length,
+                                                buffer_distance=buffer_distance)
+    else:
+        n_added_part_dets = add_detections(loaded_part_dets, session, det_classes, images,
+                                           ray_length=ray_length, buffer_distance=buffer_distance)
 
     print(f'Committing detections: {n_added_part_dets} Parts ...')
     session.commit()
@@ -434,7 +605,13 @@ def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
         for det_properties in json.load(json_file):
             loaded_properties_dets.append(_load_detections(det_properties, map_properties))
     loaded_properties_dets = [det for det in loaded_properties_dets if det is not None]
-    n_added_prop_dets = add_detections(loaded_properties_dets, session, det_classes)
+    if bulk:
+        n_added_prop_dets = bulk_add_detections(loaded_properties_dets, session, errors, det_classes,
+                                                source=props_inference_fpath, ray_length=ray_length,
+                                                buffer_distance=buffer_distance)
+    else:
+        n_added_prop_dets = add_detections(loaded_properties_dets, session, det_classes, images,
+                                           ray_length=ray_length, buffer_distance=buffer_distance)
     # ################################################
     # # Committing detections to db
     # ################################################
@@ -442,12 +619,33 @@ def export_to_db(db_url, trajectory_fpath, geomfile_fpath,
     session.commit()
     print('Done.\n')
 
+    print('Creating indexes on sv_detections table...')
+    create_indexes(session, ['sv_detections'])
+    session.commit()
+
+    if errors:
+        errors.report()
+
+
+def _link_neighborhood(session, neighborhood, engine='postgis'):
+    """Helper to link the detections of a neighborhood, returning the detection and match counts"""
+    if engine == 'offline':
+        n_detections, n_detection_matches = link_db_neighborhood(session, neighborhood)
+        print(f'Matched {n_detections} detections to buildings in process.')
+    else:
+        n_detections = session.query(Detection).filter(Detection.neighborhood == neighborhood).count()
+        print(f'Matching {n_detections} detections to buildings...')
+        n_detection_matches = session.execute(LINK_DETECTIONS_SQL, {'neighborhood': neighborhood}).rowcount
+    return n_detections, n_detection_matches
+
 
 @click.command(short_help="Link buildings and detections in existing DB.")
 @click.argument('db-url', nargs=1)
 @click.option("--neighborhood", type=str,
               help="Neighborhood to run matches for.")
-def link_db_detections(db_url, neighborhood):
+@click.option("--engine", type=click.Choice(['postgis', 'offline']), default='postgis',
+              help="Run the spatial matching in PostGIS or in process with shapely.")
+def link_db_detections(db_url, neighborhood, engine):
     """Link object detections to building footprints in existing DB.
     Also, consolidates building properties into metadata.
     Parameters
@@ -456,65 +654,167 @@ def link_db_detections(db_url, neighborhood):
         Database access URL (including username and password if necessary).
     neighborhood: str
         Name of neighborhood to run DB matches for.
+    engine: str
+        'postgis' runs `LINK_DETECTIONS_SQL` in the database. 'offline' loads
+        the geometries once, matches them with `link_offline` and writes the
+        links back in one batch.
     """
 
     # Link to DB
     session = _get_session(db_url)
-
-    # Loop over all detections and match to buildings
-    n_detection_matches = 0
-    n_detection_misses = 0
-
-    query = session.query(Detection).filter(Detection.neighborhood == neighborhood)
-    for detection in tqdm(query.yield_per(10000),
-                          desc='Matching detections to buildings',
-                          total=query.count()):
-
-        ################################
-        # Look for building intersection
-        ################################
-
-        # TODO: Could add a filter to search for buildings within some radius of ray
-        build_matches = session.query(Building). \
-            filter(Building.neighborhood == neighborhood). \
-            filter(ST_Within(Building.centroid, detection.ray_buffer)). \
-            filter(ST_Intersects(Building.footprint, detection.detection_ray)).all()
-
-        ###########################################################
-        # Handle linkage between linestring and individual building
-        ###########################################################
-
-        if not build_matches:
-            n_detection_misses += 1
-            continue
-        # If multiple intersections, find closest building
-        elif len(build_matches) > 1:
-            dists = []
-            # Calc euclidean dist for each building
-            for building in build_matches:
-                line = ogr.Geometry(ogr.wkbLineString)
-                line.AddPoint(detection.image.lon, detection.image.lat)
-                line.AddPoint(building.lon, building.lat)
-                dists.append(line.Length())
-            build_match = build_matches[np.argmin(dists)]
-        else:
-            build_match = build_matches[0]
-
-        build_match.detections.append(detection)
-        n_detection_matches += 1
+    n_detections, n_detection_matches = _link_neighborhood(session, neighborhood, engine)
 
     ##################
     # Print and commit
     ##################
-    if (n_detection_matches + n_detection_misses) > 0:
+    if n_detections > 0:
         print(f'Found building matches for {n_detection_matches} detections '
-              f'({100 * n_detection_matches / (n_detection_matches + n_detection_misses):0.2f}%)')
+              f'({100 * n_detection_matches / n_detections:0.2f}%)')
     else:
         print('Found 0 building matches. Try checking building footprint file '
               ' for errors/corruption.')
     session.commit()
 
 
+@click.command(short_help="Link detections to building footprints from files, without a database.")
+@click.option("--trajectory-fpath", type=click.Path(exists=True), required=True,
+              help="CSV file containing GPS trajectory info for each image")
+@click.option("--geomfile-fpath", type=click.Path(exists=True), required=True,
+              help="Shapefile or geojson containing building footprints")
+@click.option("--inference-fpath", type=click.Path(exists=True), required=True,
+              help="Json file containing ML predictions for building parts or properties.")
+@click.option("--map-fpath", type=click.Path(exists=True), required=True,
+              help="PBTXT file mapping the class IDs of `--inference-fpath` to strings")
+@click.option("--neighborhood", type=str, default=None,
+              help="Only link buildings and images of this neighborhood.")
+@click.option('--det_classes', type=str, default=None, multiple=True,
+              help='Property classes to include (e.g., "window", "pre_1940").')
+@click.option('--save-fpath', type=click.Path(), default='links.parquet',
+              help='Parquet file to save one row per detection to.')
+@click.option('--ray-length', type=float, default=RAY_LENGTH, show_default=True,
+              help='Length of the detection rays in meters.')
+@click.option('--buffer-distance', type=float, default=BUFFER_DISTANCE, show_default=True,
+              help='Distance of the ray buffers around the detection rays in meters.')
+def link_file_detections(trajectory_fpath, geomfile_fpath, inference_fpath, map_fpath,
+                         neighborhood, det_classes, save_fpath, ray_length, buffer_distance):
+    """Link ML detections to building footprints in process and save them to Parquet.
+
+    Parameters
+    ----------
+    trajectory_fpath: str
+        CSV file containing GPS trajectory info for each image
+    geomfile_fpath: str
+        Shapefile or geojson containing building footprints
+    inference_fpath: str
+        Json that contains ML predictions.
+    map_fpath: str
+        TF PBTXT file mapping class IDs to strings
+    neighborhood: str or None
+        Name of neighborhood used to filter buildings and images.
+    det_classes: list or None
+        List of class names (e.g., 'complete', 'window', etc.) used to filter
+        detections.
+    save_fpath: str
+        Parquet file to save the detections with their `building_id`, the
+        feature index of the linked building in `geomfile_fpath`.
+    ray_length: float
+        Length of the detection rays in meters.
+    buffer_distance: float
+        Distance of the ray buffers around the detection rays in meters.
+    """
+    class_map = create_category_index_from_labelmap(map_fpath, use_display_name=True)
+    building_ids, footprints, centroids = load_file_buildings(geomfile_fpath, neighborhood)
+    images = load_file_images(trajectory_fpath, neighborhood)
+
+    with open(inference_fpath, 'r') as json_file:
+        det_group = [_load_detections(det, class_map) for det in json.load(json_file)]
+    det_group = [det for det in det_group if det is not None]
+
+    placed, rays, buffers, missing, failed = place_detections(det_group, images, det_classes,
+                                                              ray_length, buffer_distance)
+    for det, e in failed:
+        print(f"Error processing detection {det}: {e}")
+    print(f'Skipped {len(missing)} detection groups without an image in the trajectory file.')
+
+    links = link_placed_detections(placed, rays, buffers, building_ids, footprints, centroids)
+    links.to_parquet(save_fpath, index=False)
+
+    n_matches = int(links['building_id'].notna().sum())
+    if len(links):
+        print(f'Found building matches for {n_matches} detections '
+              f'({100 * n_matches / len(links):0.2f}%)')
+    print(f'Saved {len(links)} detections to {save_fpath}')
+
+
+@click.command(short_help="Report the link rate of detections for several ray lengths and buffer distances.")
+@click.argument('db-url', nargs=1)
+@click.option("--neighborhood", type=str, required=True,
+              help="Neighborhood to run matches for.")
+@click.option('--ray-length', type=float, multiple=True, default=[RAY_LENGTH], show_default=True,
+              help='Length of the detection rays in meters. Repeat to sweep several values.')
+@click.option('--buffer-distance', type=float, multiple=True, default=[BUFFER_DISTANCE], show_default=True,
+              help='Distance of the ray buffers in meters. Repeat to sweep several values.')
+@click.option("--engine", type=click.Choice(['postgis', 'offline']), default='postgis',
+              help="Regenerate and link in the database, or in process without writing to it.")
+@click.option('--report-fpath', type=click.Path(), default=None,
+              help='CSV file to save the link rate of every setting to.')
+def sweep_ray_settings(db_url, neighborhood, ray_length, buffer_distance, engine, report_fpath):
+    """Regenerate detection rays for every ray length and buffer distance and report link rates.
+
+    Rays are rebuilt from the image location and `angle` stored with each
+    detection, so trajectories and ML predictions are not re-read.
+
+    Parameters
+    ----------
+    db_url: str
+        Database access URL (including username and password if necessary).
+    neighborhood: str
+        Name of neighborhood to run DB matches for.
+    ray_length: list of float
+        Ray lengths in meters.
+    buffer_distance: list of float
+        Ray buffer distances in meters. Every combination with `ray_length`
+        is run.
+    engine: str
+        'postgis' rewrites `detection_ray`, `ray_buffer` and `building_id` in
+        place and links with `LINK_DETECTIONS_SQL`; the database holds the last
+        setting afterwards. 'offline' links in process and leaves the database
+        untouched.
+    report_fpath: str or None
+        CSV file to save the link rate of every setting to.
+    """
+    session = _get_session(db_url)
+    settings = [(length, distance) for length in ray_length for distance in buffer_distance]
+
+    results = []
+    if engine == 'offline':
+        _, footprints, centroids = load_db_buildings(session, neighborhood)
+        _, lons, lats, headings = detection_origins(session, neighborhood)
+        for length, distance, n_matches in tqdm(sweep_link_counts(footprints, centroids, lons, lats,
+                                                                  headings, settings),
+                                                desc='Sweeping ray settings', total=len(settings)):
+            results.append((length, distance, len(lons), n_matches))
+    else:
+        for length, distance in settings:
+            print(f'Regenerating rays for ray length {length} m and buffer distance {distance} m...')
+            bulk_regenerate_rays(session, neighborhood, length, distance)
+            n_detections, n_matches = _link_neighborhood(session, neighborhood)
+            session.commit()
+            results.append((length, distance, n_detections, n_matches))
+
+    print('ray_length  buffer_distance  detections  matches  link_rate')
+    for length, distance, n_detections, n_matches in results:
+        rate = 100 * n_matches / n_detections if n_detections else 0.
+        print(f'{length:10.1f}  {distance:15.1f}  {n_detections:10d}  {n_matches:7d}  {rate:8.2f}%')
+
+    if report_fpath:
+        with open(report_fpath, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['ray_length', 'buffer_distance', 'detections', 'matches'])
+            writer.writerows(results)
+        print(f'Saved link rates to {report_fpath}')
+
+
 @click.command(short_help="Export detections as geojson linestrings.")
 @click.argument('db-url', nargs=1)
 @click.option('--save-fpath', type=str, default='rays.geojson',
@@ -525,16 +825,22 @@ def link_db_detections(db_url, neighborhood):
               help='Property classes to include (e.g., "window").')
 @click.option('--linked-dets-only', type=bool, default=True,
               help='Whether or not to only include detections successfully linked to a building.')
+@click.option('--format', 'fmt', type=click.Choice(sorted(set(FORMATS.values()))), default=None,
+              help='Output format. Inferred from the --save-fpath extension if not given.')
 def export_detection_geometry(db_url, save_fpath, neighborhood, det_class,
-                              linked_dets_only):
+                              linked_dets_only, fmt):
     """Generate geojson consisting of linestrings, one per ML detection
 
+    Features are streamed from a server-side cursor, so the export does not
+    hold the neighborhood in memory.
+
     Parameters
     ----------
     db_url: str
         Database access URL (including username and password if necessary).
     save_fpath: str
-        Filepath to save the geojson output to.
+        Filepath to save the output to. `.geojson`, `.ndjson`, `.fgb` and
+        `.parquet` (GeoParquet) are supported.
     neighborhood: str
         Name of neighborhood used to filter for ML detections
     det_class: list or None
@@ -542,49 +848,227 @@ def export_detection_geometry(db_url, save_fpath, neighborhood, det_class,
         detections.
     linked_dets_only: bool
         Whether to only export detections that are matched to a building.
+    fmt: str or None
+        Output format, see `geo_export.export_features`.
     """
 
     # Link to DB
     session = _get_session(db_url)
+    export_neighborhood_detections(session, save_fpath, neighborhood, det_class, linked_dets_only, fmt)
 
+
+def export_neighborhood_detections(session, save_fpath, neighborhood, det_class=None, linked_dets_only=True,
+                                   fmt=None):
+    """Stream the detection rays of a neighborhood to a file, see `export_detection_geometry`.
+
+    Returns the number of rays written.
+    """
     ########################
     # Get all detection rays
     ########################
     print('Getting desired detections...')
-    detections = session.query(Detection, Detection.detection_ray.ST_AsGeoJSON()) \
-        .filter(Detection.neighborhood == neighborhood)
+    from_clause = 'FROM sv_detections WHERE neighborhood = :neighborhood'
+    params = {'neighborhood': neighborhood}
     if det_class:
         print(f'Filtering for classes: {str(det_class)}...')
-        detections = detections.filter(Detection.class_str.in_(det_class))
+        from_clause += ' AND class_str = ANY(:det_classes)'
+        params['det_classes'] = list(det_class)
     if linked_dets_only:
         print('Filtering detections that don\'t have matching building...')
-        detections = detections.filter(Detection.building_id.isnot(None))
-
-    n_rows = detections.count()
-    print(f'Found {n_rows} detections. Pulling necessary info...')
+        from_clause += ' AND building_id IS NOT NULL'
 
     ################################
-    # Dump detection rays to geojson
+    # Stream detection rays to file
     ################################
-    geojson_rays = {"type": "FeatureCollection",
-                    "name": f'{neighborhood}_rays',
-                    "crs": {"type": "name", "properties":
-                        {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
-                    "features": []}
-
-    for det, geom in tqdm(detections.yield_per(10000),
-                          desc='Constructing geometries', total=n_rows):
-        properties = dict(class_str=det.class_str,
-                          image_id=getattr(det, 'image_id', 'None'),
-                          confidence=det.confidence)
-
-        geojson_rays['features'].append({'type': "Feature",
-                                         'geometry': json.loads(geom),
-                                         'properties': properties})
-
-    print('Dumping information to geojson...')
-    # Construct list of all rays
-    with open(save_fpath, 'w') as geoj_f:
-        json.dump(geojson_rays, geoj_f)
-
-    print(f'Saved {len(geojson_rays["features"])} ray linestrings to {save_fpath}')
+    n_features = export_features(session, save_fpath, 'detection_ray',
+                                 "json_build_object('class_str', class_str, 'image_id', image_id, "
+                                 "'confidence', confidence)",
+                                 from_clause, params, name=f'{neighborhood}_rays', fmt=fmt)
+
+    print(f'Saved {n_features} ray linestrings to {save_fpath}')
+    return n_features
+
+
+def triangulate_neighborhood(engine, neighborhood, link_engine='postgis', parts_list=None, property_groups=None,
+                             rays_fpath=None, ray_classes=None, rays_format=None):
+    """Link, distill and optionally export one neighborhood in its own session.
+
+    Parameters
+    ----------
+    engine: sqlalchemy.engine.Engine
+        Pooled engine, see `get_engine`.
+    neighborhood: str
+        Name of neighborhood to process.
+    link_engine: str
+        'postgis' or 'offline', see `link_db_detections`.
+    parts_list, property_groups: list and dict or None
+        Distillation keys, see `load_distill_keys`. Distillation is skipped
+        if both are empty.
+    rays_fpath: str or None
+        File to export the linked detection rays to. Skipped if None.
+    ray_classes: list or None
+        Class names of the exported rays. All classes if None.
+    rays_format: str or None
+        Format of `rays_fpath`, see `geo_export.export_features`.
+
+    Returns
+    -------
+    counts: dict
+        Number of detections, matches, distilled buildings and exported rays.
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        n_detections, n_matches = _link_neighborhood(session, neighborhood, link_engine)
+        session.commit()
+
+        n_buildings = 0
+        if parts_list or property_groups:
+            n_buildings = distill_neighborhood(session, neighborhood, parts_list or [], property_groups or {})
+            session.commit()
+
+        n_rays = 0
+        if rays_fpath:
+            n_rays = export_neighborhood_detections(session, rays_fpath, neighborhood, ray_classes,
+                                                    linked_dets_only=True, fmt=rays_format)
+    finally:
+        session.close()
+
+    return {'detections': n_detections, 'matches': n_matches, 'buildings': n_buildings, 'rays': n_rays}
+
+
+def run_triangulation(db_url, neighborhoods=None, workers=4, inputs=None, link_engine='postgis',
+                      fpath_parts=None, fpath_property_groups=None, rays_dir=None, ray_classes=None,
+                      rays_format='geojson'):
+    """Run the triangulation pipeline on one pooled engine.
+
+    Inputs are loaded first (if given), then every neighborhood is linked,
+    distilled and exported by a bounded pool of workers, each with its own
+    session on the shared engine.
+
+    Parameters
+    ----------
+    db_url: str
+        Database access URL (including username and password if necessary).
+    neighborhoods: list or None
+        Neighborhoods to process. All neighborhoods of the buildings table if None.
+    workers: int
+        Number of neighborhoods processed concurrently.
+    inputs: dict or None
+        Keyword arguments of `load_inputs`. Nothing is loaded if None.
+    link_engine: str
+        'postgis' or 'offline', see `link_db_detections`.
+    fpath_parts, fpath_property_groups: str or None
+        Distillation keys, see `distill_building_metadata`.
+    rays_dir: str or None
+        Directory to export the linked rays of each neighborhood to. Skipped if None.
+    ray_classes: list or None
+        Class names of the exported rays. All classes if None.
+    rays_format: str
+        Format of the ray files, see `geo_export.export_features`.
+
+    Returns
+    -------
+    counts: dict
+        Neighborhood -> counts returned by `triangulate_neighborhood`.
+    """
+    engine = get_engine(db_url, pool_size=workers)
+
+    if inputs:
+        session = sessionmaker(bind=engine)()
+        try:
+            load_inputs(session, **inputs)
+        finally:
+            session.close()
+
+    if not neighborhoods:
+        with engine.connect() as connection:
+            neighborhoods = connection.execute(text(
+                'SELECT DISTINCT neighborhood FROM buildings WHERE neighborhood IS NOT NULL ORDER BY 1'
+            )).scalars().all()
+
+    parts_list, property_groups = load_distill_keys(fpath_parts, fpath_property_groups)
+    rays_ext = next(ext for ext, fmt in FORMATS.items() if fmt == rays_format)
+
+    counts, failed = {}, []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(triangulate_neighborhood, engine, neighborhood, link_engine, parts_list, property_groups,
+                        op.join(rays_dir, f'{neighborhood}_rays{rays_ext}') if rays_dir else None,
+                        ray_classes, rays_format): neighborhood
+            for neighborhood in neighborhoods
+        }
+        for future in as_completed(futures):
+            neighborhood = futures[future]
+            try:
+                counts[neighborhood] = future.result()
+            except Exception as e:
+                print(f'Neighborhood {neighborhood} failed: {e}')
+                failed.append(neighborhood)
+
+    for neighborhood in sorted(counts):
+        c = counts[neighborhood]
+        rate = 100 * c['matches'] / c['detections'] if c['detections'] else 0.
+        print(f'{neighborhood}: {c["matches"]}/{c["detections"]} detections linked ({rate:0.2f}%), '
+              f'{c["buildings"]} buildings distilled, {c["rays"]} rays exported')
+    if failed:
+        raise RuntimeError(f'Triangulation failed for neighborhoods: {", ".join(sorted(failed))}')
+    return counts
+
+
+@click.command(short_help="Run load, link, distill and export on one pooled database engine.")
+@click.argument('db-url', nargs=1)
+@click.option("--neighborhood", type=str, multiple=True,
+              help="Neighborhood to process. Repeat for several. Defaults to all neighborhoods.")
+@click.option("--workers", type=int, default=4, show_default=True,
+              help="Number of neighborhoods processed concurrently.")
+@click.option("--trajectory-fpath", type=click.Path(exists=True),
+              help="CSV file containing GPS trajectory info for each image")
+@click.option("--geomfile-fpath", type=click.Path(exists=True),
+              help="Shapefile or geojson containing building footprints")
+@click.option("--parts-inference-fpath", type=click.Path(exists=True),
+              help="Json file containing ML predictions for building parts. Loading is skipped if not given.")
+@click.option("--props-inference-fpath", type=click.Path(exists=True),
+              help="Json file containing ML predictions for building properties.")
+@click.option("--parts-map-fpath", type=click.Path(exists=True),
+              help="PBTXT file mapping building parts class IDs to strings")
+@click.option("--props-map-fpath", type=click.Path(exists=True),
+              help="PBTXT file mapping building properties class IDs to strings")
+@click.option('--det_classes', type=str, default=None, multiple=True,
+              help='Property classes to load (e.g., "window", "pre_1940").')
+@click.option('--bulk', is_flag=True, default=False,
+              help='Load with COPY into staging tables instead of adding ORM objects one by one.')
+@click.option('--error-report', type=click.Path(), default=None,
+              help='CSV file listing the rows skipped by --bulk. Printed if not given.')
+@click.option('--ray-length', type=float, default=RAY_LENGTH, show_default=True,
+              help='Length of the detection rays in meters.')
+@click.option('--buffer-distance', type=float, default=BUFFER_DISTANCE, show_default=True,
+              help='Distance of the ray buffers around the detection rays in meters.')
+@click.option("--link-engine", type=click.Choice(['postgis', 'offline']), default='postgis',
+              help="Run the spatial matching in PostGIS or in process with shapely.")
+@click.option("--fpath-parts", type=click.Path(exists=True),
+              help="JSON file containing a list of building parts under `parts` key.")
+@click.option("--fpath-property-groups", type=click.Path(exists=True),
+              help="JSON file containing a dictionary of property names and included keys.")
+@click.option('--rays-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory to export the linked detection rays of each neighborhood to.')
+@click.option('--ray-class', type=str, default=None, multiple=True,
+              help='Property classes of the exported rays (e.g., "window").')
+@click.option('--rays-format', type=click.Choice(sorted(set(FORMATS.values()))), default='geojson',
+              show_default=True, help='Format of the exported ray files.')
+def run_pipeline(db_url, neighborhood, workers, trajectory_fpath, geomfile_fpath, parts_inference_fpath,
+                 props_inference_fpath, parts_map_fpath, props_map_fpath, det_classes, bulk, error_report,
+                 ray_length, buffer_distance, link_engine, fpath_parts, fpath_property_groups, rays_dir,
+                 ray_class, rays_format):
+    """Run the whole triangulation pipeline in one process, see `run_triangulation`."""
+    inputs = None
+    if parts_inference_fpath:
+        inputs = dict(trajectory_fpath=trajectory_fpath, geomfile_fpath=geomfile_fpath,
+                      parts_inference_fpath=parts_inference_fpath, props_inference_fpath=props_inference_fpath,
+                      parts_map_fpath=parts_map_fpath, props_map_fpath=props_map_fpath,
+                      det_classes=det_classes, bulk=bulk, errors=LoadErrors(error_report),
+                      ray_length=ray_length, buffer_distance=buffer_distance)
+    if rays_dir:
+        os.makedirs(rays_dir, exist_ok=True)
+
+    run_triangulation(db_url, list(neighborhood), workers, inputs, link_engine, fpath_parts,
+                      fpath_property_groups, rays_dir, list(ray_class) or None, rays_format)
@@ -0,0 +1,171 @@
+"""
+Stream features from PostGIS to GeoJSON, newline-delimited GeoJSON, FlatGeobuf or GeoParquet
+
+Rows are read from a server-side cursor in batches and written as they
+arrive, so memory use does not grow with the number of features. For the
+GeoJSON formats the geometry text of `ST_AsGeoJSON` and the properties
+serialized by PostgreSQL are spliced into the output without being parsed
+in Python. FlatGeobuf and GeoParquet store the geometry as WKB and the
+properties as one JSON column.
+"""
+import json
+import os.path as op
+
+from sqlalchemy import text
+
+# Output format per file extension
+FORMATS = {
+    '.geojson': 'geojson',
+    '.json': 'geojson',
+    '.ndjson': 'ndjson',
+    '.geojsonl': 'ndjson',
+    '.geojsons': 'ndjson',
+    '.fgb': 'fgb',
+    '.parquet': 'parquet',
+    '.geoparquet': 'parquet',
+}
+
+# Number of rows fetched from the server-side cursor at once
+BATCH_SIZE = 10000
+
+CRS84 = {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}}
+
+
+def export_format(fpath, fmt=None):
+    """Get the output format of a file from its extension unless given explicitly."""
+    if fmt is None:
+        ext = op.splitext(fpath)[1].lower()
+        if ext not in FORMATS:
+            raise ValueError(f'Cannot infer the export format of {fpath}. Use one of {sorted(FORMATS)}')
+        fmt = FORMATS[ext]
+    if fmt not in set(FORMATS.values()):
+        raise ValueError(f'Unknown export format {fmt}')
+    return fmt
+
+
+def _stream_batches(session, query, params, batch_size):
+    """Yield lists of rows fetched through a server-side cursor."""
+    # Options of this statement only, the session's connection keeps buffering later queries
+    result = session.execute(text(query), params, execution_options={'yield_per': batch_size})
+    for batch in result.partitions(batch_size):
+        yield batch
+
+
+def _write_geojson(fpath, batches, name):
+    n_features = 0
+    with open(fpath, 'w') as f:
+        header = {"type": "FeatureCollection", "name": name, "crs": CRS84}
+        f.write(json.dumps(header)[:-1] + ', "features": [\n')
+        for batch in batches:
+            for geom, properties in batch:
+                if n_features:
+                    f.write(',\n')
+                f.write(f'{{"type": "Feature", "geometry": {geom or "null"}, '
+                        f'"properties": {properties or "null"}}}')
+                n_features += 1
+        f.write('\n]}\n')
+    return n_features
+
+
+def _write_ndjson(fpath, batches):
+    n_features = 0
+    with open(fpath, 'w') as f:
+        for batch in batches:
+            f.writelines(f'{{"type": "Feature", "geometry": {geom or "null"}, '
+                         f'"properties": {properties or "null"}}}\n'
+                         for geom, properties in batch)
+            n_features += len(batch)
+    return n_features
+
+
+def _write_flatgeobuf(fpath, batches, name):
+    from osgeo import ogr, osr
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    dataSource = ogr.GetDriverByName('FlatGeobuf').CreateDataSource(fpath)
+    # Without a spatial index features are written as they come instead of kept until closing
+    layer = dataSource.CreateLayer(name, srs, ogr.wkbUnknown, options=['SPATIAL_INDEX=NO'])
+    field = ogr.FieldDefn('properties', ogr.OFTString)
+    field.SetSubType(ogr.OFSTJSON)
+    layer.CreateField(field)
+    layer_defn = layer.GetLayerDefn()
+
+    n_features = 0
+    for batch in batches:
+        for wkb, properties in batch:
+            feat = ogr.Feature(layer_defn)
+            if wkb is not None:
+                feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(wkb)))
+            if properties is not None:
+                feat.SetField('properties', properties)
+            layer.CreateFeature(feat)
+            n_features += 1
+    dataSource = None
+    return n_features
+
+
+def _write_geoparquet(fpath, batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    geo = {"version": "1.0.0", "primary_column": "geometry",
+           "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}}}
+    schema = pa.schema([('geometry', pa.binary()), ('properties', pa.string())],
+                       metadata={b'geo': json.dumps(geo).encode()})
+
+    n_features = 0
+    with pq.ParquetWriter(fpath, schema) as writer:
+        for batch in batches:
+            writer.write_table(pa.table({
+                'geometry': [None if wkb is None else bytes(wkb) for wkb, _ in batch],
+                'properties': [properties for _, properties in batch],
+            }, schema=schema))
+            n_features += len(batch)
+    return n_features
+
+
+def export_features(session, fpath, geometry, properties, from_clause, params=None, name='features',
+                    fmt=None, batch_size=BATCH_SIZE):
+    """Stream the result of a query to a feature file.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    fpath: str
+        File to write.
+    geometry: str
+        SQL expression of the geometry column, e.g. 'd.detection_ray'.
+    properties: str
+        SQL expression evaluating to the json or jsonb properties of a feature.
+    from_clause: str
+        FROM (and WHERE/ORDER BY) clause of the query.
+    params: dict or None
+        Bound parameters of `from_clause`.
+    name: str
+        Name of the FeatureCollection or layer.
+    fmt: str or None
+        'geojson', 'ndjson', 'fgb' or 'parquet'. Inferred from `fpath` if None.
+    batch_size: int
+        Number of rows fetched from the server at once.
+
+    Returns
+    -------
+    n_features: int
+        Number of features written.
+    """
+    fmt = export_format(fpath, fmt)
+    geometry_sql = f'ST_AsGeoJSON({geometry})' if fmt in ('geojson', 'ndjson') else f'ST_AsBinary({geometry})'
+    query = f'SELECT {geometry_sql}, CAST({properties} AS text) {from_clause}'
+    batches = _stream_batches(session, query, params or {}, batch_size)
+
+    if fmt == 'geojson':
+        return _write_geojson(fpath, batches, name)
+    if fmt == 'ndjson':
+        return _write_ndjson(fpath, batches)
+    if fmt == 'fgb':
+        return _write_flatgeobuf(fpath, batches, name)
+    return _write_geoparquet(fpath, batches)
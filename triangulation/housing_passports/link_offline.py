@@ -0,0 +1,298 @@
+"""
+Link detections to buildings in process with shapely 2.x, without PostGIS
+
+Replicates `db_package.LINK_DETECTIONS_SQL` on geometry arrays: a detection
+is linked to the building whose centroid lies within the ray buffer and whose
+footprint the ray intersects, and the building closest to the camera wins
+when several qualify. Inputs come either from an existing database (read in
+two queries, written back in one batch) or straight from the files used by
+`export_to_db`, in which case the links are written to Parquet.
+"""
+import csv
+import os.path as op
+
+import numpy as np
+import pandas as pd
+import shapely
+from osgeo import ogr
+from sqlalchemy import text
+from tqdm import tqdm
+
+from housing_passports.db_bulk import ImageRef, bulk_set_building_ids
+from housing_passports.utils_transforms import generate_buffer_rays, generate_rays
+
+
+def link_nearest_buildings(footprints, centroids, rays, buffers, origins):
+    """Find the building each detection ray points at with bulk spatial queries
+
+    Parameters
+    ----------
+    footprints: np.ndarray of shapely.Polygon
+        Building footprints.
+    centroids: np.ndarray of shapely.Point
+        Building centroids, in the order of `footprints`.
+    rays: np.ndarray of shapely.LineString
+        Detection rays.
+    buffers: np.ndarray of shapely.Polygon
+        Ray buffers, in the order of `rays`.
+    origins: np.ndarray of shapely.Point
+        Camera location of each detection, in the order of `rays`.
+
+    Returns
+    -------
+    building_index: np.ndarray of int
+        Index into `footprints` of the building linked to each detection, -1
+        for detections without a match.
+    """
+    building_index = np.full(len(rays), -1, dtype=np.int64)
+    if not len(rays) or not len(centroids):
+        return building_index
+
+    # Candidate pairs: centroid within the ray buffer (buffer contains centroid)
+    tree = shapely.STRtree(centroids)
+    det_idx, bldg_idx = tree.query(buffers, predicate='contains')
+
+    # Keep the pairs whose footprint the ray crosses
+    hits = shapely.intersects(footprints[bldg_idx], rays[det_idx])
+    det_idx, bldg_idx = det_idx[hits], bldg_idx[hits]
+    if not len(det_idx):
+        return building_index
+
+    # Closest centroid to the camera per detection. Distances are in degrees
+    # like the KNN ordering of the SQL engine.
+    dists = shapely.distance(centroids[bldg_idx], origins[det_idx])
+    order = np.lexsort((dists, det_idx))
+    det_idx, bldg_idx = det_idx[order], bldg_idx[order]
+    first = np.ones(len(det_idx), dtype=bool)
+    first[1:] = det_idx[1:] != det_idx[:-1]
+    building_index[det_idx[first]] = bldg_idx[first]
+    return building_index
+
+
+def load_db_buildings(session, neighborhood):
+    """Load the footprints and centroids of a neighborhood in one query
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    neighborhood: str
+        Name of neighborhood to load buildings for.
+
+    Returns
+    -------
+    ids: np.ndarray of int
+        Building IDs.
+    footprints: np.ndarray of shapely.Polygon
+    centroids: np.ndarray of shapely.Point
+    """
+    rows = session.execute(text("""
+        SELECT id, footprint, centroid FROM buildings
+        WHERE neighborhood = :neighborhood AND footprint IS NOT NULL AND centroid IS NOT NULL
+    """), {'neighborhood': neighborhood}).all()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    # Geometry columns come back as hex EWKB, which GEOS reads as is
+    footprints = shapely.from_wkb([row[1] for row in rows])
+    centroids = shapely.from_wkb([row[2] for row in rows])
+    return ids, footprints, centroids
+
+
+def load_db_detections(session, neighborhood):
+    """Load the rays, buffers and camera locations of a neighborhood in one query
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    neighborhood: str
+        Name of neighborhood to load detections for.
+
+    Returns
+    -------
+    ids: np.ndarray of int
+        Detection IDs.
+    rays: np.ndarray of shapely.LineString
+    buffers: np.ndarray of shapely.Polygon
+    origins: np.ndarray of shapely.Point
+    """
+    rows = session.execute(text("""
+        SELECT det.id, det.detection_ray, det.ray_buffer, img.lon, img.lat
+        FROM sv_detections AS det
+        JOIN sv_images AS img ON img.id = det.image_id
+        WHERE det.neighborhood = :neighborhood
+          AND det.detection_ray IS NOT NULL AND det.ray_buffer IS NOT NULL
+    """), {'neighborhood': neighborhood}).all()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    rays = shapely.from_wkb([row[1] for row in rows])
+    buffers = shapely.from_wkb([row[2] for row in rows])
+    origins = shapely.points([row[3] for row in rows], [row[4] for row in rows])
+    return ids, rays, buffers, origins
+
+
+def link_db_neighborhood(session, neighborhood):
+    """Link the detections of a neighborhood in process and write the links back in one batch
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session
+        SQL Alchemy session handle to the database
+    neighborhood: str
+        Name of neighborhood to run matches for.
+
+    Returns
+    -------
+    n_detections: int
+        Number of detections with a ray in the neighborhood.
+    n_matches: int
+        Number of detections linked to a building. The caller commits.
+    """
+    building_ids, footprints, centroids = load_db_buildings(session, neighborhood)
+    detection_ids, rays, buffers, origins = load_db_detections(session, neighborhood)
+    building_index = link_nearest_buildings(footprints, centroids, rays, buffers, origins)
+
+    matched = building_index >= 0
+    n_matches = bulk_set_building_ids(session, detection_ids[matched], building_ids[building_index[matched]])
+    return len(detection_ids), n_matches
+
+
+def sweep_link_counts(footprints, centroids, lons, lats, headings, settings):
+    """Count the detections linked to a building for several ray settings, without writing anything
+
+    Parameters
+    ----------
+    footprints, centroids: np.ndarray
+        Building geometries.
+    lons, lats, headings: np.ndarray of float
+        Camera location and ray heading of each detection, as returned by
+        `db_bulk.detection_origins`.
+    settings: iterable of tuple
+        (ray_length, buffer_distance) pairs in meters.
+
+    Yields
+    ------
+    ray_length, buffer_distance: float
+        Setting the count was computed for.
+    n_matches: int
+        Number of detections linked to a building.
+    """
+    origins = shapely.points(lons, lats)
+    for ray_length, buffer_distance in settings:
+        rays = generate_rays(lons, lats, headings, ray_length)
+        buffers = generate_buffer_rays(rays, buffer_distance)
+        building_index = link_nearest_buildings(footprints, centroids, rays, buffers, origins)
+        yield ray_length, buffer_distance, int(np.count_nonzero(building_index >= 0))
+
+
+def load_file_buildings(geomfile_fpath, neighborhood=None):
+    """Load valid building polygons from a shapefile or geojson
+
+    Parameters
+    ----------
+    geomfile_fpath: str
+        File path to shapefile or geojson containing building polygons, with a
+        "neighborho" column holding the neighborhood.
+    neighborhood: str or None
+        If specified, only load buildings of this neighborhood.
+
+    Returns
+    -------
+    ids: np.ndarray of int
+        Feature index of each building in `geomfile_fpath`.
+    footprints: np.ndarray of shapely.Polygon
+    centroids: np.ndarray of shapely.Point
+    """
+    ogr_driver = 'ESRI Shapefile' if op.splitext(geomfile_fpath)[1] == '.shp' else 'GeoJSON'
+    dataSource = ogr.GetDriverByName(ogr_driver).Open(geomfile_fpath, 0)
+    if dataSource is None:
+        raise RuntimeError(f'Could not open {geomfile_fpath}')
+    layer = dataSource.GetLayer()
+
+    ids, wkbs = [], []
+    for gi in tqdm(range(layer.GetFeatureCount()), desc='Loading buildings'):
+        feat = layer.GetFeature(gi)
+        geom = feat.GetGeometryRef()
+        if geom is None or geom.GetGeometryName() != 'POLYGON' or not geom.IsValid():
+            continue
+        if neighborhood is not None and feat.GetField('neighborho') != neighborhood:
+            continue
+        ids.append(gi)
+        wkbs.append(bytes(geom.ExportToWkb()))
+
+    footprints = shapely.from_wkb(wkbs)
+    return np.array(ids, dtype=np.int64), footprints, shapely.centroid(footprints)
+
+
+def load_file_images(image_csv_fpath, neighborhood=None):
+    """Build the image lookup of `db_bulk.image_lookup` from a trajectory CSV file
+
+    Parameters
+    ----------
+    image_csv_fpath: str
+        Filepath to the CSV file containing image information, in the format
+        documented in `db_package.add_images`.
+    neighborhood: str or None
+        If specified, only load images of this neighborhood.
+
+    Returns
+    -------
+    images: dict
+        (frame, subfolder, image_fname, cam) -> `ImageRef`, with the CSV line
+        number as ID. Rows that cannot be parsed are skipped.
+    """
+    images = {}
+    with open(image_csv_fpath, 'r') as csvfile:
+        reader = csv.DictReader(csvfile, delimiter=',')
+        for row in reader:
+            if neighborhood is not None and row['neighborhood'] != neighborhood:
+                continue
+            try:
+                key = (row['frame'], row['subfolder'], row['image_fname'], int(row['cam']))
+                images[key] = ImageRef(reader.line_num, float(row['longitude[deg]']),
+                                       float(row['latitude[deg]']), float(row['heading[deg]']),
+                                       row['neighborhood'])
+            except (TypeError, ValueError):
+                continue
+    return images
+
+
+def link_placed_detections(placed, rays, buffers, building_ids, footprints, centroids):
+    """Link detections placed by `db_bulk.place_detections` and tabulate them
+
+    Parameters
+    ----------
+    placed: list of PlacedDetection
+        Detections resolved to their image.
+    rays, buffers: np.ndarray
+        Ray and ray buffer of each placed detection.
+    building_ids: np.ndarray of int
+        ID of each building in `footprints`.
+    footprints, centroids: np.ndarray
+        Building geometries.
+
+    Returns
+    -------
+    links: pandas.DataFrame
+        One row per detection, with a nullable `building_id` column.
+    """
+    origins = shapely.points([p.image.lon for p in placed], [p.image.lat for p in placed])
+    building_index = link_nearest_buildings(footprints, centroids, rays, buffers, origins)
+    matched = building_index >= 0
+
+    links = pd.DataFrame({
+        'image_id': [p.image.id for p in placed],
+        'neighborhood': [p.image.neighborhood for p in placed],
+        'y_min': [p.bbox[0] for p in placed],
+        'x_min': [p.bbox[1] for p in placed],
+        'y_max': [p.bbox[2] for p in placed],
+        'x_max': [p.bbox[3] for p in placed],
+        'class_id': [p.class_id for p in placed],
+        'class_str': [p.class_str for p in placed],
+        'confidence': [p.score for p in placed],
+        'angle': [p.heading for p in placed],
+        'detection_ray': shapely.to_wkb(rays),
+    })
+    building_id = pd.array([None] * len(placed), dtype='Int64')
+    building_id[matched] = building_ids[building_index[matched]]
+    links['building_id'] = building_id
+    return links
+
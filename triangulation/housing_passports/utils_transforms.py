@@ -6,6 +6,7 @@ Transform detected objects from image to map coordinates
 import csv
 
 import numpy as np
+import shapely
 from osgeo import ogr
 from pyproj import Geod
 from pyproj import CRS
@@ -17,6 +18,7 @@ from shapely.wkt import loads
 
 transformer_4326_3857 = Transformer.from_crs("epsg:4326", "epsg:3857")
 transformer_3857_4326 = Transformer.from_crs("epsg:3857", "epsg:4326")
+geod_wgs84 = Geod(ellps='WGS84')
 
 def load_geo_layer(fpath, ogr_driver='GeoJSON'):
     """Load a geojson file using GDAL and return layer"""
@@ -146,6 +148,33 @@ def interpolate(norm_prop, min_val, max_val):
 
     return min_val + (max_val - min_val) * norm_prop
 
+def detection_heading(cam, od_mean_x, gps_heading, fov_extent=90.):
+    """Find the heading of a detection from its position in the L/R camera view
+
+    Parameters
+    ----------
+    cam: int
+        Camera number, 1 for the right view and 3 for the left view.
+    od_mean_x: float
+        Horizontal center of the detection bbox, normalized between 0 and 1.
+    gps_heading: float
+        Heading of car on interval [0, 360) when the image was taken.
+    fov_extent: float
+        Field of view (degrees) of camera
+
+    Returns
+    -------
+    heading: float
+        Heading (degrees) of the ray from the car towards the detection.
+    """
+    vext = get_LR_visual_extents(gps_heading, fov_extent)
+    if cam == 1:
+        return interpolate(od_mean_x, vext['r_min'], vext['r_max'])
+    elif cam == 3:
+        return interpolate(od_mean_x, vext['l_min'], vext['l_max'])
+    raise RuntimeError('Key indicating camera view unrecognized')
+
+
 def generate_buffer(lon, lat, distance):
     """Generate a Buffer from lon and lat of the image
 
@@ -181,6 +210,58 @@ def generate_buffer(lon, lat, distance):
     return polygonSimple.wkt
 
 
+def generate_ray_endpoints(lon_start, lat_start, az, distance=20):
+    """Find the end points of rays from start locations, angles, and distances
+
+    Parameters
+    ----------
+    lon_start: array_like
+        Longitude points in deg
+    lat_start: array_like
+        Latitude points in deg
+    az: array_like
+        Azimuth headings used to generate 2nd line points
+    distance: float or array_like
+        Distance away from start lat/lon coordinates in meters
+
+    Returns
+    -------
+    lon_end, lat_end: np.ndarray
+        Longitude and latitude of the ray end points in deg
+    """
+    lon_start, lat_start, az, distance = np.broadcast_arrays(
+        *(np.asarray(arr, dtype=float) for arr in (lon_start, lat_start, az, distance)))
+    lon_end, lat_end, _ = geod_wgs84.fwd(lon_start, lat_start, az, distance)
+    return np.asarray(lon_end), np.asarray(lat_end)
+
+
+def generate_rays(lon_start, lat_start, az, distance=20):
+    """Generate linestrings from start locations, angles, and distances in one vectorized call
+
+    Parameters
+    ----------
+    lon_start: array_like
+        Longitude points in deg
+    lat_start: array_like
+        Latitude points in deg
+    az: array_like
+        Azimuth headings used to generate 2nd line points
+    distance: float or array_like
+        Distance away from start lat/lon coordinates in meters
+
+    Returns
+    -------
+    lines: np.ndarray of shapely.LineString
+        Ray linestrings. Use `shapely.to_wkb` or `shapely.to_wkt` to encode them.
+    """
+    lon_end, lat_end = generate_ray_endpoints(lon_start, lat_start, az, distance)
+    lon_start = np.broadcast_to(np.asarray(lon_start, dtype=float), lon_end.shape)
+    lat_start = np.broadcast_to(np.asarray(lat_start, dtype=float), lon_end.shape)
+    coords = np.stack([np.stack([lon_start, lat_start], axis=-1),
+                       np.stack([lon_end, lat_end], axis=-1)], axis=-2)
+    return shapely.linestrings(coords.reshape(-1, 2, 2))
+
+
 def generate_ray(lon_start, lat_start, az, distance=20):
     """Generate a linestring object from a start location, angle, and distance
 
@@ -200,15 +281,7 @@ def generate_ray(lon_start, lat_start, az, distance=20):
     line: str
         WKT specifying ray linestring
     """
-
-    # Interpolate end point using a start point, heading, and distance
-    geod = Geod(ellps='WGS84')
-    lon_end, lat_end, az_end = geod.fwd(lon_start, lat_start, az, distance)
-
-    # Create line from start and (derived) end point
-    line = LineString([(lon_start, lat_start), (lon_end, lat_end)])
-
-    return line.wkt
+    return generate_rays([lon_start], [lat_start], [az], distance)[0].wkt
 
 
 def calc_pt_dist_to_geom(xy_pt, geoms):
@@ -247,13 +320,191 @@ def calc_pt_dist_to_geom(xy_pt, geoms):
 
     return dists
 
-def generate_buffer_ray(wkt_linestring, distance=15):
+def _project_rays(rays):
+    """Reproject the two points of each ray to EPSG:3857 in one call
+
+    Returns
+    -------
+    x, y: np.ndarray
+        Arrays of shape (N, 2) holding the start and end point of each ray.
+    """
+    coords = shapely.get_coordinates(rays).reshape(-1, 2, 2)
+    x, y = transformer_4326_3857.transform(coords[..., 1].ravel(), coords[..., 0].ravel())
+    return np.asarray(x).reshape(-1, 2), np.asarray(y).reshape(-1, 2)
+
+
+def _buffered_bounds(rays, distance):
+    """Envelopes by buffering each ray in EPSG:3857 and reprojecting every buffer vertex"""
+    coords, index = shapely.get_coordinates(rays, return_index=True)
+    x_3857, y_3857 = transformer_4326_3857.transform(coords[:, 1], coords[:, 0])
+    rays_3857 = shapely.linestrings(np.stack([x_3857, y_3857], axis=-1), indices=index)
+    # quad_segs=16 is the default of `LineString.buffer`, used by the original implementation
+    buffers_3857 = shapely.buffer(rays_3857, distance, quad_segs=16)
+
+    coords, index = shapely.get_coordinates(buffers_3857, return_index=True)
+    lat, lon = transformer_3857_4326.transform(coords[:, 0], coords[:, 1])
+    bounds = np.empty((len(rays), 4))
+    bounds[:, :2] = np.inf
+    bounds[:, 2:] = -np.inf
+    np.minimum.at(bounds[:, 0], index, lon)
+    np.minimum.at(bounds[:, 1], index, lat)
+    np.maximum.at(bounds[:, 2], index, lon)
+    np.maximum.at(bounds[:, 3], index, lat)
+    return bounds
+
+
+def _envelope_bounds(rays, distance):
+    """Envelopes computed from the ray end points, without building the buffers
+
+    The round-capped buffer of a segment is the segment swept by a disk, so
+    its envelope in EPSG:3857 is the end points' envelope grown by `distance`.
+    EPSG:3857 to lon/lat is monotonic per axis, so reprojecting the two
+    envelope corners gives the lon/lat envelope.
+    """
+    x, y = _project_rays(rays)
+    distance = np.asarray(distance, dtype=float)
+    lat_min, lon_min = transformer_3857_4326.transform(x.min(axis=1) - distance, y.min(axis=1) - distance)
+    lat_max, lon_max = transformer_3857_4326.transform(x.max(axis=1) + distance, y.max(axis=1) + distance)
+    return np.stack([lon_min, lat_min, lon_max, lat_max], axis=-1)
+
+
+def generate_buffer_ray_bounds(rays, distance=15, method='envelope'):
+    """Get the lon/lat bounding boxes of buffered detection rays in one vectorized pass
+
+    Parameters
+    ----------
+    rays: array_like of shapely.LineString
+        Detection rays in lon/lat
+    distance: float or array_like
+        Distance (meters) to generate the buffer
+    method: str
+        'envelope' computes the bounding boxes analytically from the ray end
+        points. 'buffer' buffers each ray in EPSG:3857 and reprojects every
+        buffer vertex with 16 segments per quarter circle, which returns the
+        same bounds as the original implementation. The two differ by the
+        polygonal approximation of the round caps, at most
+        `distance * (1 - cos(pi / 64))` (see `buffer_envelope_deviation`).
+
+    Returns
+    -------
+    bounds: np.ndarray
+        Array of shape (N, 4) holding minx, miny, maxx, maxy in lon/lat
+    """
+    rays = np.asarray(rays)
+    if not len(rays):
+        return np.empty((0, 4))
+    if method == 'envelope':
+        return _envelope_bounds(rays, distance)
+    elif method == 'buffer':
+        return _buffered_bounds(rays, distance)
+    raise ValueError(f'Unknown buffer method: {method}')
+
+
+def buffer_envelope_deviation(rays, distance=15):
+    """Validate the analytic envelopes against the buffer-then-bbox envelopes
+
+    Parameters
+    ----------
+    rays: array_like of shapely.LineString
+        Detection rays in lon/lat
+    distance: float or array_like
+        Distance (meters) to generate the buffer
+
+    Returns
+    -------
+    deviation: float
+        Largest difference (meters, in EPSG:3857) between any bound of the two
+        methods. The analytic envelope contains the polygonal one, whose cap
+        vertices are pi / 32 apart, so this stays under
+        `distance * (1 - cos(pi / 64))` (about 1.8 cm for 15 m).
+    """
+    bounds = {}
+    for method in ('envelope', 'buffer'):
+        lon_lat = generate_buffer_ray_bounds(rays, distance, method).reshape(-1, 2)
+        x, y = transformer_4326_3857.transform(lon_lat[:, 1], lon_lat[:, 0])
+        bounds[method] = np.stack([x, y], axis=-1)
+    if not len(bounds['envelope']):
+        return 0.
+    return float(np.abs(bounds['envelope'] - bounds['buffer']).max())
+
+
+def generate_oriented_buffer_rays(rays, distance=15):
+    """Get rectangles around detection rays, aligned with each ray
+
+    The rectangle extends `distance` meters on both sides of the ray and past
+    both of its ends (a square-capped buffer), computed in EPSG:3857 and
+    reprojected with one call for all rays. Unlike the bounding box, its area
+    does not grow with the ray's angle to the meridian.
+
+    Parameters
+    ----------
+    rays: array_like of shapely.LineString
+        Detection rays in lon/lat
+    distance: float or array_like
+        Distance (meters) to generate the buffer
+
+    Returns
+    -------
+    polygons: np.ndarray of shapely.Polygon
+        Oriented rectangle around each ray.
+    """
+    rays = np.asarray(rays)
+    if not len(rays):
+        return np.empty(0, dtype=object)
+    x, y = _project_rays(rays)
+    distance = np.asarray(distance, dtype=float)[..., None] if np.ndim(distance) else float(distance)
+
+    # Unit vectors along and across each ray. Degenerate rays get an east-west axis.
+    dx, dy = x[:, 1] - x[:, 0], y[:, 1] - y[:, 0]
+    length = np.hypot(dx, dy)
+    safe_length = np.where(length > 0, length, 1.)
+    ux, uy = np.where(length > 0, dx / safe_length, 1.), np.where(length > 0, dy / safe_length, 0.)
+    along = np.stack([ux, uy], axis=-1) * distance
+    across = np.stack([-uy, ux], axis=-1) * distance
+
+    start = np.stack([x[:, 0], y[:, 0]], axis=-1) - along
+    end = np.stack([x[:, 1], y[:, 1]], axis=-1) + along
+    corners = np.stack([start - across, end - across, end + across, start + across], axis=1)
+
+    lat, lon = transformer_3857_4326.transform(corners[..., 0].ravel(), corners[..., 1].ravel())
+    lon_lat = np.stack([lon, lat], axis=-1).reshape(-1, 4, 2)
+    return shapely.polygons(lon_lat)
+
+
+def generate_buffer_rays(rays, distance=15, method='envelope'):
+    """Get the buffer polygons of detection rays
+
+    Parameters
+    ----------
+    rays: array_like of shapely.LineString
+        Detection rays in lon/lat
+    distance: float or array_like
+        Distance (meters) to generate the buffer
+    method: str
+        'envelope' or 'buffer' for the bounding box of the buffered ray (see
+        `generate_buffer_ray_bounds`), 'rectangle' for the oriented rectangle
+        of `generate_oriented_buffer_rays`.
+
+    Returns
+    -------
+    polygons: np.ndarray of shapely.Polygon
+        Buffer polygon of each ray. Use `shapely.to_wkb` or `shapely.to_wkt`
+        to encode them.
+    """
+    if method == 'rectangle':
+        return generate_oriented_buffer_rays(rays, distance)
+    bounds = generate_buffer_ray_bounds(rays, distance, method)
+    return shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+
+
+def generate_buffer_ray(wkt_linestring, distance=15, method='envelope'):
     """Get buffer of detection ray
 
     Parameters
     ----------
     wkt_linestring: detection ray lineString
     distance: distance to generate the buffer
+    method: 'envelope', 'buffer' or 'rectangle', see `generate_buffer_rays`
 
     Returns
     -------
@@ -263,24 +514,4 @@ def generate_buffer_ray(wkt_linestring, distance=15):
     -------
     print(generate_buffer_ray('LINESTRING (100.379621266922 -0.9399297362403251, 100.3794650645071 -0.9398403340425333)'))
     """
-    lineString_4326 = loads(wkt_linestring)
-    # Reproject LineString
-    array_coords_3857 = []
-    for point in list(lineString_4326.coords):
-        x = point[0]
-        y = point[1]
-        x, y = transformer_4326_3857.transform(y, x)
-        array_coords_3857.append((y, x))
-    lineString_3857 = LineString(array_coords_3857)
-    # # Buffer the lineString
-    polygon_3857 = lineString_3857.buffer(distance)
-    proj_buffer_points = []
-    for point in list(polygon_3857.exterior.coords):
-        x = point[0]
-        y = point[1]
-        x, y = transformer_3857_4326.transform(y, x)
-        proj_buffer_points.append((y, x))
-    polygon_4326 = Polygon(proj_buffer_points)
-    bounds = polygon_4326.bounds
-    bounds_poly = box(minx=bounds[0], miny=bounds[1], maxx=bounds[2], maxy=bounds[3])
-    return bounds_poly.wkt
+    return generate_buffer_rays([loads(wkt_linestring)], distance, method)[0].wkt
@@ -22,6 +22,7 @@ from mapillary.heading import compass_to_cartesian
 from tqdm import tqdm
 import fire
 import geopandas as gpd
+import pandas as pd
 from copy import deepcopy
 from shapely import wkb
 from shapely.geometry import shape
@@ -74,6 +75,31 @@ def include_geom(features, features_area):
     return features
 
 
+def read_predictions(predictions_file):
+    """Read detect_clip_classify predictions as a list of dicts with parsed `boxes`.
+
+    Parquet predictions carry typed columns and are read without any string
+    parsing; CSV predictions use the original layout with JSON-encoded boxes.
+    """
+    if predictions_file.endswith(".parquet"):
+        df = pd.read_parquet(predictions_file)
+        boxes = df[["x1", "y1", "x2", "y2"]].astype(float).values.tolist()
+        df = df.drop(columns=["x1", "y1", "x2", "y2"]).rename(columns={"score": "box_scores"})
+        for column in df.select_dtypes("category").columns:
+            df[column] = df[column].astype(str)
+        rows = df.to_dict("records")
+        for row, box in zip(rows, boxes):
+            row["boxes"] = box
+        return rows
+
+    rows = read_csv(predictions_file)
+    for box in tqdm(rows, desc="parse csv boxes"):
+        box["boxes"] = json.loads(box.get("boxes"))
+        box["boxes_float"] = json.loads(box.get("boxes_float", "[]"))
+        box["boxes_int"] = json.loads(box.get("boxes_int", "[]"))
+    return rows
+
+
 def combine_resources(
     predictions_csv,
     original_geojson,
@@ -96,7 +122,7 @@ def combine_resources(
     This function integrates the annotated cvat data in csv format, the original points and the buildings to combine and validate them.
 
     Parameters:
-    - predictions_csv (str): Path CSV file containing predictions csv.
+    - predictions_csv (str): Path CSV or Parquet file containing predictions.
     - original_geojson (str): Path GeoJSON points file.
     - gpkg_buildings_file (str): Path GeoPackage file with building data.
     - prefix_path_images (str): Prefix path for images.
@@ -123,15 +149,12 @@ def combine_resources(
 
     # df_polygons = gpd.read_file(gpkg_buildings_file)
 
-    csv_predictions_data = read_csv(predictions_csv)
+    csv_predictions_data = read_predictions(predictions_csv)
     print("total_csv", len(csv_predictions_data))
     # group csv data
     csv_groups = {}
     for box in tqdm(csv_predictions_data, desc="group csv data"):
         fake_key = box.get("image_name").strip()
-        box["boxes"] = json.loads(box.get("boxes"))
-        box["boxes_float"] = json.loads(box.get("boxes_float", "[]"))
-        box["boxes_int"] = json.loads(box.get("boxes_int", "[]"))
 
         if not csv_groups.get(fake_key):
             csv_groups[fake_key] = []
@@ -34,8 +34,11 @@ setup(
         "passport_annot = housing_passports.local_inf_cli:save_annotated_image",
         "passport_db_export = housing_passports.db_package:export_to_db",
         "passport_link_db_detections = housing_passports.db_package:link_db_detections",
+        "passport_link_file_detections = housing_passports.db_package:link_file_detections",
+        "passport_sweep_ray_settings = housing_passports.db_package:sweep_ray_settings",
         "passport_distill_metadata = housing_passports.db_package:distill_building_metadata",
-        "passport_detection_export = housing_passports.db_package:export_detection_geometry"]},
+        "passport_detection_export = housing_passports.db_package:export_detection_geometry",
+        "passport_pipeline = housing_passports.db_package:run_pipeline"]},
     packages=find_packages(exclude=['docs', 'tests*']),
     include_package_data=True,
     install_requires=install_requires,
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+
+try:
+    import shapely
+    from housing_passports.link_offline import link_nearest_buildings
+    from housing_passports.utils_transforms import generate_buffer_rays, generate_rays
+except ImportError:
+    link_nearest_buildings = None
+
+
+def brute_force_link(footprints, centroids, rays, buffers, origins):
+    """Building linked to each detection by `LINK_DETECTIONS_SQL`, one pair at a time"""
+    building_index = np.full(len(rays), -1, dtype=np.int64)
+    for di, (ray, buffer, origin) in enumerate(zip(rays, buffers, origins)):
+        candidates = [bi for bi, (footprint, centroid) in enumerate(zip(footprints, centroids))
+                      if buffer.contains(centroid) and ray.intersects(footprint)]
+        if candidates:
+            building_index[di] = min(candidates, key=lambda bi: centroids[bi].distance(origin))
+    return building_index
+
+
+@unittest.skipIf(link_nearest_buildings is None, 'GDAL, GeoAlchemy2, shapely or pyproj is not installed')
+class TestLinkNearestBuildings(unittest.TestCase):
+    """ Test the bulk building links against a brute-force reference """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        lon0, lat0 = -72.33, 18.54
+        n_buildings, n_detections = 400, 300
+
+        # ~10 m square footprints scattered over ~500 m
+        lons = lon0 + rng.uniform(0, 0.005, n_buildings)
+        lats = lat0 + rng.uniform(0, 0.005, n_buildings)
+        half = rng.uniform(0.00003, 0.00006, n_buildings)
+        self.footprints = shapely.box(lons - half, lats - half, lons + half, lats + half)
+        self.centroids = shapely.centroid(self.footprints)
+
+        cam_lons = lon0 + rng.uniform(0, 0.005, n_detections)
+        cam_lats = lat0 + rng.uniform(0, 0.005, n_detections)
+        headings = rng.uniform(0, 360, n_detections)
+        self.rays = generate_rays(cam_lons, cam_lats, headings, 40)
+        self.buffers = generate_buffer_rays(self.rays, 15)
+        self.origins = shapely.points(cam_lons, cam_lats)
+
+    def test_matches_brute_force(self):
+        """ The bulk query links the same building as the pairwise reference """
+        expected = brute_force_link(self.footprints, self.centroids, self.rays, self.buffers, self.origins)
+        building_index = link_nearest_buildings(self.footprints, self.centroids, self.rays, self.buffers,
+                                                self.origins)
+        np.testing.assert_array_equal(building_index, expected)
+        # The scene has both linked and unlinked detections
+        self.assertTrue(0 < np.count_nonzero(expected >= 0) < len(expected))
+
+    def test_empty_inputs(self):
+        """ Without buildings or detections nothing is linked """
+        no_buildings = link_nearest_buildings(self.footprints[:0], self.centroids[:0], self.rays,
+                                              self.buffers, self.origins)
+        np.testing.assert_array_equal(no_buildings, np.full(len(self.rays), -1))
+        no_detections = link_nearest_buildings(self.footprints, self.centroids, self.rays[:0],
+                                               self.buffers[:0], self.origins[:0])
+        self.assertEqual(len(no_detections), 0)